@@ -0,0 +1,118 @@
+"""
+Reservation-based admission control.
+
+A launch is admitted when the RAM *committed* to instances (the memory
+limit each was started with, plus launches still in flight) leaves room
+for its own limit within
+
+    (host RAM - MIN_RAM_FREE_MB) * RAM_OVERCOMMIT_RATIO
+
+instead of comparing against whatever happens to be free at that moment.
+Limits are enforced per instance by its cgroup (api/cgroups.py), so the
+commitment is a real upper bound unless overcommit is configured.
+
+With several backend workers the launches in flight of the others are read
+from their shared reservations (api/workers.py), and checking plus
+recording a reservation happens under the cross-worker launch lock.
+"""
+import os, threading
+from contextlib import nullcontext
+
+RAM_OVERCOMMIT_RATIO = float(os.environ.get("JUPYTER_RAM_OVERCOMMIT", "1.0"))
+
+
+class AdmissionDenied(Exception):
+    pass
+
+
+class AdmissionController:
+    def __init__(self, host_ram_mb, min_free_mb, default_instance_mb, get_instances,
+                 overcommit=RAM_OVERCOMMIT_RATIO, shared=None):
+        """
+        host_ram_mb(): total host RAM
+        get_instances(): port -> state info; each entry commits limits.memory_mb
+        (default_instance_mb for entries started before limits existed)
+        shared: SharedReservations of all backend workers, or None
+        """
+        self.host_ram_mb = host_ram_mb
+        self.min_free_mb = min_free_mb
+        self.default_instance_mb = default_instance_mb
+        self.get_instances = get_instances
+        self.overcommit = overcommit
+        self.shared = shared
+        self._pending = {}   # port -> MB for launches not yet in the state store
+        self._lock = threading.Lock()
+
+    def _launch_lock(self):
+        # Held across check and record, so other workers can't admit in between
+        return self.shared.lock if self.shared is not None else nullcontext()
+
+    def capacity_mb(self):
+        return int((self.host_ram_mb() - self.min_free_mb) * self.overcommit)
+
+    def _committed(self):
+        # Caller holds self._lock
+        instances = self.get_instances()
+        committed = sum(
+            info.get("limits", {}).get("memory_mb", self.default_instance_mb)
+            for info in instances.values()
+        )
+        pending = {**self.shared.memory(), **self._pending} if self.shared is not None else self._pending
+        # A pending launch whose entry already landed is counted once, via the entry
+        return committed + sum(mb for port, mb in pending.items() if str(port) not in instances)
+
+    def committed_mb(self):
+        with self._lock:
+            return self._committed()
+
+    def headroom_mb(self):
+        return self.capacity_mb() - self.committed_mb()
+
+    def reserve(self, port, memory_mb):
+        """Commit memory_mb for a launch on port, or raise AdmissionDenied."""
+        with self._launch_lock(), self._lock:
+            # Checked and recorded under one lock so concurrent launches can't both squeeze in
+            committed = self._committed()
+            capacity = self.capacity_mb()
+            if committed + memory_mb > capacity:
+                raise AdmissionDenied(
+                    f"Not enough RAM: {committed} MB of {capacity} MB committed, {memory_mb} MB requested"
+                )
+            self._pending[int(port)] = memory_mb
+            if self.shared is not None:
+                self.shared.add(port, memory_mb)
+
+    def reserve_many(self, requests):
+        """Commit {port: memory_mb} all at once (a batch), or raise AdmissionDenied for all of it."""
+        with self._launch_lock(), self._lock:
+            committed = self._committed()
+            capacity = self.capacity_mb()
+            wanted = sum(requests.values())
+            if committed + wanted > capacity:
+                raise AdmissionDenied(
+                    f"Not enough RAM for the batch: {committed} MB of {capacity} MB committed, {wanted} MB requested"
+                )
+            for port, memory_mb in requests.items():
+                self._pending[int(port)] = memory_mb
+                if self.shared is not None:
+                    self.shared.add(port, memory_mb)
+
+    def release(self, port):
+        """Drop the in-flight reservation (the launch finished or failed)."""
+        with self._lock:
+            self._pending.pop(int(port), None)
+        if self.shared is not None:
+            self.shared.remove(port)
+
+    def stats(self):
+        capacity = self.capacity_mb()
+        committed = self.committed_mb()
+        with self._lock:
+            pending = dict(self._pending)
+        return {
+            "capacity_mb": capacity,
+            "committed_mb": committed,
+            "headroom_mb": capacity - committed,
+            "overcommit_ratio": self.overcommit,
+            "pending": pending,
+        }
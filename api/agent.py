@@ -0,0 +1,212 @@
+"""
+Node agent: the per-host half of multi-host scheduling.
+
+Each extra host runs one agent next to its Jupyter servers. It owns the
+host's port range, RAM admission, start_jupyter.sh and sampling (with its
+own state store), and the backend (api/main.py, api/nodes.py) calls it to
+place sessions:
+
+    GET  /health        ports, RAM headroom, last sample of every server
+    POST /launch        start a server (port optional), returns port/pid
+    POST /stop/{port}   stop one and everything it started (api/procs.py)
+    GET  /logs/{port}   a byte range of one's jupyter.log
+
+Expiry, idle culling, history and the public API stay in the backend.
+
+    JUPYTER_NODE_NAME=node-2 JUPYTER_PUBLIC_HOST=10.0.0.12 \\
+    JUPYTER_PORT_RANGE=9000-9100 JUPYTER_AGENT_TOKEN=... \\
+    uvicorn api.agent:app --host 0.0.0.0 --port 8100
+
+Requests must carry X-Agent-Token when JUPYTER_AGENT_TOKEN is set. Port
+ranges of the nodes of one backend must not overlap (sessions are keyed by
+port). For a local test cluster, give every agent its own JUPYTER_STATE_DIR
+and port range and point JUPYTER_START_SCRIPT at
+scripts/stub_start_jupyter.sh.
+"""
+import asyncio, os, secrets, socket
+
+import psutil
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel
+from typing import Optional
+
+from api.admission import AdmissionController, AdmissionDenied
+from api.cgroups import cgroup_path, cgroup_v2_available
+from api.jobs import LaunchError, LaunchJob, run_start_script, start_script_argv
+from api.logs import LOG_BACKUPS, LOG_READ_BYTES, LogRotator, log_path, read_log
+from api.ports import PortAllocator, PortUnavailable
+from api.procs import OrphanSweeper, is_running, stop_process_tree
+from api.sampler import ResourceSampler
+from api.seeding import UnknownTemplate, template_dir
+from api.state import get_store
+
+NODE_NAME = os.environ.get("JUPYTER_NODE_NAME") or socket.gethostname()
+PUBLIC_HOST = os.environ.get("JUPYTER_PUBLIC_HOST", "")   # empty: the host the backend reaches us on
+AGENT_TOKEN = os.environ.get("JUPYTER_AGENT_TOKEN", "")
+START_SCRIPT = os.environ.get("JUPYTER_START_SCRIPT", "/home/ubuntu/jupyter_service/scripts/start_jupyter.sh")
+MAX_RAM_USAGE_PER_INSTANCE_MB = 1024
+MIN_RAM_FREE_MB = 1024
+LAUNCH_TIMEOUT_SECONDS = 60
+
+app = FastAPI(title="Jupyter Node Agent")
+port_allocator = PortAllocator()
+
+
+def forget_instance(port):
+    get_store().delete(port)
+    port_allocator.release(port)
+
+
+def reap_dead_instances():
+    for port, info in get_store().all().items():
+        if not info.get("pid") or not is_running(info["pid"]):
+            forget_instance(port)
+
+
+def reap_from_snapshot(snapshot):
+    store = get_store()
+    for port, sample in snapshot["instances"].items():
+        info = store.get(port)
+        if not sample["alive"] and info is not None and info.get("pid") == sample["pid"]:
+            print(f"Jupyter on port {port} (pid {sample['pid']}) is gone, forgetting it")
+            forget_instance(port)
+
+
+resource_sampler = ResourceSampler(get_instances=lambda: get_store().all(), on_sample=reap_from_snapshot)
+
+
+def get_host_ram_mb():
+    snapshot = resource_sampler.snapshot
+    if snapshot is None:
+        return psutil.virtual_memory().total // 1024 // 1024
+    return snapshot["host"]["total_mb"]
+
+
+admission = AdmissionController(
+    host_ram_mb=get_host_ram_mb,
+    min_free_mb=MIN_RAM_FREE_MB,
+    default_instance_mb=MAX_RAM_USAGE_PER_INSTANCE_MB,
+    get_instances=lambda: get_store().all(),
+)
+
+
+log_rotator = LogRotator(lambda: [info["path"] for info in get_store().all().values() if info.get("path")])
+orphan_sweeper = OrphanSweeper(lambda: {port: info.get("pid") for port, info in get_store().all().items()})
+
+
+def check_token(request: Request):
+    if AGENT_TOKEN and not secrets.compare_digest(request.headers.get("x-agent-token", ""), AGENT_TOKEN):
+        raise HTTPException(status_code=401, detail="Bad agent token")
+
+
+@app.on_event("startup")
+async def startup_event():
+    if not AGENT_TOKEN:
+        print("WARNING: JUPYTER_AGENT_TOKEN is not set; anyone who can reach this agent can start servers")
+    reap_dead_instances()
+    port_allocator.reconcile(get_store().all().keys())
+    resource_sampler.start()
+    log_rotator.start()
+    orphan_sweeper.start()
+
+
+@app.get("/health")
+def health(request: Request):
+    check_token(request)
+    snapshot = resource_sampler.snapshot or {}
+    return {
+        "name": NODE_NAME,
+        "public_host": PUBLIC_HOST or None,
+        "ports": port_allocator.stats(),
+        "ram": admission.stats(),
+        "host": snapshot.get("host"),
+        "sampled_at": snapshot.get("sampled_at"),
+        # What the store holds right now; samples may lag behind it by a pass
+        "sessions": {port: info.get("pid") for port, info in get_store().all().items()},
+        "instances": {
+            port: {
+                "pid": sample.get("pid"),
+                "alive": sample["alive"],
+                "rss_mb": sample.get("rss_mb"),
+                "cpu_percent": sample.get("cpu_percent"),
+                "kernels": sample.get("kernels"),
+                "oom_kill": (sample.get("cgroup") or {}).get("oom_kill"),
+            }
+            for port, sample in snapshot.get("instances", {}).items()
+        },
+    }
+
+
+class LaunchSpec(BaseModel):
+    password: str
+    password_hash: str
+    expires_at: str
+    limits: dict
+    api_token: str
+    port: Optional[int] = None
+    template: Optional[str] = None   # in this node's instances/common
+
+
+@app.post("/launch")
+async def launch(spec: LaunchSpec, request: Request):
+    check_token(request)
+    if spec.template:
+        try:
+            template_dir(spec.template)
+        except UnknownTemplate as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        port = port_allocator.reserve(spec.port, owner="agent")
+    except PortUnavailable as e:
+        raise HTTPException(status_code=409 if spec.port else 503, detail=str(e))
+    try:
+        admission.reserve(port, spec.limits["memory_mb"])
+    except BaseException as e:
+        port_allocator.release(port)
+        if isinstance(e, AdmissionDenied):
+            raise HTTPException(status_code=503, detail=str(e))
+        raise
+
+    job = LaunchJob({"user_port": port})
+    try:
+        port, pid = await run_start_script(
+            job,
+            start_script_argv(START_SCRIPT, spec.password, spec.password_hash, spec.expires_at, port, spec.limits, spec.api_token, spec.template),
+            timeout=LAUNCH_TIMEOUT_SECONDS,
+        )
+        cgroup = cgroup_path(port) if cgroup_v2_available() else None
+        get_store().update(port, limits=spec.limits, cgroup=cgroup, api_token=spec.api_token)
+    except BaseException as e:
+        # Whatever failed (including a cancelled request), the port goes back
+        port_allocator.release(port)
+        if isinstance(e, LaunchError):
+            raise HTTPException(status_code=500, detail=str(e))
+        raise
+    finally:
+        admission.release(port)
+    port_allocator.commit(port)
+    print(f"Jupyter on port {port} ready in {job.timings.get('readiness')} ms")
+    return {"port": port, "pid": pid, "cgroup": cgroup, "timings": job.timings}
+
+
+@app.post("/stop/{port}")
+async def stop(port: int, request: Request):
+    check_token(request)
+    info = get_store().get(port)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    report = await asyncio.get_running_loop().run_in_executor(None, stop_process_tree, info.get("pid"), port)
+    forget_instance(port)
+    return {"status": "stopped", "port": port, **report}
+
+
+@app.get("/logs/{port}")
+def logs(port: int, request: Request, offset: Optional[int] = None, length: int = LOG_READ_BYTES, backup: int = 0, whole_lines: bool = False):
+    check_token(request)
+    info = get_store().get(port)
+    if info is None or not info.get("path") or not 0 <= backup <= LOG_BACKUPS:
+        raise HTTPException(status_code=404, detail="Log not found")
+    try:
+        return read_log(log_path(info["path"], backup), offset, length, whole_lines)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Log not found")
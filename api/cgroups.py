@@ -0,0 +1,63 @@
+"""
+Per-instance cgroup v2 limits.
+
+start_jupyter.sh creates CGROUP_ROOT/<port>, writes memory.max, cpu.weight
+and pids.max from the launch parameters and moves the freshly spawned
+server into it (one sudo call), so every kernel the server starts later
+inherits the same limits. This module holds the defaults and reads the
+cgroup's counters back for the sampler, including OOM events from
+memory.events.
+"""
+import os
+
+CGROUP_ROOT = "/sys/fs/cgroup/jupyter"
+
+DEFAULT_CPU_WEIGHT = 100     # cgroup v2 default; range 1-10000
+DEFAULT_PIDS_MAX = 512
+
+
+def cgroup_path(port):
+    return os.path.join(CGROUP_ROOT, str(port))
+
+
+def cgroup_v2_available():
+    return os.path.exists("/sys/fs/cgroup/cgroup.controllers")
+
+
+def default_limits(memory_mb):
+    return {"memory_mb": memory_mb, "cpu_weight": DEFAULT_CPU_WEIGHT, "pids_max": DEFAULT_PIDS_MAX}
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return None if value == "max" else int(value)
+
+
+def _read_keyed(path):
+    try:
+        with open(path) as f:
+            return {k: int(v) for k, v in (line.split() for line in f if line.strip())}
+    except OSError:
+        return {}
+
+
+def read_stats(path):
+    """Current usage, limits and OOM counters of one instance cgroup (None if it is gone)."""
+    if not os.path.isdir(path):
+        return None
+    events = _read_keyed(os.path.join(path, "memory.events"))
+    current = _read_int(os.path.join(path, "memory.current"))
+    peak = _read_int(os.path.join(path, "memory.peak"))
+    memory_max = _read_int(os.path.join(path, "memory.max"))
+    return {
+        "memory_current_mb": current // 1024 // 1024 if current is not None else None,
+        "memory_peak_mb": peak // 1024 // 1024 if peak is not None else None,
+        "memory_max_mb": memory_max // 1024 // 1024 if memory_max is not None else None,
+        "pids_current": _read_int(os.path.join(path, "pids.current")),
+        "oom": events.get("oom", 0),
+        "oom_kill": events.get("oom_kill", 0),
+    }
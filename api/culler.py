@@ -0,0 +1,230 @@
+"""
+Activity-based idle culling.
+
+Every CULL_INTERVAL_SECONDS each live instance is asked for /api/status and
+/api/kernels (concurrently, at most CULL_CONCURRENCY at a time) using the
+per-server API token start_jupyter.sh hands to Jupyter. From the
+last_activity timestamps:
+
+  * kernels idle for longer than the instance's kernel_minutes are shut
+    down through the Jupyter API (busy kernels are never touched),
+  * a server whose newest activity (its own or any kernel's) is older than
+    server_minutes is handed to on_idle_server(port) to be stopped, or to
+    on_park_server(port) to be parked when its server_action is "park"
+    (stopped until the next request, see api/main.py).
+
+Policies come from the "idle" field of the state entry, set through the
+start API, with JUPYTER_IDLE_KERNEL_MINUTES / JUPYTER_IDLE_SERVER_MINUTES /
+JUPYTER_IDLE_SERVER_ACTION as defaults; 0 minutes disables that step. The memory freed by each action is
+measured right before it (kernel process tree / instance RSS) and reported
+as reclaimed.
+"""
+import asyncio, json, os, time, urllib.request
+from datetime import datetime
+
+import psutil
+
+from api.metrics import (
+    idle_kernels_culled_total, idle_reclaimed_mb_total, idle_servers_parked_total, idle_servers_stopped_total,
+)
+
+IDLE_KERNEL_MINUTES = int(os.environ.get("JUPYTER_IDLE_KERNEL_MINUTES", "60"))
+IDLE_SERVER_MINUTES = int(os.environ.get("JUPYTER_IDLE_SERVER_MINUTES", "0"))
+IDLE_SERVER_ACTION = os.environ.get("JUPYTER_IDLE_SERVER_ACTION", "stop")   # stop | park
+SERVER_ACTIONS = ("stop", "park")
+CULL_INTERVAL_SECONDS = 60
+CULL_CONCURRENCY = 16
+REQUEST_TIMEOUT_SECONDS = 3
+
+_MB = 1024 * 1024
+
+
+def idle_policy(info):
+    policy = {
+        "kernel_minutes": IDLE_KERNEL_MINUTES,
+        "server_minutes": IDLE_SERVER_MINUTES,
+        "server_action": IDLE_SERVER_ACTION,
+    }
+    policy.update({k: v for k, v in (info.get("idle") or {}).items() if v is not None})
+    return policy
+
+
+def _timestamp(iso):
+    return datetime.fromisoformat(iso).timestamp() if iso else 0
+
+
+def _kernel_rss_mb(server_pid, kernel_id):
+    """RSS of the kernel process (and its children) started by server_pid."""
+    try:
+        for proc in psutil.Process(server_pid).children(recursive=True):
+            try:
+                if not any(kernel_id in part for part in proc.cmdline()):
+                    continue
+                rss = proc.memory_info().rss
+                rss += sum(child.memory_info().rss for child in proc.children(recursive=True))
+                return round(rss / _MB, 1)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+    except psutil.NoSuchProcess:
+        pass
+    return 0.0
+
+
+class IdleCuller:
+    def __init__(self, get_instances, on_idle_server, instance_rss_mb, interval=CULL_INTERVAL_SECONDS, on_pass=None,
+                 on_park_server=None):
+        """
+        get_instances(): port -> state info of the sessions eligible for culling
+        on_idle_server(port): coroutine that stops an idle server
+        instance_rss_mb(port): last measured RSS of the whole instance, or None
+        on_pass(state): after each pass, with export() (e.g. to share it with other workers)
+        on_park_server(port): coroutine that parks an idle server; without it they are stopped
+        """
+        self.get_instances = get_instances
+        self.on_idle_server = on_idle_server
+        self.instance_rss_mb = instance_rss_mb
+        self.interval = interval
+        self.on_pass = on_pass
+        self.on_park_server = on_park_server
+        self.activity = {}   # port -> last poll result
+        self.totals = {"kernels_culled": 0, "servers_stopped": 0, "servers_parked": 0, "reclaimed_mb": 0.0}
+        self.last_pass = None
+        self._task = None
+
+    def _request(self, host, port, token, path, method="GET"):
+        # no_track_activity keeps our own polling from counting as activity
+        sep = "&" if "?" in path else "?"
+        req = urllib.request.Request(
+            f"http://{host}:{port}{path}{sep}no_track_activity=1",
+            method=method,
+            headers={"Authorization": f"token {token}"},
+        )
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT_SECONDS) as resp:
+            body = resp.read()
+        return json.loads(body) if body else None
+
+    def check_instance(self, port, info, now):
+        """Poll one server and shut down its idle kernels (runs in a worker thread)."""
+        policy = idle_policy(info)
+        token = info["api_token"]
+        # Sessions placed on another node (api/nodes.py) are polled over the network
+        host = info.get("node_host") or "127.0.0.1"
+        status = self._request(host, port, token, "/api/status")
+        kernels = self._request(host, port, token, "/api/kernels")
+
+        culled = []
+        for kernel in kernels:
+            idle = now - _timestamp(kernel.get("last_activity"))
+            if (
+                policy["kernel_minutes"]
+                and kernel.get("execution_state") != "busy"
+                and idle > policy["kernel_minutes"] * 60
+            ):
+                # The kernel's process tree can only be measured on this host
+                rss_mb = 0.0 if info.get("node") else _kernel_rss_mb(info["pid"], kernel["id"])
+                self._request(host, port, token, f"/api/kernels/{kernel['id']}", method="DELETE")
+                culled.append({"id": kernel["id"], "idle_seconds": round(idle), "rss_mb": rss_mb})
+
+        last_activity = max(
+            [_timestamp(status.get("last_activity"))]
+            + [_timestamp(k.get("last_activity")) for k in kernels]
+        )
+        return {
+            "checked_at": now,
+            "last_activity": last_activity,
+            "idle_seconds": round(now - last_activity),
+            "kernels": len(kernels) - len(culled),
+            "busy": any(k.get("execution_state") == "busy" for k in kernels),
+            "culled_kernels": culled,
+            "policy": policy,
+        }
+
+    async def cull_once(self):
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        instances = {p: i for p, i in self.get_instances().items() if i.get("api_token") and i.get("pid")}
+        semaphore = asyncio.Semaphore(CULL_CONCURRENCY)
+
+        async def check(port, info):
+            async with semaphore:
+                try:
+                    return port, await loop.run_in_executor(None, self.check_instance, port, info, now)
+                except Exception as e:
+                    return port, {"checked_at": now, "error": str(e)}
+
+        results = dict(await asyncio.gather(*(check(p, i) for p, i in instances.items())))
+
+        for port, result in results.items():
+            for kernel in result.get("culled_kernels", ()):
+                print(f"Shut down kernel {kernel['id']} on port {port}, idle {kernel['idle_seconds']}s")
+                self._reclaimed(kernel["rss_mb"])
+                self.totals["kernels_culled"] += 1
+                idle_kernels_culled_total.inc()
+
+            policy = result.get("policy", {})
+            server_minutes = policy.get("server_minutes")
+            if server_minutes and not result["busy"] and result["idle_seconds"] > server_minutes * 60:
+                park = policy.get("server_action") == "park" and self.on_park_server is not None
+                print(f"Session on port {port} idle for {result['idle_seconds']}s, {'parking' if park else 'stopping'} it")
+                rss_mb = self.instance_rss_mb(port) or 0.0
+                if park:
+                    await self.on_park_server(port)
+                    self.totals["servers_parked"] += 1
+                    idle_servers_parked_total.inc()
+                    result["parked"] = True
+                else:
+                    await self.on_idle_server(port)
+                    self.totals["servers_stopped"] += 1
+                    idle_servers_stopped_total.inc()
+                    result["stopped"] = True
+                self._reclaimed(rss_mb)
+
+        self.activity = results
+        self.last_pass = now
+        if self.on_pass is not None:
+            self.on_pass(self.export())
+        return results
+
+    def export(self):
+        return {"activity": self.activity, "totals": self.totals, "last_pass": self.last_pass}
+
+    def load(self, state):
+        """Take over the results of a pass made elsewhere (see export())."""
+        self.activity = state["activity"]
+        self.totals = {**self.totals, **state["totals"]}
+        self.last_pass = state["last_pass"]
+
+    def _reclaimed(self, mb):
+        self.totals["reclaimed_mb"] = round(self.totals["reclaimed_mb"] + mb, 1)
+        idle_reclaimed_mb_total.inc(mb)
+
+    def idle_seconds(self, port):
+        result = self.activity.get(str(port))
+        if not result or "idle_seconds" not in result:
+            return None
+        return result["idle_seconds"] + round(time.time() - result["checked_at"])
+
+    def stats(self):
+        return {
+            "interval_seconds": self.interval,
+            "defaults": {
+                "kernel_minutes": IDLE_KERNEL_MINUTES,
+                "server_minutes": IDLE_SERVER_MINUTES,
+                "server_action": IDLE_SERVER_ACTION,
+            },
+            "last_pass": self.last_pass,
+            **self.totals,
+            "instances": self.activity,
+        }
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.cull_once()
+            except Exception as e:
+                print(f"Idle culler error: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
@@ -0,0 +1,203 @@
+"""
+In-process event bus behind GET /api/jupyter/events (server-sent events).
+
+Lifecycle changes (launching, ready, launch_failed, expiring_soon,
+expired, stopped, crashed) and one "sample" per sampling pass are
+published here by the code that causes them. Events get increasing ids
+and are kept in a ring buffer of EVENT_BUFFER_SIZE. Subscribers don't get
+queues of their own: each one tracks the last id it has sent and waits on
+a shared asyncio.Event. Fan-out is then one wake-up per publish, however
+many clients are connected, and resuming from Last-Event-ID is a buffer
+read.
+
+publish() is thread-safe; the sampler and sync endpoints call it from
+worker threads.
+
+With a db_path (the SQLite state database) events go through an events
+table instead: ids come from the table, so they are shared by every
+backend worker (api/workers.py), and each worker tails the table into its
+ring buffer every TAIL_SECONDS (at once for its own publishes). A client
+can then reconnect to any worker, or across a restart, and resume.
+"""
+import asyncio, json, os, sqlite3, threading, time
+from collections import deque
+
+from api.state import STATE_DB
+from api.workers import SHARED
+
+EVENT_BUFFER_SIZE = 1000
+HEARTBEAT_SECONDS = 15
+TAIL_SECONDS = 0.25
+TRIM_EVERY = 100   # publishes between trims of the events table
+
+
+class EventBus:
+    def __init__(self, buffer_size=EVENT_BUFFER_SIZE, db_path=None):
+        self._events = deque(maxlen=buffer_size)
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._loop = None
+        self._changed = None
+        self._nudge = None
+        self.subscribers = 0
+        self.db_path = db_path
+        self._local = threading.local()
+        self._published = 0
+        if db_path is not None:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._conn().executescript("""
+                CREATE TABLE IF NOT EXISTS events (
+                    id    INTEGER PRIMARY KEY AUTOINCREMENT,
+                    type  TEXT NOT NULL,
+                    time  REAL NOT NULL,
+                    data  TEXT NOT NULL
+                );
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        if self.db_path is not None:
+            # Pick up where the log is, so ids keep counting across restarts
+            rows = self._conn().execute(
+                "SELECT id, type, time, data FROM events ORDER BY id DESC LIMIT ?", (self._events.maxlen,)
+            ).fetchall()
+            self._append(reversed(rows))
+            self._nudge = asyncio.Event()
+            self._loop.create_task(self._tail())
+
+    def _append(self, rows):
+        """Add rows of the events table to the buffer; True if there were any."""
+        events = [{"id": id, "type": type, "time": t, "data": json.loads(data)} for id, type, t, data in rows]
+        with self._lock:
+            events = [e for e in events if e["id"] > self._last_id]
+            self._events.extend(events)
+            if events:
+                self._last_id = events[-1]["id"]
+        return bool(events)
+
+    def _catch_up(self):
+        rows = self._conn().execute(
+            "SELECT id, type, time, data FROM events WHERE id > ? ORDER BY id", (self.last_id,)
+        ).fetchall()
+        return self._append(rows)
+
+    async def _tail(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if await loop.run_in_executor(None, self._catch_up):
+                    self._wake()
+            except sqlite3.Error as e:
+                print(f"Event log tail error: {e}")
+            try:
+                await asyncio.wait_for(self._nudge.wait(), TAIL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._nudge.clear()
+
+    def _wake(self):
+        # Runs on the loop: wake everyone waiting, arm a fresh event for the next publish
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, type, **data):
+        if self.db_path is not None:
+            return self._publish_shared(type, data)
+        with self._lock:
+            self._last_id += 1
+            event = {"id": self._last_id, "type": type, "time": time.time(), "data": data}
+            self._events.append(event)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake)
+        return event
+
+    def _publish_shared(self, type, data):
+        now = time.time()
+        conn = self._conn()
+        cur = conn.execute(
+            "INSERT INTO events (type, time, data) VALUES (?, ?, ?)", (type, now, json.dumps(data)),
+        )
+        event = {"id": cur.lastrowid, "type": type, "time": now, "data": data}
+        self._published += 1
+        if self._published % TRIM_EVERY == 0:
+            conn.execute("DELETE FROM events WHERE id <= ?", (event["id"] - 2 * self._events.maxlen,))
+        # Our own subscribers get it on the next tail read, which this triggers
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._nudge.set)
+        return event
+
+    @property
+    def last_id(self):
+        with self._lock:
+            return self._last_id
+
+    def since(self, last_id):
+        """(events after last_id, whether some were already dropped from the buffer)"""
+        with self._lock:
+            oldest = self._events[0]["id"] if self._events else self._last_id + 1
+            # An id from before a restart (ahead of ours) can't be resumed either
+            gap = last_id < oldest - 1 or last_id > self._last_id
+            return [e for e in self._events if e["id"] > last_id], gap
+
+    async def subscribe(self, last_id=None, types=None, heartbeat=HEARTBEAT_SECONDS):
+        """
+        Yield events after last_id (only new ones if None), filtered by types.
+        Yields a "reset" event when the requested history is gone, and None
+        every `heartbeat` seconds without events.
+        """
+        if last_id is None:
+            last_id = self.last_id
+        elif self.db_path is not None and last_id > self.last_id:
+            # Seen on another worker, which may be a tail read ahead of us
+            self._catch_up()
+        self.subscribers += 1
+        try:
+            while True:
+                # Grab the event before reading, so a publish in between still wakes us
+                changed = self._changed
+                events, gap = self.since(last_id)
+                if gap:
+                    yield {"id": self.last_id if not events else events[0]["id"] - 1,
+                           "type": "reset", "time": time.time(),
+                           "data": {"reason": "history unavailable, refetch GET /api/jupyter"}}
+                    if not events:
+                        last_id = self.last_id
+                for event in events:
+                    last_id = event["id"]
+                    if types is None or event["type"] in types:
+                        yield event
+                if events or gap:
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            self.subscribers -= 1
+
+    def stats(self):
+        with self._lock:
+            buffered = len(self._events)
+            oldest = self._events[0]["id"] if self._events else None
+            last_id = self._last_id
+        return {"last_id": last_id, "oldest_id": oldest, "buffered": buffered, "subscribers": self.subscribers}
+
+
+def format_sse(event):
+    """One SSE frame; None is a heartbeat comment."""
+    if event is None:
+        return ": keep-alive\n\n"
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+event_bus = EventBus(db_path=STATE_DB if SHARED else None)
@@ -0,0 +1,180 @@
+"""
+Password hashing for Jupyter servers, in a pool of worker processes.
+
+Servers are given their password as a jupyter_server argon2 hash
+("argon2:$argon2id$..."). It is made here rather than with
+jupyter_server.auth.passwd() so the cost can be configured; a server checks
+a password with the parameters stored in its hash, so a new cost only
+applies to hashes made after it.
+
+Argon2 is CPU- and memory-hard on purpose. Hashes are made in HASH_WORKERS
+processes (spawned, not forked from the backend), so no more than that many
+run at once however many launches are in flight, and none of them competes
+with request handling in the backend process. Launches, warm pool claims and
+wakes of parked sessions all hash through PasswordHasherPool.hash().
+
+Cost levels (JUPYTER_ARGON2_COST), each parameter overridable with
+JUPYTER_ARGON2_TIME_COST / JUPYTER_ARGON2_MEMORY_KIB / JUPYTER_ARGON2_PARALLELISM:
+
+  low      t=3, 12 MiB, 1 lane
+  default  t=10, 10 MiB, 8 lanes: what jupyter_server's passwd() uses
+  high     t=3, 64 MiB, 4 lanes
+
+Hashes per second at each level, on this host:
+
+    python3 -m api.hashing bench [--seconds N] [--workers N] [--json]
+"""
+import argparse, asyncio, json, multiprocessing, os, sys, time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from argon2 import PasswordHasher
+
+COST_LEVELS = {
+    "low": {"time_cost": 3, "memory_kib": 12 * 1024, "parallelism": 1},
+    "default": {"time_cost": 10, "memory_kib": 10 * 1024, "parallelism": 8},
+    "high": {"time_cost": 3, "memory_kib": 64 * 1024, "parallelism": 4},
+}
+HASH_COST = os.environ.get("JUPYTER_ARGON2_COST", "default")
+HASH_WORKERS = int(os.environ.get("JUPYTER_HASH_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) // 2)))))
+
+
+def cost_params(level=HASH_COST):
+    """Argon2 parameters of a cost level, with the JUPYTER_ARGON2_* overrides."""
+    if level not in COST_LEVELS:
+        raise ValueError(f"Unknown argon2 cost level {level!r} (one of {', '.join(COST_LEVELS)})")
+    params = dict(COST_LEVELS[level])
+    for key in params:
+        value = os.environ.get(f"JUPYTER_ARGON2_{key.upper()}")
+        if value:
+            params[key] = int(value)
+    return params
+
+
+def hash_password_sync(password, params):
+    """password hashed in jupyter_server's format (blocking)."""
+    hasher = PasswordHasher(
+        time_cost=params["time_cost"], memory_cost=params["memory_kib"], parallelism=params["parallelism"],
+    )
+    return "argon2:" + hasher.hash(password)
+
+
+def _ready():
+    return os.getpid()
+
+
+def _process_pool(workers):
+    # Forking the backend would copy its threads' locks into the children
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+class PasswordHasherPool:
+    def __init__(self, workers=HASH_WORKERS, params=None):
+        """params: argon2 parameters (cost_params()); the configured level by default"""
+        self.workers = workers
+        self.params = params or cost_params()
+        self.pending = 0
+        self.hashed = 0
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = _process_pool(self.workers)
+        return self._pool
+
+    def start(self):
+        """Spawn the workers now instead of on the first launch."""
+        pool = self._executor()
+        for _ in range(self.workers):
+            pool.submit(_ready)
+
+    async def hash(self, password):
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            try:
+                result = await loop.run_in_executor(self._executor(), hash_password_sync, password, self.params)
+            except BrokenProcessPool:
+                # A worker died (OOM killer...); the pool is unusable from then on
+                print("Password hashing pool broke, starting a new one")
+                self._pool = None
+                result = await loop.run_in_executor(self._executor(), hash_password_sync, password, self.params)
+        finally:
+            self.pending -= 1
+        self.hashed += 1
+        return result
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self):
+        return {"workers": self.workers, "params": self.params, "pending": self.pending, "hashed": self.hashed}
+
+
+# ------------------------
+# BENCHMARK
+# ------------------------
+def _serial_rate(params, seconds):
+    count, started = 0, time.perf_counter()
+    while count == 0 or time.perf_counter() - started < seconds:
+        hash_password_sync("benchmark", params)
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def _pool_rate(pool, workers, params, seconds):
+    """Hashes per second with workers hashes kept in flight on pool."""
+    in_flight = {pool.submit(hash_password_sync, "benchmark", params) for _ in range(workers)}
+    count, started = 0, time.perf_counter()
+    while in_flight:
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        count += len(done)
+        if time.perf_counter() - started < seconds:
+            in_flight |= {pool.submit(hash_password_sync, "benchmark", params) for _ in done}
+    return count / (time.perf_counter() - started)
+
+
+def bench(levels, workers, seconds):
+    rows = []
+    with _process_pool(workers) as pool:
+        wait([pool.submit(_ready) for _ in range(workers)])
+        for level in levels:
+            params = COST_LEVELS[level]
+            serial = _serial_rate(params, seconds)
+            rows.append({
+                "level": level,
+                **params,
+                "ms_per_hash": round(1000 / serial, 1),
+                "hashes_per_second": round(serial, 2),
+                "workers": workers,
+                "pool_hashes_per_second": round(_pool_rate(pool, workers, params, seconds), 2),
+            })
+    return rows
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python3 -m api.hashing", description="Argon2 hashes per second at each cost level")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--seconds", type=float, default=3, help="per level and mode")
+    parser.add_argument("--workers", type=int, default=HASH_WORKERS)
+    parser.add_argument("--level", action="append", choices=list(COST_LEVELS), help="repeatable; all levels by default")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+    rows = bench(args.level or list(COST_LEVELS), args.workers, args.seconds)
+    if args.json:
+        print(json.dumps({"configured": HASH_COST, "cpus": os.cpu_count(), "results": rows}, indent=2))
+        return 0
+    print(f"{'level':8} {'t':>3} {'mem KiB':>8} {'lanes':>5} {'ms/hash':>8} {'hash/s':>8} {'hash/s x' + str(args.workers):>12}")
+    for row in rows:
+        mark = " *" if row["level"] == HASH_COST else ""
+        print(
+            f"{row['level']:8} {row['time_cost']:>3} {row['memory_kib']:>8} {row['parallelism']:>5} "
+            f"{row['ms_per_hash']:>8} {row['hashes_per_second']:>8} {row['pool_hashes_per_second']:>12}{mark}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
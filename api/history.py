@@ -0,0 +1,176 @@
+"""
+Port history: which ports were used, under which tag, when and how often.
+
+Kept by the backend in the state database (table port_history, indexed by
+tag, last_used and times_used) instead of a JSON file on the frontend's
+disk, so every UI replica sees the same history and concurrent launches
+can't lose each other's writes: record_use() is a single atomic
+INSERT ... ON CONFLICT DO UPDATE that bumps the counter in place.
+
+The frontend's old streamlit_frontend/port_history.json is imported once.
+"""
+import json, os, sqlite3, threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from api.state import STATE_DB
+
+LEGACY_HISTORY_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "streamlit_frontend", "port_history.json"
+)
+UNTAGGED = "Untagged"
+SORT_FIELDS = ("port", "tag", "last_used", "times_used")
+
+
+class PortHistory:
+    def __init__(self, db_path=STATE_DB, legacy_json=LEGACY_HISTORY_FILE):
+        self.db_path = db_path
+        self.legacy_json = legacy_json
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS port_history (
+                port        INTEGER PRIMARY KEY,
+                tag         TEXT NOT NULL DEFAULT 'Untagged',
+                last_used   TEXT,
+                times_used  INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_port_history_tag ON port_history(tag);
+            CREATE INDEX IF NOT EXISTS idx_port_history_last_used ON port_history(last_used);
+            CREATE INDEX IF NOT EXISTS idx_port_history_times_used ON port_history(times_used);
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self._migrate_json()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def _migrate_json(self):
+        if not self.legacy_json or not os.path.exists(self.legacy_json):
+            return
+        with self.transaction() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'port_history_migrated'").fetchone():
+                return
+            try:
+                with open(self.legacy_json) as f:
+                    legacy = json.load(f)
+            except (OSError, ValueError):
+                legacy = {}
+            for port, entry in legacy.items():
+                db.execute(
+                    "INSERT OR IGNORE INTO port_history (port, tag, last_used, times_used) VALUES (?, ?, ?, ?)",
+                    (int(port), entry.get("tag") or UNTAGGED, entry.get("last_used"), int(entry.get("times_used", 0))),
+                )
+            db.execute("INSERT INTO meta (key, value) VALUES ('port_history_migrated', ?)", (self.legacy_json,))
+        print(f"Migrated history of {len(legacy)} port(s) from {self.legacy_json}")
+
+    @staticmethod
+    def _row(row):
+        return {"port": row["port"], "tag": row["tag"], "last_used": row["last_used"], "times_used": row["times_used"]}
+
+    def record_use(self, port, tag=None):
+        """One more use of port, now. tag=None keeps the current tag."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self.transaction() as db:
+            db.execute(
+                """
+                INSERT INTO port_history (port, tag, last_used, times_used) VALUES (?, ?, ?, 1)
+                ON CONFLICT(port) DO UPDATE SET
+                    tag = COALESCE(?, tag),
+                    last_used = excluded.last_used,
+                    times_used = times_used + 1
+                """,
+                (int(port), tag or UNTAGGED, now, tag or None),
+            )
+
+    def set_tag(self, port, tag):
+        with self.transaction() as db:
+            db.execute(
+                """
+                INSERT INTO port_history (port, tag) VALUES (?, ?)
+                ON CONFLICT(port) DO UPDATE SET tag = excluded.tag
+                """,
+                (int(port), tag or UNTAGGED),
+            )
+            return self._row(db.execute("SELECT * FROM port_history WHERE port = ?", (int(port),)).fetchone())
+
+    def get(self, port):
+        row = self._conn().execute("SELECT * FROM port_history WHERE port = ?", (int(port),)).fetchone()
+        return self._row(row) if row else None
+
+    def delete(self, port):
+        with self.transaction() as db:
+            return db.execute("DELETE FROM port_history WHERE port = ?", (int(port),)).rowcount > 0
+
+    def query(self, tag=None, active_ports=None, active=None, last_used_after=None, last_used_before=None,
+              min_times_used=None, sort="last_used", order="desc", limit=50, offset=0):
+        """
+        (total matching, one page of entries). active filters on membership in
+        active_ports (the ports with a running session).
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}")
+        where, args = [], []
+        if tag is not None:
+            where.append("tag = ?")
+            args.append(tag)
+        if last_used_after is not None:
+            where.append("last_used >= ?")
+            args.append(last_used_after)
+        if last_used_before is not None:
+            where.append("last_used < ?")
+            args.append(last_used_before)
+        if min_times_used is not None:
+            where.append("times_used >= ?")
+            args.append(int(min_times_used))
+        if active is not None:
+            ports = sorted(int(p) for p in active_ports or ())
+            if ports:
+                where.append(f"port {'IN' if active else 'NOT IN'} ({','.join('?' * len(ports))})")
+                args.extend(ports)
+            elif active:
+                where.append("0")
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        direction = "ASC" if order == "asc" else "DESC"
+
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM port_history {clause}", args).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT * FROM port_history {clause} ORDER BY {sort} {direction}, port LIMIT ? OFFSET ?",
+            [*args, int(limit), int(offset)],
+        ).fetchall()
+        return total, [self._row(row) for row in rows]
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history():
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = PortHistory()
+        return _history
@@ -0,0 +1,62 @@
+"""
+In-memory index of the state store for the read endpoints.
+
+Listing used to reload every row and re-parse every expires_at per
+request. The index keeps the parsed entries (port order, deadline
+precomputed) and only rebuilds when the store version has moved, which
+costs one indexed read per request otherwise. Pagination walks the sorted
+port list from a cursor (the last port of the previous page) with bisect.
+"""
+import bisect, threading
+
+from api.scheduler import parse_expires_at
+
+
+class InstanceIndex:
+    def __init__(self, get_store):
+        self.get_store = get_store
+        self.version = None
+        self.entries = {}   # port (int) -> {"port", "info", "deadline"}
+        self.ports = []     # sorted
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Rebuild if the store changed; returns the version the index reflects."""
+        store = self.get_store()
+        version = store.version()
+        with self._lock:
+            if version != self.version:
+                entries = {}
+                for port, info in store.all().items():
+                    entries[int(port)] = {
+                        "port": int(port),
+                        "info": info,
+                        "deadline": parse_expires_at(info.get("expires_at")),
+                    }
+                self.entries = entries
+                self.ports = sorted(entries)
+                self.version = version
+            return self.version
+
+    def get(self, port):
+        self.refresh()
+        return self.entries.get(int(port))
+
+    def page(self, predicate=None, cursor=None, limit=None):
+        """
+        Entries after port `cursor` matching predicate(entry), at most limit.
+        Returns (entries, next_cursor); next_cursor is None on the last page.
+        """
+        self.refresh()
+        with self._lock:
+            ports, entries = self.ports, self.entries
+        start = 0 if cursor is None else bisect.bisect_right(ports, int(cursor))
+        out = []
+        for i in range(start, len(ports)):
+            entry = entries[ports[i]]
+            if predicate is not None and not predicate(entry):
+                continue
+            if limit is not None and len(out) == limit:
+                return out, out[-1]["port"]
+            out.append(entry)
+        return out, None
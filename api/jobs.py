@@ -0,0 +1,431 @@
+"""
+Background launch jobs.
+
+POST /api/jupyter hands the actual launch to a LaunchJob and returns
+immediately. Jobs run on the event loop with asyncio subprocesses, at most
+LAUNCH_CONCURRENCY at a time, and move through these phases:
+
+    queued -> provisioning -> spawning -> ready
+                                      \\-> failed (from any phase)
+
+start_jupyter.sh reports its progress with "PHASE <name>" lines and step
+durations with "TIMING <step> <ms>" lines on stdout, and finishes with
+"<port> <pid>".
+
+A LaunchBatch groups the jobs of one POST /api/jupyter/batch; its jobs run
+under their own semaphore (the batch's parallelism) instead of the global
+one.
+
+With a db_path (several backend workers, see api/workers.py) every phase
+change is also written to the launch_jobs table, so a job can be polled
+through any worker: one the worker doesn't run itself is a SharedJob read
+back from the table. The global limit then holds across workers too
+(slots: a FileSemaphore of LAUNCH_CONCURRENCY).
+"""
+import asyncio, json, os, secrets, sqlite3, threading, time
+from collections import deque
+from contextlib import nullcontext
+
+from api.procs import is_running
+
+LAUNCH_CONCURRENCY = int(os.environ.get("JUPYTER_LAUNCH_CONCURRENCY", "4"))
+BATCH_MAX_PARALLELISM = int(os.environ.get("JUPYTER_BATCH_PARALLELISM", "16"))
+JOB_RETENTION_SECONDS = 15 * 60
+SHARED_JOB_POLL_SECONDS = 0.25
+STDERR_TAIL_LINES = 20   # of the launcher's stderr, kept for the error message
+
+PHASES = ("queued", "provisioning", "spawning", "ready", "failed")
+TERMINAL_PHASES = ("ready", "failed")
+
+
+class LaunchError(Exception):
+    pass
+
+
+class LaunchJob:
+    def __init__(self, params=None, on_change=None):
+        """on_change(job): called after every phase change"""
+        self.id = secrets.token_urlsafe(8)
+        self.params = params or {}
+        self.phase = "queued"
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.phase_times = {"queued": self.created_at}
+        self.timings = {}
+        self.result = None
+        self.error = None
+        self.on_change = on_change
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.phase in TERMINAL_PHASES
+
+    def set_phase(self, phase):
+        if phase == self.phase or self.done:
+            return
+        self.phase = phase
+        self.updated_at = time.time()
+        self.phase_times[phase] = self.updated_at
+        # Wake long-pollers and arm a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def finish(self, result):
+        self.result = result
+        self.set_phase("ready")
+
+    def fail(self, error):
+        self.error = error
+        self.set_phase("failed")
+
+    async def wait_done(self):
+        while not self.done:
+            await self.wait_for_change(60)
+
+    async def wait_for_change(self, timeout):
+        """Block until the phase changes or timeout expires (returns immediately if done)."""
+        if self.done or timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "phase": self.phase,
+            "params": self.params,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "phase_times": self.phase_times,
+            "timings": self.timings,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class SharedJob:
+    """A job another worker runs, as last written to the launch_jobs table."""
+
+    def __init__(self, manager, job_id, owner, data):
+        self.manager = manager
+        self.id = job_id
+        self._load(owner, data)
+
+    def _load(self, owner, data):
+        if data["phase"] not in TERMINAL_PHASES and not is_running(owner):
+            data = {**data, "phase": "failed", "error": f"Worker {owner} exited before the launch finished"}
+        self.data = data
+
+    @property
+    def phase(self):
+        return self.data["phase"]
+
+    @property
+    def done(self):
+        return self.phase in TERMINAL_PHASES
+
+    @property
+    def updated_at(self):
+        return self.data["updated_at"]
+
+    def refresh(self):
+        row = self.manager._load_job(self.id)
+        if row is not None:
+            self._load(*row)
+
+    async def wait_done(self):
+        while not self.done:
+            await self.wait_for_change(60)
+
+    async def wait_for_change(self, timeout):
+        """Poll the table until the phase changes or timeout expires."""
+        deadline = time.time() + timeout
+        phase = self.phase
+        while not self.done and self.phase == phase and time.time() < deadline:
+            await asyncio.sleep(min(SHARED_JOB_POLL_SECONDS, max(deadline - time.time(), 0)))
+            self.refresh()
+
+    def to_dict(self):
+        return self.data
+
+
+class LaunchBatch:
+    def __init__(self, jobs, params=None, id=None, created_at=None):
+        self.id = id or secrets.token_urlsafe(8)
+        self.jobs = jobs
+        self.params = params or {}
+        self.created_at = created_at or time.time()
+
+    @property
+    def done(self):
+        return all(job.done for job in self.jobs)
+
+    async def as_completed(self):
+        """Yield (index, job) as each job reaches a terminal phase."""
+        async def finished(i, job):
+            await job.wait_done()
+            return i, job
+        for next_done in asyncio.as_completed([finished(i, job) for i, job in enumerate(self.jobs)]):
+            yield await next_done
+
+    async def wait_for_change(self, timeout):
+        """Block until any unfinished job changes phase or timeout expires."""
+        pending = [job for job in self.jobs if not job.done]
+        if not pending or timeout <= 0:
+            return
+        waiters = [asyncio.ensure_future(job.wait_for_change(timeout)) for job in pending]
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
+
+    def to_dict(self):
+        phases = {}
+        for job in self.jobs:
+            phases[job.phase] = phases.get(job.phase, 0) + 1
+        return {
+            "batch_id": self.id,
+            "params": self.params,
+            "created_at": self.created_at,
+            "done": self.done,
+            "phases": phases,
+            "items": [job.to_dict() for job in self.jobs],
+        }
+
+
+class JobManager:
+    def __init__(self, concurrency=LAUNCH_CONCURRENCY, db_path=None, slots=None):
+        """
+        db_path: SQLite database to share jobs through, or None (this process only)
+        slots: FileSemaphore holding the global limit across workers, or None
+        """
+        self.concurrency = concurrency
+        self.jobs = {}
+        self.batches = {}
+        self.db_path = db_path
+        self.slots = slots
+        self._semaphore = None
+        self._tasks = set()
+        self._local = threading.local()
+        if db_path is not None:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._conn().executescript("""
+                CREATE TABLE IF NOT EXISTS launch_jobs (
+                    id          TEXT PRIMARY KEY,
+                    owner       INTEGER NOT NULL,   -- pid of the worker running it
+                    updated_at  REAL NOT NULL,
+                    data        TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS launch_batches (
+                    id          TEXT PRIMARY KEY,
+                    created_at  REAL NOT NULL,
+                    data        TEXT NOT NULL
+                );
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _save(self, job):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO launch_jobs (id, owner, updated_at, data) VALUES (?, ?, ?, ?)",
+            (job.id, os.getpid(), job.updated_at, json.dumps(job.to_dict())),
+        )
+
+    def _load_job(self, job_id):
+        row = self._conn().execute("SELECT owner, data FROM launch_jobs WHERE id = ?", (job_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def _new_job(self, params):
+        job = LaunchJob(params, on_change=self._save if self.db_path is not None else None)
+        self.jobs[job.id] = job
+        return job
+
+    def _sem(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def submit(self, launch, params=None, semaphore=None):
+        """
+        Schedule `launch(job)` (a coroutine function returning the result dict),
+        bounded by semaphore (default: the global LAUNCH_CONCURRENCY one).
+        """
+        self.prune()
+        job = self._new_job(params)
+        if self.db_path is not None:
+            self._save(job)
+        slot = self.slots.slot() if semaphore is None and self.slots is not None else nullcontext()
+        task = asyncio.get_running_loop().create_task(self._run(job, launch, semaphore or self._sem(), slot))
+        # Keep a reference so the task is not garbage-collected mid-flight
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def completed(self, result, params=None):
+        """Register a launch that finished inline (e.g. a warm pool claim)."""
+        self.prune()
+        job = self._new_job(params)
+        job.finish(result)
+        return job
+
+    def add_batch(self, jobs, params=None):
+        batch = LaunchBatch(jobs, params)
+        self.batches[batch.id] = batch
+        if self.db_path is not None:
+            self._conn().execute(
+                "INSERT INTO launch_batches (id, created_at, data) VALUES (?, ?, ?)",
+                (batch.id, batch.created_at, json.dumps({"params": batch.params, "job_ids": [job.id for job in jobs]})),
+            )
+        return batch
+
+    async def _run(self, job, launch, semaphore, slot):
+        async with semaphore, slot:
+            try:
+                job.finish(await launch(job))
+            except LaunchError as e:
+                job.fail(str(e))
+            except Exception as e:
+                print(f"Launch job {job.id} crashed: {e!r}")
+                job.fail(f"Unexpected error: {e}")
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None and self.db_path is not None:
+            row = self._load_job(job_id)
+            if row is not None:
+                job = SharedJob(self, job_id, *row)
+        return job
+
+    def get_batch(self, batch_id):
+        batch = self.batches.get(batch_id)
+        if batch is None and self.db_path is not None:
+            row = self._conn().execute(
+                "SELECT created_at, data FROM launch_batches WHERE id = ?", (batch_id,)
+            ).fetchone()
+            if row is not None:
+                data = json.loads(row[1])
+                jobs = [self.get(job_id) for job_id in data["job_ids"]]
+                batch = LaunchBatch([job for job in jobs if job is not None], data["params"], batch_id, row[0])
+        return batch
+
+    def all(self):
+        """Every job still retained, of this worker and the others."""
+        if self.db_path is None:
+            return list(self.jobs.values())
+        rows = self._conn().execute("SELECT id, owner, data FROM launch_jobs ORDER BY updated_at").fetchall()
+        return [self.jobs.get(job_id) or SharedJob(self, job_id, owner, json.loads(data)) for job_id, owner, data in rows]
+
+    def active(self):
+        return [job for job in self.all() if not job.done]
+
+    def prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id, job in list(self.jobs.items()):
+            if job.done and job.updated_at < cutoff:
+                del self.jobs[job_id]
+        for batch_id, batch in list(self.batches.items()):
+            if batch.done and max((job.updated_at for job in batch.jobs), default=batch.created_at) < cutoff:
+                del self.batches[batch_id]
+        if self.db_path is not None:
+            # Unfinished jobs of a dead worker show up as failed (SharedJob) until they age out too
+            self._conn().execute("DELETE FROM launch_jobs WHERE updated_at < ?", (cutoff,))
+            self._conn().execute("DELETE FROM launch_batches WHERE created_at < ?", (cutoff - JOB_RETENTION_SECONDS,))
+
+
+# ------------------------
+# start_jupyter.sh driver
+# ------------------------
+def start_script_argv(script, password, password_hash, expires_at, port, limits, api_token, template=None):
+    """The launcher's positional arguments (see the top of start_jupyter.sh)."""
+    return [
+        script,
+        password,
+        password_hash,
+        expires_at,
+        str(port),
+        str(limits["memory_mb"]),
+        str(limits["cpu_weight"]),
+        str(limits["pids_max"]),
+        api_token,
+        template or "",
+    ]
+
+
+async def run_start_script(job, argv, timeout=60):
+    """
+    Run the launcher script, mirroring its PHASE markers onto the job.
+    Returns (port, pid) parsed from the last stdout line.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    lines = []
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+
+    async def read_stderr():
+        # Drained while the script runs: a full pipe would block it until the
+        # timeout. Read in chunks, since a line may be longer than readline() allows.
+        partial = b""
+        while True:
+            chunk = await proc.stderr.read(65536)
+            *complete, partial = (partial + chunk).split(b"\n")
+            partial = partial[-4096:]
+            if not chunk:
+                complete.append(partial)
+            for raw in complete:
+                line = raw.decode(errors="replace").rstrip()
+                if line:
+                    stderr_tail.append(line[-1000:])
+            if not chunk:
+                return
+
+    async def read_stdout():
+        while True:
+            raw = await proc.stdout.readline()
+            if not raw:
+                return
+            line = raw.decode(errors="replace").strip()
+            if line.startswith("PHASE "):
+                job.set_phase(line.split()[1])
+            elif line.startswith("TIMING "):
+                _, step, ms = line.split()
+                job.timings[step] = int(ms)
+            elif line:
+                lines.append(line)
+
+    readers = [asyncio.create_task(read_stdout()), asyncio.create_task(read_stderr())]
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        for reader in readers:
+            reader.cancel()
+        raise LaunchError(f"Launcher timed out after {timeout}s")
+
+    # Background children may keep the pipes open; don't wait on them for EOF
+    done, pending = await asyncio.wait(readers, timeout=1)
+    for reader in pending:
+        reader.cancel()
+    stderr = "\n".join(stderr_tail)
+
+    if proc.returncode != 0:
+        raise LaunchError(f"Failed to start Jupyter: {stderr or (lines[-1] if lines else 'Unknown error')}")
+
+    parts = lines[-1].split() if lines else []
+    if len(parts) != 2 or not all(p.isdigit() for p in parts):
+        raise LaunchError(f"Unexpected script output format: {lines[-1] if lines else ''}")
+    return int(parts[0]), int(parts[1])
@@ -0,0 +1,38 @@
+"""
+Identity provider loaded *inside* each Jupyter server (not by the API).
+
+start_jupyter.sh runs every server with
+
+    --ServerApp.identity_provider_class=api.jupyter_auth.RekeyablePasswordIdentityProvider
+
+and JUPYTER_PASSWORD_FILE pointing at <instance>/.jupyter_password_hash.
+When that file exists its hash takes precedence over the one given on the
+command line, so the API can re-key a running server (warm pool claims)
+by rewriting one file instead of restarting it.
+"""
+import os
+
+from jupyter_server.auth.identity import PasswordIdentityProvider
+from jupyter_server.auth.security import passwd_check
+
+
+class RekeyablePasswordIdentityProvider(PasswordIdentityProvider):
+    _file_mtime = None
+    _file_hash = None
+
+    def _current_hash(self):
+        path = os.environ.get("JUPYTER_PASSWORD_FILE")
+        if not path:
+            return self.hashed_password
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return self.hashed_password
+        if mtime != self._file_mtime:
+            with open(path) as f:
+                self._file_hash = f.read().strip()
+            self._file_mtime = mtime
+        return self._file_hash or self.hashed_password
+
+    def passwd_check(self, password):
+        return passwd_check(self._current_hash(), password)
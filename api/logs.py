@@ -0,0 +1,113 @@
+"""
+Instance logs: size-bounded rotation and offset-based reads.
+
+start_jupyter.sh appends each server's output to <instance>/jupyter.log
+(O_APPEND, so the file can be truncated under a running server). Every
+LOG_ROTATE_SECONDS the LogRotator checks the logs of the sessions on this
+host, and one over LOG_MAX_BYTES is copied to jupyter.log.1 (older copies
+shift up to jupyter.log.LOG_BACKUPS, the oldest is dropped) and truncated,
+like logrotate's copytruncate. A log is at most LOG_MAX_BYTES plus what the
+server writes within one interval; lines written between the copy and the
+truncate are lost.
+
+read_log() serves a byte range with pread, so tailing a large log never
+reads more than the range asked for. Offsets are byte offsets into the
+current file; when a read's offset is beyond the end the log was rotated
+since, and the read starts over at 0 with "rotated": true.
+"""
+import asyncio, os, shutil
+
+LOG_NAME = "jupyter.log"
+LOG_MAX_BYTES = int(os.environ.get("JUPYTER_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("JUPYTER_LOG_BACKUPS", "3"))
+LOG_ROTATE_SECONDS = 30
+LOG_READ_BYTES = 64 * 1024      # default range: the last 64 KiB
+LOG_MAX_READ_BYTES = 1024 * 1024
+
+
+def log_path(instance_dir, backup=0):
+    """jupyter.log, or its backup-th rotated copy."""
+    path = os.path.join(instance_dir, LOG_NAME)
+    return f"{path}.{backup}" if backup else path
+
+
+def rotate(path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """Rotate path if it is over max_bytes; returns whether it was."""
+    try:
+        if os.path.getsize(path) <= max_bytes:
+            return False
+    except FileNotFoundError:
+        return False
+    for n in range(backups - 1, 0, -1):
+        if os.path.exists(f"{path}.{n}"):
+            os.replace(f"{path}.{n}", f"{path}.{n + 1}")
+    if backups > 0:
+        shutil.copyfile(path, f"{path}.1")
+    # The server keeps its fd; with O_APPEND its next write lands at the new end
+    os.truncate(path, 0)
+    return True
+
+
+def read_log(path, offset=None, length=LOG_READ_BYTES, whole_lines=False):
+    """
+    Up to length bytes of path from offset (None or negative: that far from
+    the end, starting at the next full line). whole_lines leaves a trailing
+    partial line for the next read. Returns {"offset", "next_offset", "size",
+    "rotated", "data"}; FileNotFoundError if there is no log.
+    """
+    length = max(0, min(length, LOG_MAX_READ_BYTES))
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        rotated = False
+        tail = offset is None or offset < 0
+        if tail:
+            offset = max(0, size - (length if offset is None else -offset))
+        elif offset > size:
+            offset, rotated = 0, True
+        data = os.pread(f.fileno(), min(length, size - offset), offset)
+    if tail and offset > 0:
+        # Drop the partial line in front
+        cut = data.find(b"\n") + 1
+        offset, data = offset + cut, data[cut:]
+    if whole_lines and len(data) < length:
+        data = data[:data.rfind(b"\n") + 1]
+    return {
+        "offset": offset,
+        "next_offset": offset + len(data),
+        "size": size,
+        "rotated": rotated,
+        "data": data.decode(errors="replace"),
+    }
+
+
+class LogRotator:
+    def __init__(self, get_instance_dirs, on_rotate=None, interval=LOG_ROTATE_SECONDS):
+        """
+        get_instance_dirs(): instance dirs (state "path") of the sessions on this host
+        on_rotate(): called after each log rotated (e.g. to count them)
+        """
+        self.get_instance_dirs = get_instance_dirs
+        self.on_rotate = on_rotate
+        self.interval = interval
+        self._task = None
+
+    def rotate_once(self):
+        for instance_dir in self.get_instance_dirs():
+            try:
+                if rotate(log_path(instance_dir)) and self.on_rotate is not None:
+                    self.on_rotate()
+            except OSError as e:
+                print(f"Rotating the log in {instance_dir} failed: {e}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.rotate_once)
+            except Exception as e:
+                print(f"Log rotator error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
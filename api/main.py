@@ -1,287 +1,1723 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-from typing import Optional
-import subprocess, json, os, signal, psutil, secrets
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from typing import List, Optional
+import asyncio, json, os, psutil, secrets, time, zlib
 from datetime import datetime, timedelta, timezone 
 
-STATE_FILE = "/home/ubuntu/jupyter_service/instances/jupyter_instances.json"
+from api.admission import AdmissionController, AdmissionDenied
+from api.cgroups import cgroup_path, cgroup_v2_available, default_limits
+from api.culler import SERVER_ACTIONS, IdleCuller, idle_policy
+from api.events import event_bus, format_sse
+from api.hashing import PasswordHasherPool
+from api.history import SORT_FIELDS, get_history
+from api.index import InstanceIndex
+from api.logs import LOG_BACKUPS, LOG_READ_BYTES, LogRotator, log_path, read_log
+from api.jobs import (
+    BATCH_MAX_PARALLELISM, LAUNCH_CONCURRENCY, JobManager, LaunchError, run_start_script, start_script_argv,
+)
+from api.nodes import (
+    DRAIN_LOCAL, LOCAL_NODE, NODES, AgentError, LocalNode, NodeRegistry, NodeUnavailable, RemoteNode, parse_nodes,
+)
+from api.metrics import (
+    Gauge, registry, launch_phase_seconds, launches_total, expiries_total, stops_total, state_lock_wait_seconds,
+    log_rotations_total, orphans_stopped_total, stop_escalations_total, stop_freed_mb_total, wakes_total,
+)
+from api.pool import WarmPool, is_warm, write_password_hash
+from api.ports import PortAllocator, PortUnavailable
+from api.procs import OrphanSweeper, is_running, stop_process_tree
+from api.sampler import ResourceSampler
+from api.scheduler import ExpiryScheduler, parse_expires_at
+from api.seeding import DEFAULT_TEMPLATE, UnknownTemplate, list_templates, manifest, template_dir
+from api.state import STATE_DB, get_store
+from api.workers import (
+    LAUNCH_LOCK, LAUNCH_SLOTS, SHARED, FileLock, FileSemaphore, LeaderElection, SharedReservations,
+)
+
 MAX_RAM_USAGE_PER_INSTANCE_MB = 1024
 MIN_RAM_FREE_MB = 1024
+EXPIRY_WARNING_SECONDS = 5 * 60   # "expiring_soon" event this long before a deadline
+STOP_RETRY_SECONDS = 30   # an expired session whose node didn't answer is retried after this
+FOLLOW_SECONDS = 1   # how often a worker picks up what the other workers changed
+METRICS_FLUSH_SECONDS = 10
 
 JUPYTER_BIN = "/home/ubuntu/.venv/bin/jupyter"
-START_SCRIPT = "/home/ubuntu/jupyter_service/scripts/start_jupyter.sh"
+START_SCRIPT = os.environ.get("JUPYTER_START_SCRIPT", "/home/ubuntu/jupyter_service/scripts/start_jupyter.sh")
+PUBLIC_HOST = os.environ.get("JUPYTER_PUBLIC_HOST", "13.232.82.145")   # host in the URLs of local sessions
 
 app = FastAPI(title="Jupyter Manager")
+# Launches in flight of all workers when running several (api/workers.py)
+shared_reservations = SharedReservations(get_store, FileLock(LAUNCH_LOCK)) if SHARED else None
+launch_jobs = JobManager(
+    db_path=STATE_DB if SHARED else None,
+    slots=FileSemaphore(LAUNCH_SLOTS, LAUNCH_CONCURRENCY) if SHARED else None,
+)
+port_allocator = PortAllocator(shared=shared_reservations)
+get_store().on_lock_wait = state_lock_wait_seconds.observe
 
 
 # ------------------------
 # Utilities
 # ------------------------
-def load_state():
-    if not os.path.exists(STATE_FILE):
-        return {}
-    with open(STATE_FILE) as f:
-        return json.load(f)
+def forget_instance(port):
+    """Drop the state entry, its deadline and give the port back to the allocator."""
+    get_store().delete(port)
+    expiry_scheduler.unschedule(port)
+    port_allocator.release(port)
 
 
-def save_state(data):
-    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-    with open(STATE_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+def is_local(info):
+    """Runs on this host, as opposed to a node agent's (api/nodes.py)."""
+    return not info.get("node")
 
 
-def is_running(pid: int) -> bool:
-    """Check if process is running, works across users"""
-    try:
-        # Try using psutil first (works across users)
-        psutil.Process(pid)
-        return True
-    except (psutil.NoSuchProcess, psutil.AccessDenied):
-        # Fallback to os.kill (may fail for different users)
-        try:
-            os.kill(pid, 0)
-            return True
-        except (OSError, ProcessLookupError):
-            return False
+def is_parked(info):
+    """Server stopped until the session is next used (see PARKING)."""
+    return bool(info.get("parked"))
 
 
-def cleanup_dead_and_expired():
-    data = load_state()
-    if not data:
-        return  # Don't write empty dict if state file is empty
-    
-    now = datetime.now(timezone.utc)
-    changed = False
+def local_instances():
+    """Sessions with a server running on this host; parked ones have none."""
+    return {port: info for port, info in get_store().all().items() if is_local(info) and not is_parked(info)}
+
 
-    for port, info in list(data.items()):
+def instance_url(port, info):
+    return f"http://{info.get('node_host') or PUBLIC_HOST}:{port}"
+
+
+def stop_instance_process(port, info):
+    """
+    Stop the server behind a state entry and everything it started, here or
+    through its node's agent (blocking). Returns the stop report
+    (api/procs.py), None if there was no server. Raises NodeUnavailable /
+    AgentError if the agent can't.
+    """
+    if is_parked(info):
+        return None
+    if is_local(info):
+        report = stop_process_tree(info.get("pid"), port)
+    else:
+        node = node_registry.get(info["node"])
+        if node is None:
+            raise NodeUnavailable(f"Node {info['node']} is not configured")
+        report = node.stop(port)
+    if report:
+        record_stop(port, report)
+    return report
+
+
+def record_stop(port, report):
+    stop_freed_mb_total.inc(report.get("freed_mb") or 0)
+    if report.get("escalated"):
+        stop_escalations_total.inc()
+        print(f"Port {port}: {report['escalated']} process(es) ignored SIGTERM, sent SIGKILL")
+    if report.get("survivors"):
+        print(f"Port {port}: pids {report['survivors']} survived SIGKILL")
+    if report.get("port_released") is False:
+        print(f"Port {port} is still in use after stopping its server")
+
+
+def stop_summary(report):
+    """What a stop's API answer and "stopped" event say about it."""
+    return {k: (report or {}).get(k) for k in ("freed_mb", "escalated", "port_released")}
+
+
+def reap_dead_instances():
+    """Forget entries whose server is gone. Expiry itself is the scheduler's job."""
+    for port, info in get_store().all().items():
+        if not is_local(info):
+            continue   # its agent reports it (reap_remote_instances)
+        if is_parked(info):
+            continue
         pid = info.get("pid")
         if not pid:
-            del data[port]
-            changed = True
+            forget_instance(port)
             continue
 
         # Check if process is running (using improved is_running that works across users)
         if not is_running(pid):
             # Process is dead, remove from state
-            del data[port]
-            changed = True
+            forget_instance(port)
             continue
 
         # ⬇️ HANDLE OLD ENTRIES SAFELY
-        expires_at_str = info.get("expires_at")
-        if not expires_at_str:
+        if not info.get("expires_at"):
             # Old instance → expire immediately
-            try:
-                os.kill(pid, signal.SIGTERM)
-            except (OSError, ProcessLookupError):
-                pass  # Process already dead
-            del data[port]
-            changed = True
-            continue
+            stop_instance_process(port, info)
+            forget_instance(port)
+
 
-        expires_at = datetime.fromisoformat(expires_at_str)
-        
-        # Check if expiration is set to far future (timer disabled) - 50+ years indicates disabled timer
-        # This allows sessions with disabled timers to never expire
-        years_until_expiry = (expires_at - now).total_seconds() / (365.25 * 24 * 3600)
-        if years_until_expiry > 50:
-            # Timer disabled - skip expiration check
+async def expire_instance(port):
+    info = get_store().get(port)
+    if info is None:
+        return
+    deadline = parse_expires_at(info.get("expires_at"))
+    if deadline is None or deadline > time.time():
+        # TTL was changed behind our back (e.g. by another process); follow it
+        expiry_scheduler.schedule(port, info.get("expires_at"))
+        return
+    try:
+        report = await asyncio.get_running_loop().run_in_executor(None, stop_instance_process, port, info)
+    except (NodeUnavailable, AgentError) as e:
+        # Keep the entry: dropping it would leave the server running unseen
+        print(f"Could not stop expired session on port {port}, retrying in {STOP_RETRY_SECONDS}s: {e}")
+        expiry_scheduler.schedule(port, (datetime.now(timezone.utc) + timedelta(seconds=STOP_RETRY_SECONDS)).isoformat())
+        return
+    print(f"Session on port {port} expired")
+    expiries_total.inc()
+    forget_instance(port)
+    event_bus.publish("expired", port=int(port), tag=info.get("tag"), **stop_summary(report))
+
+
+expiry_scheduler = ExpiryScheduler(on_expire=expire_instance)
+
+
+def reap_from_snapshot(snapshot):
+    """Forget servers the sampler found dead (runs after every sampling pass)."""
+    store = get_store()
+    for port, sample in snapshot["instances"].items():
+        if sample["alive"]:
             continue
+        info = store.get(port)
+        # Same pid check: the port may have been relaunched since the pass began
+        if info is not None and info.get("pid") == sample["pid"]:
+            print(f"Jupyter on port {port} (pid {sample['pid']}) is gone, forgetting it")
+            forget_instance(port)
+            event_bus.publish("crashed", port=int(port), pid=sample["pid"], tag=info.get("tag"))
 
-        if now >= expires_at:
-            try:
-                os.kill(pid, signal.SIGTERM)
-            except (OSError, ProcessLookupError):
-                pass  # Process already dead
-            del data[port]
-            changed = True
 
-    if changed:
-        save_state(data)
+_expiry_warned = {}   # port -> deadline an "expiring_soon" event went out for
+
+
+def warn_expiring():
+    due = dict(expiry_scheduler.due_within(EXPIRY_WARNING_SECONDS))
+    for port, deadline in due.items():
+        if _expiry_warned.get(port) != deadline:
+            _expiry_warned[port] = deadline
+            event_bus.publish("expiring_soon", port=port, expires_in_seconds=round(deadline - time.time()))
+    for port in list(_expiry_warned):
+        if port not in due:
+            del _expiry_warned[port]
+
+
+def on_sample(snapshot):
+    """After every sampling pass: share it, reap, publish the sample, warn about deadlines."""
+    if SHARED:
+        get_store().set_meta("sample", snapshot)
+    reap_from_snapshot(snapshot)
+    event_bus.publish(
+        "sample",
+        totals=snapshot["totals"],
+        host=snapshot["host"],
+        instances={
+            port: {k: sample.get(k) for k in ("alive", "rss_mb", "cpu_percent", "kernels")}
+            for port, sample in snapshot["instances"].items()
+        },
+    )
+    warn_expiring()
+
+
+resource_sampler = ResourceSampler(
+    get_instances=local_instances,
+    on_sample=on_sample,
+)
+
+
+def get_host_ram_mb():
+    snapshot = resource_sampler.snapshot
+    if snapshot is None:
+        return psutil.virtual_memory().total // 1024 // 1024
+    return snapshot["host"]["total_mb"]
+
+
+admission = AdmissionController(
+    host_ram_mb=get_host_ram_mb,
+    min_free_mb=MIN_RAM_FREE_MB,
+    default_instance_mb=MAX_RAM_USAGE_PER_INSTANCE_MB,
+    get_instances=local_instances,
+    shared=shared_reservations,
+)
+
+
+async def stop_idle_instance(port):
+    info = get_store().get(port)
+    if info is None:
+        return
+    try:
+        report = await asyncio.get_running_loop().run_in_executor(None, stop_instance_process, port, info)
+    except (NodeUnavailable, AgentError) as e:
+        print(f"Could not stop idle session on port {port}: {e}")   # next culling pass retries
+        return
+    forget_instance(port)
+    event_bus.publish("stopped", port=int(port), reason="idle", tag=info.get("tag"), **stop_summary(report))
+
+
+idle_culler = IdleCuller(
+    # Warm servers are idle by design
+    get_instances=lambda: {p: i for p, i in get_store().all().items() if not is_warm(i)},
+    on_idle_server=stop_idle_instance,
+    instance_rss_mb=lambda port: (instance_sample(port, get_store().get(port) or {}) or {}).get("rss_mb"),
+    on_pass=lambda state: get_store().set_meta("idle_culler", state) if SHARED else None,
+    on_park_server=lambda port: park_idle_instance(port),
+)
+
+
+orphan_sweeper = OrphanSweeper(
+    get_tracked=lambda: {port: info.get("pid") for port, info in local_instances().items()},
+    on_stopped=lambda port, report: orphans_stopped_total.inc(report["processes"]),
+)
+
+
+log_rotator = LogRotator(
+    # Warm servers log too
+    get_instance_dirs=lambda: [info["path"] for info in local_instances().values() if info.get("path")],
+    on_rotate=log_rotations_total.inc,
+)
 
 
 def get_free_ram_mb():
-    return psutil.virtual_memory().available // 1024 // 1024
+    snapshot = resource_sampler.snapshot
+    if snapshot is None:
+        # Before the first sampling pass
+        return psutil.virtual_memory().available // 1024 // 1024
+    return snapshot["host"]["available_mb"]
 
 
 def get_total_estimated_ram_usage_mb():
-    data = load_state()
-    usage = 0
-    for info in data.values():
-        pid = info["pid"]
-        if is_running(pid):
-            try:
-                p = psutil.Process(pid)
-                usage += p.memory_info().rss // 1024 // 1024
-            except psutil.NoSuchProcess:
-                pass
-    return usage
+    """RSS of all instances including their kernels, from the last sampling pass"""
+    snapshot = resource_sampler.snapshot
+    return int(snapshot["totals"]["rss_mb"]) if snapshot else 0
+
+
+# ------------------------
+# NODES
+# ------------------------
+def local_node_status():
+    """This host, in the shape of an agent's /health."""
+    free_mb = get_free_ram_mb()
+    return {
+        "healthy": free_mb >= MIN_RAM_FREE_MB,
+        "error": f"Only {free_mb} MB of RAM free",
+        "ports": port_allocator.stats(),
+        "ram": admission.stats(),
+    }
+
+
+def reap_remote_instances(node, health, polled_at):
+    """After each poll of an agent: forget the sessions it no longer has."""
+    if not leader.is_leader:
+        return
+    sessions = health.get("sessions", {})
+    for port, info in get_store().all().items():
+        if info.get("node") != node.name or port in sessions:
+            continue
+        # Entries written after the poll went out can be missing from its answer
+        if datetime.fromisoformat(info["started_at"]).timestamp() >= polled_at:
+            continue
+        print(f"Jupyter on port {port} is gone from node {node.name}, forgetting it")
+        forget_instance(port)
+        event_bus.publish("crashed", port=int(port), pid=info.get("pid"), node=node.name, tag=info.get("tag"))
+
+
+def instance_sample(port, info):
+    """Latest sample of a session: this host's sampler, or its agent's at the last poll."""
+    if is_parked(info):
+        return None
+    if is_local(info):
+        return resource_sampler.instance(port)
+    node = node_registry.get(info["node"])
+    return node.sample(port) if node is not None else None
+
+
+node_registry = NodeRegistry(
+    local=LocalNode(LOCAL_NODE, status=local_node_status, public_host=PUBLIC_HOST, draining=DRAIN_LOCAL),
+    remotes=[RemoteNode(name, url) for name, url in parse_nodes(NODES)],
+    on_health=reap_remote_instances,
+)
+
+
+@app.get("/api/nodes")
+def list_nodes():
+    """Every node with its health, draining flag, free ports, RAM headroom and session count."""
+    sessions = {}
+    for info in get_store().all().values():
+        if not is_warm(info):
+            name = info.get("node") or node_registry.local.name
+            sessions[name] = sessions.get(name, 0) + 1
+    return [{**node.to_dict(), "sessions": sessions.get(node.name, 0)} for node in node_registry.nodes.values()]
+
+
+@app.post("/api/nodes/{name}/drain")
+def drain_node(name: str, draining: bool = True):
+    """Stop (draining=false: resume) placing new sessions on a node; running ones stay."""
+    node = node_registry.get(name)
+    if node is None:
+        raise HTTPException(status_code=404, detail="Node not found")
+    node.draining = draining
+    if SHARED:
+        # The other workers pick it up within FOLLOW_SECONDS
+        get_store().set_meta("node_draining", {**(get_store().get_meta("node_draining") or {}), name: draining})
+    print(f"Node {name} {'draining' if draining else 'schedulable again'}")
+    return node.to_dict()
+
+
+# ------------------------
+# WORKERS
+# ------------------------
+async def become_leader():
+    """Start what only one worker may run (see api/workers.py)."""
+    reap_dead_instances()
+    port_allocator.reconcile(get_store().ports())
+    if SHARED:
+        # Carry on from the previous leader's culling totals
+        state = get_store().get_meta("idle_culler")
+        if state is not None:
+            idle_culler.load(state)
+    expiry_scheduler.start()
+    resource_sampler.start()
+    idle_culler.start()
+    warm_pool.start()
+    log_rotator.start()
+    orphan_sweeper.start()
+
+
+leader = LeaderElection(on_elected=become_leader)
+
+
+def follow_deadlines(version):
+    """Apply the deadlines written since version (by any worker) to the scheduler; returns the new version."""
+    store = get_store()
+    changes = store.changes_since(version)
+    if changes is None:
+        current = store.version()
+        if current != version:
+            expiry_scheduler.rebuild(store.all())
+        return current
+    version, changed, deleted = changes
+    for port, info in changed.items():
+        if expiry_scheduler.deadline(port) != parse_expires_at(info.get("expires_at")):
+            expiry_scheduler.schedule(port, info.get("expires_at"))
+    for port in deleted:
+        expiry_scheduler.unschedule(port)
+    return version
+
+
+def follow_shared_state():
+    """Drain flags from any worker; the leader's last sample and culling pass."""
+    store = get_store()
+    for name, draining in (store.get_meta("node_draining") or {}).items():
+        node = node_registry.get(name)
+        if node is not None:
+            node.draining = draining
+    if leader.is_leader:
+        return
+    snapshot = store.get_meta("sample")
+    if snapshot is not None:
+        resource_sampler.load(snapshot)
+    state = store.get_meta("idle_culler")
+    if state is not None and state["last_pass"] != idle_culler.last_pass:
+        idle_culler.load(state)
+
+
+async def follow_workers(version):
+    loop = asyncio.get_running_loop()
+    flushed = time.time()
+    while True:
+        await asyncio.sleep(FOLLOW_SECONDS)
+        try:
+            version = await loop.run_in_executor(None, follow_deadlines, version)
+            if SHARED:
+                await loop.run_in_executor(None, follow_shared_state)
+                if time.time() - flushed >= METRICS_FLUSH_SECONDS:
+                    await loop.run_in_executor(None, registry.flush)
+                    flushed = time.time()
+        except Exception as e:
+            print(f"Following the other workers failed: {e}")
+
+
+@app.get("/api/workers")
+def worker_status():
+    """This worker's pid and which worker is the leader."""
+    return leader.stats()
 
 
 @app.on_event("startup")
 async def startup_event():
-    cleanup_dead_and_expired()
+    event_bus.start()
+    store = get_store()
+    version = store.version()
+    data = store.all()
+    port_allocator.reconcile(data.keys())
+    # Every worker keeps the deadlines (for /api/jupyter/scheduler); only the leader acts on them
+    expiry_scheduler.rebuild(data)
+    node_registry.start()
+    if SHARED:
+        follow_shared_state()
+    asyncio.get_running_loop().create_task(follow_workers(version))
+    password_hasher.start()
+    await leader.start()
 
-from argon2 import PasswordHasher
 
-ph = PasswordHasher()
+@app.on_event("shutdown")
+async def shutdown_event():
+    password_hasher.shutdown()
+
 
-def generate_jupyter_password(password: str) -> str:
-    """
-    Returns a Jupyter-compatible Argon2 hash
-    """
-    return ph.hash(password)
 # ------------------------
 # START JUPYTER
 # ------------------------
-from jupyter_server.auth import passwd
+# Argon2 is CPU- and memory-hard: hashes are made in a bounded process pool (api/hashing.py)
+password_hasher = PasswordHasherPool()
 
 
-@app.post("/api/jupyter")
-def start_jupyter(session_minutes: Optional[int] = None, user_port: Optional[int] = None, password: str = "", disable_timer: bool = False):
-    print(f"Starting Jupyter with session_minutes: {session_minutes}, user_port: {user_port}, password: {password}, disable_timer: {disable_timer}")
-    free_ram = get_free_ram_mb()
-    estimated_usage = get_total_estimated_ram_usage_mb()
+async def hash_password(password):
+    return await password_hasher.hash(password)
 
-    if free_ram - MIN_RAM_FREE_MB < MAX_RAM_USAGE_PER_INSTANCE_MB:
+
+async def launch_instance(job, password, expires_at, port, disable_timer, limits, fields=None, password_hash=None):
+    """
+    Launch on a port already reserved from port_allocator and admitted with
+    limits["memory_mb"]; gives both back on failure. fields (idle policy,
+    tag) are stored on the state entry.
+    """
+    event_bus.publish("launching", port=int(port), job_id=job.id, pool=job.params.get("pool"))
+    try:
+        job.set_phase("provisioning")
+        launch_phase_seconds.observe(job.phase_times["provisioning"] - job.created_at, phase="queue")
+        if password_hash is None:
+            started = time.perf_counter()
+            password_hash = await hash_password(password)   # pass this to Jupyter
+            launch_phase_seconds.observe(time.perf_counter() - started, phase="password_hash")
+        api_token = secrets.token_urlsafe(24)
+        port, pid = await run_start_script(
+            job,
+            start_script_argv(
+                START_SCRIPT, password, password_hash, expires_at.isoformat(), port, limits, api_token,
+                (fields or {}).get("template"),
+            ),
+            timeout=60,
+        )
+        get_store().update(
+            port,
+            limits=limits,
+            cgroup=cgroup_path(port) if cgroup_v2_available() else None,
+            api_token=api_token,
+            password_hash=password_hash,   # to restart the server after parking
+            **(fields or {}),
+        )
+    except BaseException as e:
+        port_allocator.release(port)
+        launches_total.inc(result="failed")
+        event_bus.publish("launch_failed", port=int(port), job_id=job.id, error=str(e))
+        raise
+    finally:
+        # The state entry (with its limits) now carries the commitment
+        admission.release(port)
+    port_allocator.commit(port)
+    return finish_launch(job, node_registry.local, port, pid, password, expires_at, disable_timer, fields)
+
+
+async def launch_remote(job, node, password, expires_at, user_port, disable_timer, limits, fields):
+    """
+    Launch through node's agent (api/agent.py), which reserves the port (any
+    free one of its range when user_port is None) and admits the RAM.
+    """
+    event_bus.publish("launching", port=user_port, node=node.name, job_id=job.id, pool=None)
+    try:
+        job.set_phase("provisioning")
+        launch_phase_seconds.observe(job.phase_times["provisioning"] - job.created_at, phase="queue")
+        started = time.perf_counter()
+        password_hash = await hash_password(password)
+        launch_phase_seconds.observe(time.perf_counter() - started, phase="password_hash")
+        api_token = secrets.token_urlsafe(24)
+        job.set_phase("spawning")
+        result = await asyncio.get_running_loop().run_in_executor(None, node.launch, {
+            "password": password,
+            "password_hash": password_hash,
+            "expires_at": expires_at.isoformat(),
+            "limits": limits,
+            "api_token": api_token,
+            "port": user_port,
+            "template": fields.get("template"),
+        })
+    except BaseException as e:
+        launches_total.inc(result="failed")
+        event_bus.publish("launch_failed", port=user_port, node=node.name, job_id=job.id, error=str(e))
+        if isinstance(e, (NodeUnavailable, AgentError)):
+            raise LaunchError(f"Node {node.name}: {e}")
+        raise
+    port, pid = result["port"], result["pid"]
+    job.timings.update(result.get("timings") or {})
+    info = {
+        "pid": pid,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": expires_at.isoformat(),
+        "password": password,
+        "node": node.name,
+        "node_host": node.host,
+        "limits": limits,
+        "cgroup": result.get("cgroup"),
+        "api_token": api_token,
+        **fields,
+    }
+    get_store().upsert(port, {k: v for k, v in info.items() if v is not None})
+    return finish_launch(job, node, port, pid, password, expires_at, disable_timer, fields)
+
+
+def finish_launch(job, node, port, pid, password, expires_at, disable_timer, fields):
+    """Metrics, history, expiry and the "ready" event of a launch; returns the job result."""
+    for step, ms in job.timings.items():
+        launch_phase_seconds.observe(ms / 1000, phase=step)
+    launch_phase_seconds.observe(time.time() - job.created_at, phase="total")
+    launches_total.inc(result="started")
+    if job.params.get("pool") != "warm":
+        get_history().record_use(port, (fields or {}).get("tag"))
+    expiry_scheduler.schedule(port, expires_at.isoformat())
+    print(f"Jupyter on port {port} ({node.name}) ready in {job.timings.get('readiness')} ms")
+    event_bus.publish(
+        "ready", port=port, pid=pid, node=node.name, job_id=job.id, pool=job.params.get("pool"),
+        tag=(fields or {}).get("tag"), readiness_ms=job.timings.get("readiness"),
+    )
+    return {
+        "status": "started",
+        "port": port,
+        "pid": pid,
+        "node": node.name,
+        "url": f"http://{node.host}:{port}",
+        "password": password,              # 👈 shown ONCE
+        "expires_at": expires_at.isoformat() if not disable_timer else None,
+        "readiness_ms": job.timings.get("readiness"),
+    }
+
+
+def build_limits(memory_mb=None, cpu_weight=None, pids_max=None):
+    limits = default_limits(MAX_RAM_USAGE_PER_INSTANCE_MB)
+    if memory_mb is not None:
+        limits["memory_mb"] = memory_mb
+    if cpu_weight is not None:
+        limits["cpu_weight"] = cpu_weight
+    if pids_max is not None:
+        limits["pids_max"] = pids_max
+    if limits["memory_mb"] < 128 or not 1 <= limits["cpu_weight"] <= 10000 or limits["pids_max"] < 16:
+        raise HTTPException(status_code=400, detail="Invalid limits (memory_mb >= 128, 1 <= cpu_weight <= 10000, pids_max >= 16)")
+    return limits
+
+
+def build_idle(idle_kernel_minutes=None, idle_server_minutes=None, idle_server_action=None):
+    # Unset fields fall back to the culler's defaults; 0 disables that step
+    idle = {"kernel_minutes": idle_kernel_minutes, "server_minutes": idle_server_minutes}
+    if any(v is not None and v < 0 for v in idle.values()):
+        raise HTTPException(status_code=400, detail="Idle minutes must be >= 0")
+    if idle_server_action is not None and idle_server_action not in SERVER_ACTIONS:
+        raise HTTPException(status_code=400, detail=f"idle_server_action: one of {', '.join(SERVER_ACTIONS)}")
+    idle["server_action"] = idle_server_action
+    return {k: v for k, v in idle.items() if v is not None} or None
+
+
+def session_expiry(session_minutes, disable_timer):
+    # Handle timer: if disabled, set far future expiration; otherwise use session_minutes (default 60 if not provided)
+    if disable_timer:
+        # Set expiration to 100 years in the future (effectively never expires)
+        return datetime.now(timezone.utc) + timedelta(days=365 * 100)
+    if session_minutes is None:
+        session_minutes = 60  # Default value
+    return datetime.now(timezone.utc) + timedelta(minutes=session_minutes)
+
+
+def check_host_ram():
+    # Admission is by committed reservations; this only guards the host floor
+    if get_free_ram_mb() < MIN_RAM_FREE_MB:
         raise HTTPException(
             status_code=503,
             detail="Not enough free RAM"
         )
 
+
+async def claim_warm_session(user_port, password, expires_at, disable_timer, fields, params, password_hash=None):
+    """
+    Hand over a warm server, re-keyed to password. Returns (finished job or
+    None if none was free, password_hash).
+    """
+    if password_hash is None:
+        password_hash = await hash_password(password)
+    claimed = warm_pool.claim(
+        user_port,
+        password=password,
+        started_at=datetime.now(timezone.utc).isoformat(),
+        expires_at=expires_at.isoformat(),
+        password_hash=password_hash,
+        **fields,
+    )
+    if not claimed:
+        return None, password_hash
+    port, info = claimed
+    try:
+        write_password_hash(info["path"], password_hash)
+    except OSError as e:
+        # Put it back untouched; the placeholder password still applies
+        get_store().update(port, pool="warm", password=None, expires_at=(datetime.now(timezone.utc) + timedelta(days=365 * 100)).isoformat())
+        raise HTTPException(status_code=500, detail=f"Failed to re-key warm server: {e}")
+    expiry_scheduler.schedule(port, expires_at.isoformat())
+    print(f"Claimed warm Jupyter on port {port}")
+    launches_total.inc(result="warm")
+    get_history().record_use(port, fields.get("tag"))
+    job = launch_jobs.completed({
+        "status": "started",
+        "port": int(port),
+        "pid": info["pid"],
+        "node": node_registry.local.name,
+        "url": instance_url(port, info),
+        "password": password,              # 👈 shown ONCE
+        "expires_at": expires_at.isoformat() if not disable_timer else None,
+        "readiness_ms": 0,
+        "warm": True,
+    }, params=params)
+    event_bus.publish("ready", port=int(port), pid=info["pid"], job_id=job.id, warm=True, tag=fields.get("tag"), readiness_ms=0)
+    return job, password_hash
+
+
+def warm_eligible(limits, template):
+    # Warm servers run with default limits and are seeded with the default template
+    return warm_pool.size and limits == default_limits(MAX_RAM_USAGE_PER_INSTANCE_MB) and template == DEFAULT_TEMPLATE
+
+
+def resolve_template(template):
+    """
+    The notebook template a launch is seeded from (api/seeding.py): the
+    default one when not given, none for an empty name.
+    """
+    if template is None:
+        return DEFAULT_TEMPLATE
+    if template == "":
+        return None
+    try:
+        template_dir(template)
+    except UnknownTemplate as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return template
+
+
+def place_session(limits, user_port, prefer_local=False):
+    """The node a new session goes to; this host unless agents are configured."""
+    try:
+        node = node_registry.place(
+            limits["memory_mb"], user_port, prefer=node_registry.local if prefer_local else None,
+        )
+    except NodeUnavailable as e:
+        raise HTTPException(status_code=409 if user_port else 503, detail=str(e))
+    if node.local:
+        check_host_ram()
+    return node
+
+
+def reserve_port(user_port):
+    try:
+        return port_allocator.reserve(
+            user_port,
+            owner="launch",
+            exclude=warm_pool.ports if warm_pool.size else None,
+        )
+    except PortUnavailable as e:
+        raise HTTPException(status_code=409 if user_port else 503, detail=str(e))
+
+
+@app.post("/api/jupyter", status_code=202)
+async def start_jupyter(
+    session_minutes: Optional[int] = None,
+    user_port: Optional[int] = None,
+    password: str = "",
+    disable_timer: bool = False,
+    memory_mb: Optional[int] = None,
+    cpu_weight: Optional[int] = None,
+    pids_max: Optional[int] = None,
+    idle_kernel_minutes: Optional[int] = None,
+    idle_server_minutes: Optional[int] = None,
+    idle_server_action: Optional[str] = None,
+    tag: Optional[str] = None,
+    owner: Optional[str] = None,
+    template: Optional[str] = None,
+):
+    print(f"Starting Jupyter with session_minutes: {session_minutes}, user_port: {user_port}, disable_timer: {disable_timer}")
+    limits = build_limits(memory_mb, cpu_weight, pids_max)
+    idle = build_idle(idle_kernel_minutes, idle_server_minutes, idle_server_action)
+    template = resolve_template(template)
+    # A free warm server here beats a cold start on a roomier node
+    node = place_session(limits, user_port, prefer_local=warm_eligible(limits, template) and bool(warm_pool.warm_ports()))
+
     # 🔐 Generate password
     if password == "":
         password = secrets.token_urlsafe(10)
-    password_hash = passwd(password)       # pass this to Jupyter
 
-    # Handle timer: if disabled, set far future expiration; otherwise use session_minutes (default 60 if not provided)
-    if disable_timer:
-        # Set expiration to 100 years in the future (effectively never expires)
-        expires_at = datetime.now(timezone.utc) + timedelta(days=365 * 100)
-        ttl_minutes = ""  # Empty string tells shell script not to set up auto-expire
-    else:
-        if session_minutes is None:
-            session_minutes = 60  # Default value
-        expires_at = datetime.now(timezone.utc) + timedelta(minutes=session_minutes)
-        ttl_minutes = str(session_minutes)
-    
+    expires_at = session_expiry(session_minutes, disable_timer)
     print(f"Expires at: {expires_at}")
+    params = {
+        "session_minutes": session_minutes,
+        "user_port": user_port,
+        "disable_timer": disable_timer,
+        "limits": limits,
+        "idle": idle,
+        "tag": tag,
+        "owner": owner,
+        "template": template,
+        "node": node.name,
+    }
+    fields = {"idle": idle, "tag": tag, "owner": owner, "template": template}
+
+    # ♨️ Hand over a warm server if one is available
+    password_hash = None
+    if node.local and warm_eligible(limits, template):
+        job, password_hash = await claim_warm_session(user_port, password, expires_at, disable_timer, fields, params)
+        if job is not None:
+            return {
+                "status": "started",
+                "job_id": job.id,
+                "phase": job.phase,
+                "job_url": f"/api/jupyter/jobs/{job.id}",
+                "result": job.result,
+            }
+
+    if node.local:
+        port = reserve_port(user_port)
+        try:
+            admission.reserve(port, limits["memory_mb"])
+        except AdmissionDenied as e:
+            port_allocator.release(port)
+            raise HTTPException(status_code=503, detail=str(e))
+        launch = lambda job: launch_instance(job, password, expires_at, port, disable_timer, limits, fields, password_hash)
+    else:
+        launch = lambda job: launch_remote(job, node, password, expires_at, user_port, disable_timer, limits, fields)
+
+    job = launch_jobs.submit(launch, params=params)
+    return {
+        "status": "accepted",
+        "job_id": job.id,
+        "phase": job.phase,
+        "job_url": f"/api/jupyter/jobs/{job.id}",
+    }
+
+
+# ------------------------
+# BATCH LAUNCH / STOP
+# ------------------------
+BATCH_MAX_SIZE = 200
+
+
+class SessionSpec(BaseModel):
+    user_port: Optional[int] = None
+    session_minutes: Optional[int] = None
+    password: str = ""
+    disable_timer: bool = False
+    tag: Optional[str] = None
+    owner: Optional[str] = None
+    memory_mb: Optional[int] = None
+    cpu_weight: Optional[int] = None
+    pids_max: Optional[int] = None
+    idle_kernel_minutes: Optional[int] = None
+    idle_server_minutes: Optional[int] = None
+    idle_server_action: Optional[str] = None
+    template: Optional[str] = None
+
+
+class BatchLaunch(SessionSpec):
+    """Top-level fields are defaults for every item; give either count or items."""
+    count: Optional[int] = None
+    items: Optional[List[SessionSpec]] = None
+    parallelism: Optional[int] = None
+
+
+class BatchStop(BaseModel):
+    ports: Optional[List[int]] = None
+    tag: Optional[str] = None
+
+
+def expand_batch(batch: BatchLaunch):
+    defaults = batch.model_dump(exclude={"count", "items", "parallelism"}, exclude_unset=True)
+    if (batch.count is None) == (batch.items is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of count, items")
+    if batch.count is not None:
+        if batch.user_port is not None and batch.count > 1:
+            raise HTTPException(status_code=400, detail="user_port can't be shared by several sessions")
+        specs = [SessionSpec(**defaults) for _ in range(batch.count)]
+    else:
+        specs = [SessionSpec(**{**defaults, **item.model_dump(exclude_unset=True)}) for item in batch.items]
+    if not 1 <= len(specs) <= BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"A batch holds 1 to {BATCH_MAX_SIZE} sessions")
+    ports = [spec.user_port for spec in specs if spec.user_port is not None]
+    if len(ports) != len(set(ports)):
+        raise HTTPException(status_code=400, detail="Duplicate user_port in batch")
+    return specs
+
+
+@app.post("/api/jupyter/batch", status_code=202)
+async def start_jupyter_batch(batch: BatchLaunch, stream: bool = False):
+    """
+    Launch many sessions at once. Each item is placed on a node first; RAM on
+    this host is admitted for all of its items up front (all or nothing),
+    items on other nodes are admitted by their agent. Launches then run at
+    most `parallelism` at a time.
+    With stream=true the response is NDJSON: the batch, then one line per
+    item as it finishes.
+    """
+    specs = expand_batch(batch)
+    prepared = []
+    for spec in specs:
+        prepared.append({
+            "spec": spec,
+            "limits": build_limits(spec.memory_mb, spec.cpu_weight, spec.pids_max),
+            "idle": build_idle(spec.idle_kernel_minutes, spec.idle_server_minutes, spec.idle_server_action),
+            "template": resolve_template(spec.template),
+            "password": spec.password or secrets.token_urlsafe(10),
+            "expires_at": session_expiry(spec.session_minutes, spec.disable_timer),
+        })
+    warm_left = len(warm_pool.warm_ports())
+    for item in prepared:
+        spec = item["spec"]
+        prefer_local = spec.user_port is None and warm_left > 0 and warm_eligible(item["limits"], item["template"])
+        warm_left -= prefer_local
+        item["warm"] = prefer_local
+        item["node"] = place_session(item["limits"], spec.user_port, prefer_local=prefer_local)
+    local_items = [item for item in prepared if item["node"].local]
+    parallelism = max(1, min(batch.parallelism or BATCH_MAX_PARALLELISM, BATCH_MAX_PARALLELISM))
+    print(f"Starting batch of {len(prepared)} sessions ({len(local_items)} here), parallelism {parallelism}")
+
+    # Reserve ports and RAM here for every local item before launching any of them
+    reserved = []
     try:
-        result = subprocess.run(
-            [
-                "/home/ubuntu/jupyter_service/scripts/start_jupyter.sh",
-                password,
-                password_hash,
-                expires_at.isoformat(),
-                ttl_minutes,
-                str(user_port) if user_port else ""
-            ],
-            text=True,
-            capture_output=True,
-            timeout=60,
-            bufsize=1  # Line buffered
-        )
-        
-        # Debug output
-        print(f"Script return code: {result.returncode}")
-        print(f"Script stdout: {result.stdout}")
-        print(f"Script stderr: {result.stderr}")
-        
-        if result.returncode != 0:
-            error_msg = result.stderr or result.stdout or "Unknown error"
-            print(f"Script error: {error_msg}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to start Jupyter: {error_msg}"
-            )
-        
-        output = result.stdout.strip()
-        if not output:
-            # If no stdout but state file was updated, try to read from state file
-            data = load_state()
-            if user_port and str(user_port) in data:
-                info = data[str(user_port)]
-                port = user_port
-                pid = info.get("pid")
-                print(f"Recovered from state file: port={port}, pid={pid}")
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Script returned no output and state file not updated"
-                )
-        else:
-            parts = output.split()
-            if len(parts) < 2:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Unexpected script output format: {output}"
-                )
-            port, pid = parts[0], parts[1]
-
-        return {
-            "status": "started",
-            "port": int(port),
-            "pid": int(pid),
-            "url": f"http://13.232.82.145:{port}",
-            "password": password,              # 👈 shown ONCE
-            "expires_at": expires_at.isoformat() if not disable_timer else None
+        for item in local_items:
+            item["port"] = reserve_port(item["spec"].user_port)
+            reserved.append(item["port"])
+        admission.reserve_many({item["port"]: item["limits"]["memory_mb"] for item in local_items})
+    except (HTTPException, AdmissionDenied) as e:
+        for port in reserved:
+            port_allocator.release(port)
+        if isinstance(e, AdmissionDenied):
+            raise HTTPException(status_code=503, detail=str(e))
+        raise
+
+    # Warm claims are made in this request: hash their passwords all at once
+    warm_items = [item for item in local_items if item["warm"]]
+    for item, password_hash in zip(warm_items, await asyncio.gather(*(hash_password(i["password"]) for i in warm_items))):
+        item["password_hash"] = password_hash
+
+    semaphore = asyncio.Semaphore(parallelism)
+    jobs = []
+    for item in prepared:
+        spec, limits, idle, node = item["spec"], item["limits"], item["idle"], item["node"]
+        fields = {"idle": idle, "tag": spec.tag, "owner": spec.owner, "template": item["template"]}
+        params = {
+            "session_minutes": spec.session_minutes,
+            "user_port": spec.user_port,
+            "disable_timer": spec.disable_timer,
+            "limits": limits,
+            "idle": idle,
+            "tag": spec.tag,
+            "owner": spec.owner,
+            "template": item["template"],
+            "node": node.name,
         }
+        if not node.local:
+            jobs.append(launch_jobs.submit(
+                lambda job, item=item, fields=fields: launch_remote(
+                    job, item["node"], item["password"], item["expires_at"], item["spec"].user_port,
+                    item["spec"].disable_timer, item["limits"], fields,
+                ),
+                params=params,
+                semaphore=semaphore,
+            ))
+            continue
+        # Items without a fixed port may take a warm server instead
+        if spec.user_port is None and warm_eligible(limits, item["template"]):
+            job, item["password_hash"] = await claim_warm_session(
+                None, item["password"], item["expires_at"], spec.disable_timer, fields, params, item.get("password_hash"),
+            )
+            if job is not None:
+                admission.release(item["port"])
+                port_allocator.release(item["port"])
+                jobs.append(job)
+                continue
+        jobs.append(launch_jobs.submit(
+            lambda job, item=item, fields=fields: launch_instance(
+                job, item["password"], item["expires_at"], item["port"],
+                item["spec"].disable_timer, item["limits"], fields, item.get("password_hash"),
+            ),
+            params=params,
+            semaphore=semaphore,
+        ))
+
+    launch_batch = launch_jobs.add_batch(jobs, params={"size": len(jobs), "parallelism": parallelism, "tag": batch.tag})
+    if not stream:
+        return launch_batch.to_dict()
+
+    async def results():
+        head = launch_batch.to_dict()
+        head.pop("items")
+        yield json.dumps(head) + "\n"
+        async for index, job in launch_batch.as_completed():
+            yield json.dumps({"index": index, **job.to_dict()}) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
 
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/jupyter/batches/{batch_id}")
+async def get_launch_batch(batch_id: str, wait: float = 0):
+    """Batch status. With wait>0, long-polls until some item changes phase (max 60s)."""
+    launch_batch = launch_jobs.get_batch(batch_id)
+    if launch_batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    await launch_batch.wait_for_change(min(wait, 60))
+    return launch_batch.to_dict()
+
+
+@app.post("/api/jupyter/batch/stop")
+async def stop_jupyter_batch(request: BatchStop):
+    """Stop the given ports, or every session carrying tag, concurrently."""
+    if (request.ports is None) == (request.tag is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of ports, tag")
+    data = get_store().all()
+    if request.tag is not None:
+        ports = sorted(int(p) for p, info in data.items() if info.get("tag") == request.tag and not is_warm(info))
+    else:
+        ports = request.ports
+
+    loop = asyncio.get_running_loop()
+
+    async def stop(port):
+        info = data.get(str(port))
+        if info is None or is_warm(info):
+            return {"port": port, "status": "not_found"}
+        try:
+            report = await loop.run_in_executor(None, stop_instance_process, port, info)
+        except (NodeUnavailable, AgentError) as e:
+            return {"port": port, "status": "failed", "error": str(e)}
+        forget_instance(port)
+        stops_total.inc()
+        event_bus.publish("stopped", port=int(port), reason="api", tag=info.get("tag"), **stop_summary(report))
+        return {"port": port, "status": "stopped", **stop_summary(report)}
+
+    results = await asyncio.gather(*(stop(port) for port in ports))
+    return {"stopped": sum(r["status"] == "stopped" for r in results), "items": list(results)}
+
+
+# ------------------------
+# WARM POOL
+# ------------------------
+async def spawn_warm_server(port):
+    async def launch(job):
+        # Placeholder password nobody learns; replaced on claim
+        placeholder = secrets.token_urlsafe(32)
+        expires_at = datetime.now(timezone.utc) + timedelta(days=365 * 100)
+        result = await launch_instance(
+            job, placeholder, expires_at, port, True, default_limits(MAX_RAM_USAGE_PER_INSTANCE_MB),
+            {"template": DEFAULT_TEMPLATE},
+        )
+        get_store().update(port, pool="warm", password=None)
+        return {"status": "warm", "port": result["port"], "pid": result["pid"]}
+
+    job = launch_jobs.submit(launch, params={"user_port": port, "pool": "warm"})
+    await job.wait_done()
+    if job.phase == "failed":
+        raise RuntimeError(job.error)
+
+
+def admit_warm_server(port):
+    try:
+        admission.reserve(port, MAX_RAM_USAGE_PER_INSTANCE_MB)
+    except AdmissionDenied:
+        return False
+    return True
+
+
+warm_pool = WarmPool(
+    spawn=spawn_warm_server,
+    allocator=port_allocator,
+    admit=admit_warm_server,
+    is_alive=lambda pid: bool(pid) and is_running(pid),
+)
+
+
+@app.get("/api/jupyter/pool")
+def warm_pool_status():
+    return warm_pool.status()
+
+
+@app.get("/api/jupyter/ports")
+def port_allocation_stats():
+    return port_allocator.stats()
+
+
+@app.get("/api/jupyter/admission")
+def admission_stats():
+    return admission.stats()
+
+
+# ------------------------
+# NOTEBOOK TEMPLATES
+# ------------------------
+@app.get("/api/jupyter/templates")
+def notebook_templates():
+    """Templates in instances/common a launch can be seeded from (template=)."""
+    templates = []
+    for name in list_templates():
+        current = manifest(name)
+        templates.append({
+            "name": name,
+            "hash": current["hash"],
+            "files": sorted(current["files"]),
+            "default": name == DEFAULT_TEMPLATE,
+        })
+    return {"templates": templates, "default": DEFAULT_TEMPLATE}
+
+
+# ------------------------
+# PORT HISTORY
+# ------------------------
+@app.get("/api/jupyter/history")
+def port_history(
+    tag: Optional[str] = None,
+    active: Optional[bool] = None,
+    last_used_after: Optional[str] = None,
+    last_used_before: Optional[str] = None,
+    min_times_used: Optional[int] = None,
+    sort: str = "last_used",
+    order: str = "desc",
+    limit: int = 50,
+    offset: int = 0,
+):
+    """Ports used so far, with tag and usage counters; paginated, sorted, filtered."""
+    if sort not in SORT_FIELDS or order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"sort is one of {', '.join(SORT_FIELDS)}; order is asc or desc")
+    limit = max(1, min(limit, 500))
+    active_ports = {int(p) for p, info in get_store().all().items() if not is_warm(info)}
+    total, items = get_history().query(
+        tag=tag, active_ports=active_ports, active=active,
+        last_used_after=last_used_after, last_used_before=last_used_before,
+        min_times_used=min_times_used, sort=sort, order=order, limit=limit, offset=max(offset, 0),
+    )
+    for item in items:
+        item["active"] = item["port"] in active_ports
+    return {"total": total, "limit": limit, "offset": offset, "items": items}
+
+
+@app.put("/api/jupyter/history/{port}")
+def set_port_tag(port: int, tag: str = ""):
+    """Set the tag remembered for port (empty = Untagged)."""
+    return get_history().set_tag(port, tag.strip())
+
+
+@app.delete("/api/jupyter/history/{port}")
+def forget_port_history(port: int):
+    if not get_history().delete(port):
+        raise HTTPException(status_code=404, detail="Port not in history")
+    return {"status": "deleted", "port": port}
+
+
+# ------------------------
+# METRICS
+# ------------------------
+registry.register(Gauge(
+    "jupyter_instances_running", "Instances alive at the last sampling pass",
+    lambda: (resource_sampler.snapshot or {}).get("totals", {}).get("instances", 0),
+))
+registry.register(Gauge(
+    "jupyter_instances_parked", "Sessions parked (server stopped until the next request)",
+    lambda: sum(is_parked(info) for info in get_store().all().values()),
+))
+registry.register(Gauge(
+    "jupyter_password_hashes_pending", "Password hashes queued or running in this worker's hashing pool",
+    lambda: password_hasher.pending,
+))
+registry.register(Gauge(
+    "jupyter_ram_reserved_mb", "RAM committed to instances and in-flight launches (sum of memory limits)",
+    admission.committed_mb,
+))
+registry.register(Gauge(
+    "jupyter_ram_capacity_mb", "RAM admission will commit in total, overcommit included",
+    admission.capacity_mb,
+))
+registry.register(Gauge(
+    "jupyter_instance_oom_kills", "OOM kills inside each instance cgroup since launch",
+    lambda: {
+        (port,): (sample.get("cgroup") or {}).get("oom_kill", 0)
+        for port, sample in (resource_sampler.snapshot or {}).get("instances", {}).items()
+        if sample["alive"]
+    },
+    labels=("port",),
+))
+registry.register(Gauge(
+    "jupyter_ram_used_mb", "Measured RSS of all instance process trees, kernels included",
+    get_total_estimated_ram_usage_mb,
+))
+registry.register(Gauge(
+    "jupyter_host_ram_available_mb", "Host MemAvailable at the last sampling pass",
+    get_free_ram_mb,
+))
+registry.register(Gauge(
+    "jupyter_ports_free", "Ports the allocator can still hand out",
+    lambda: port_allocator.stats()["free"],
+))
+registry.register(Gauge(
+    "jupyter_warm_pool_ready", "Unclaimed warm pool servers",
+    lambda: len(warm_pool.warm_ports()),
+))
+registry.register(Gauge(
+    "jupyter_event_subscribers", "Clients connected to /api/jupyter/events",
+    lambda: event_bus.subscribers,
+))
+registry.register(Gauge(
+    "jupyter_launch_jobs_active", "Launch jobs queued or in progress",
+    lambda: len(launch_jobs.active()),
+))
+registry.register(Gauge(
+    "jupyter_node_schedulable", "1 if the node is healthy and not draining",
+    lambda: {(node.name,): int(node.healthy and not node.draining) for node in node_registry.nodes.values()},
+    labels=("node",),
+))
+registry.register(Gauge(
+    "jupyter_node_ram_headroom_mb", "RAM the node can still commit to new sessions, at its last poll",
+    lambda: {(node.name,): node.headroom_mb() for node in node_registry.nodes.values()},
+    labels=("node",),
+))
+
+
+@app.get("/api/metrics")
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+# ------------------------
+# EVENTS
+# ------------------------
+@app.get("/api/jupyter/events")
+async def instance_events(request: Request, last_event_id: Optional[int] = None, types: Optional[str] = None):
+    """
+    Server-sent events: launching, ready, launch_failed, expiring_soon,
+    expired, stopped, crashed and sample. Reconnecting clients resume after
+    Last-Event-ID (header, or ?last_event_id=); types=a,b filters.
+    """
+    header = request.headers.get("last-event-id", "")
+    if last_event_id is None and header.isdigit():
+        last_event_id = int(header)
+    wanted = set(types.split(",")) if types else None
+
+    async def stream():
+        async for event in event_bus.subscribe(last_event_id, wanted):
+            yield format_sse(event)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # nginx must not buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/jupyter/events/stats")
+def event_stats():
+    return event_bus.stats()
+
+
+# ------------------------
+# LAUNCH JOBS
+# ------------------------
+@app.get("/api/jupyter/jobs/{job_id}")
+async def get_launch_job(job_id: str, wait: float = 0):
+    """Launch job status. With wait>0, long-polls until the phase changes (max 60s)."""
+    job = launch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    await job.wait_for_change(min(wait, 60))
+    return job.to_dict()
+
+
+@app.get("/api/jupyter/jobs")
+async def list_launch_jobs():
+    return [job.to_dict() for job in launch_jobs.all()]
 
 
 # ------------------------
 # STOP JUPYTER
 # ------------------------
 @app.delete("/api/jupyter/{port}")
-def stop_jupyter(port: int):
-    data = load_state()
+async def stop_jupyter(port: int):
+    """
+    Stop the session: SIGTERM to its server and everything it started,
+    SIGKILL after JUPYTER_STOP_GRACE_SECONDS (api/procs.py). The answer says
+    how much RSS that freed and whether the port is free again.
+    """
+    store = get_store()
+    info = store.get(port)
 
-    if str(port) not in data:
+    if info is None:
         raise HTTPException(status_code=404, detail="Instance not found")
 
-    pid = data[str(port)]["pid"]
+    try:
+        report = await asyncio.get_running_loop().run_in_executor(None, stop_instance_process, port, info)
+    except (NodeUnavailable, AgentError) as e:
+        raise HTTPException(status_code=502, detail=f"Could not stop the server: {e}")
+
+    forget_instance(port)
+    stops_total.inc()
+    event_bus.publish("stopped", port=port, reason="api", tag=info.get("tag"), **stop_summary(report))
+
+    return {"status": "stopped", "port": port, **stop_summary(report)}
+
+
+# ------------------------
+# PARKING
+# ------------------------
+# A parked session keeps its state entry (port, password and its hash,
+# deadline, notebooks) but not its server: the pid is dropped and the
+# process stopped, so it holds no RAM and admission doesn't count it. The
+# first request through nginx to /jupyter/<port>/ finds nothing listening
+# and nginx hands it to /api/jupyter/<port>/wake (error_page 502, see
+# nginx.conf), which restarts the server on the same port, holds the
+# request until it is up and sends the client back where it was going.
+# Only sessions on this host can be parked.
+WAKE_TIMEOUT_SECONDS = 90
+WAKE_POLL_SECONDS = 0.25
+
+
+def session_state(info):
+    """running, parked, or waking (parked, its server being restarted)."""
+    if not is_parked(info):
+        return "running"
+    return "waking" if info.get("waking") else "parked"
+
+
+def park_instance(port, info, reason):
+    """Stop a session's server but keep the session (blocking)."""
+    # Drop the pid first, so the sampler doesn't take the stopped server for a crash
+    get_store().update(port, pid=None, parked={"at": time.time(), "reason": reason})
+    # Kernels included: a parked session holds no RAM at all
+    record_stop(port, stop_process_tree(info["pid"], port))
+    print(f"Parked session on port {port} ({reason})")
+    event_bus.publish("parked", port=int(port), reason=reason, tag=info.get("tag"))
+
+
+async def park_idle_instance(port):
+    info = get_store().get(port)
+    if info is None or is_parked(info):
+        return
+    if not is_local(info):
+        await stop_idle_instance(port)   # parking needs the server's host
+        return
+    await asyncio.get_running_loop().run_in_executor(None, park_instance, port, info, "idle")
 
+
+async def restart_parked(job, port, info):
+    """Launch job of a wake: the parked session's server again, with everything it had."""
+    store = get_store()
+    try:
+        job.set_phase("provisioning")
+        admission.reserve(port, info["limits"]["memory_mb"])
+        try:
+            password_hash = info.get("password_hash") or await hash_password(info["password"])
+            _, pid = await run_start_script(
+                job,
+                start_script_argv(
+                    START_SCRIPT, info["password"], password_hash, info["expires_at"], port,
+                    info["limits"], info["api_token"], info.get("template"),
+                ),
+                timeout=60,
+            )
+        finally:
+            admission.release(port)
+    except BaseException as e:
+        store.update(port, waking=None)
+        wakes_total.inc(result="failed")
+        event_bus.publish("wake_failed", port=int(port), job_id=job.id, error=str(e))
+        if isinstance(e, AdmissionDenied):
+            raise LaunchError(str(e))
+        raise
+    # The launcher wrote the entry from scratch; put the rest of the session back
+    kept = {k: v for k, v in info.items() if k not in ("pid", "parked", "waking")}
+    store.update(port, **{**kept, "password_hash": password_hash, "parked": None, "waking": None})
+    wakes_total.inc(result="woken")
+    print(f"Woke session on port {port} in {job.timings.get('readiness')} ms")
+    event_bus.publish("woken", port=int(port), pid=pid, job_id=job.id, tag=info.get("tag"), readiness_ms=job.timings.get("readiness"))
+    return {"status": "woken", "port": int(port), "pid": pid}
+
+
+async def wake_instance(port):
+    """
+    Restart a parked session's server and wait until it is up. Whichever
+    worker marks the entry waking first runs the launch; concurrent wakes
+    wait for the entry to get its pid back. Returns the entry; LaunchError
+    if the server couldn't be started.
+    """
+    store = get_store()
+    stale = time.time() - WAKE_TIMEOUT_SECONDS   # a worker died mid-wake
+    claimed = store.claim(
+        lambda p, i: int(p) == int(port) and is_parked(i) and (i.get("waking") or 0) < stale,
+        waking=time.time(),
+    )
+    if claimed is not None:
+        job = launch_jobs.submit(lambda job: restart_parked(job, port, claimed[1]), params={"user_port": port, "wake": True})
+        await job.wait_done()
+        if job.phase == "failed":
+            raise LaunchError(job.error)
+    deadline = time.time() + WAKE_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        info = store.get(port)
+        if info is None:
+            raise LaunchError("The session ended while waking")
+        if not is_parked(info):
+            return info
+        if not info.get("waking"):
+            raise LaunchError("Restarting the server failed")
+        await asyncio.sleep(WAKE_POLL_SECONDS)
+    raise LaunchError(f"Server not up after {WAKE_TIMEOUT_SECONDS}s")
+
+
+@app.post("/api/jupyter/{port}/park")
+async def park_jupyter(port: int):
+    """Stop the session's server until it is next used; port, password, deadline and notebooks stay."""
+    info = get_store().get(port)
+    if info is None or is_warm(info):
+        raise HTTPException(status_code=404, detail="Instance not found")
+    if not is_local(info):
+        raise HTTPException(status_code=409, detail="Only sessions on this host can be parked")
+    if is_parked(info):
+        raise HTTPException(status_code=409, detail="Already parked")
+    await asyncio.get_running_loop().run_in_executor(None, park_instance, port, info, "api")
+    return {"status": "parked", "port": port}
+
+
+@app.api_route("/api/jupyter/{port}/wake", methods=["GET", "POST"])
+async def wake_jupyter(port: int, request: Request):
+    """
+    Restart a parked session and wait until it is up. Requests nginx sends
+    here (X-Original-URI set) get a 307 back to that URI once the server is
+    up, or the 502 they would have got if the session isn't parked.
+    """
+    original_uri = request.headers.get("x-original-uri")
+    info = get_store().get(port)
+    if info is None or is_warm(info) or not is_parked(info):
+        if original_uri is not None:
+            raise HTTPException(status_code=502, detail=f"Nothing is answering on port {port}")
+        if info is None or is_warm(info):
+            raise HTTPException(status_code=404, detail="Instance not found")
+        return {"status": "running", "port": port}
     try:
-        os.kill(pid, signal.SIGTERM)
-    except:
-        pass
+        info = await wake_instance(port)
+    except LaunchError as e:
+        raise HTTPException(status_code=503, detail=f"Could not wake the session: {e}", headers={"Retry-After": "10"})
+    # Only ever back into this session
+    if original_uri is not None and original_uri.startswith(f"/jupyter/{port}/"):
+        return RedirectResponse(original_uri, status_code=307)
+    return {"status": "woken", "port": port, "pid": info["pid"]}
+
+
+# ------------------------
+# SESSION TTL
+# ------------------------
+@app.post("/api/jupyter/{port}/ttl")
+def update_ttl(port: int, session_minutes: Optional[int] = None, extend_minutes: Optional[int] = None, disable_timer: bool = False):
+    """
+    Change a live session's deadline: session_minutes sets it relative to now,
+    extend_minutes moves it (negative shortens), disable_timer removes it.
+    """
+    if sum([session_minutes is not None, extend_minutes is not None, disable_timer]) != 1:
+        raise HTTPException(status_code=400, detail="Give exactly one of session_minutes, extend_minutes, disable_timer")
+
+    store = get_store()
+    info = store.get(port)
+    if info is None or is_warm(info):
+        raise HTTPException(status_code=404, detail="Instance not found")
+
+    now = datetime.now(timezone.utc)
+    if disable_timer:
+        expires_at = now + timedelta(days=365 * 100)
+    elif session_minutes is not None:
+        expires_at = now + timedelta(minutes=session_minutes)
+    else:
+        current = parse_expires_at(info.get("expires_at"))
+        if current is None:
+            raise HTTPException(status_code=409, detail="Session has no timer to extend")
+        expires_at = datetime.fromtimestamp(current, timezone.utc) + timedelta(minutes=extend_minutes)
+
+    store.update(port, expires_at=expires_at.isoformat())
+    expiry_scheduler.schedule(port, expires_at.isoformat())
+
+    return {
+        "status": "updated",
+        "port": port,
+        "expires_at": expires_at.isoformat() if not disable_timer else None,
+    }
+
 
-    del data[str(port)]
-    save_state(data)
+@app.get("/api/jupyter/stats")
+def fleet_stats():
+    """Last sampling pass over every instance"""
+    return resource_sampler.snapshot or {"sampled_at": None, "instances": {}}
 
-    return {"status": "stopped", "port": port}
+
+@app.get("/api/jupyter/{port}/stats")
+def instance_stats(port: int):
+    info = get_store().get(port)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    return {
+        "port": port,
+        "node": info.get("node") or node_registry.local.name,
+        "current": instance_sample(port, info),
+        # Kept for sessions on this host only
+        "history": resource_sampler.instance_history(port),
+    }
+
+
+@app.get("/api/jupyter/scheduler")
+def scheduler_stats():
+    return expiry_scheduler.stats()
+
+
+@app.get("/api/jupyter/idle")
+def idle_stats():
+    """Last culling pass: per-instance activity, culled kernels and reclaimed RAM"""
+    return idle_culler.stats()
 
 
 # ------------------------
 # LIST JUPYTER
 # ------------------------
+try:
+    import orjson
+except ImportError:   # optional; the stdlib encoder is just slower
+    orjson = None
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+instance_index = InstanceIndex(get_store)
+
+INSTANCE_FIELDS = (
+    "port", "pid", "node", "started_at", "expires_at", "tag", "owner", "template", "state", "running",
+    "rss_mb", "kernels", "oom_kills", "idle_seconds", "url", "password",
+)
+# Passwords are only sent when asked for by name
+DEFAULT_INSTANCE_FIELDS = tuple(f for f in INSTANCE_FIELDS if f != "password")
+MAX_PAGE_SIZE = 1000
+
+
+def instance_entry(port, info, deadline, fields=DEFAULT_INSTANCE_FIELDS):
+    sample = instance_sample(port, info) or {}
+    entry = {
+        "port": int(port),
+        "pid": info.get("pid"),
+        "node": info.get("node") or node_registry.local.name,
+        "started_at": info["started_at"],
+        # deadline is None when the timer is disabled
+        "expires_at": info.get("expires_at") if deadline is not None else None,
+        "tag": info.get("tag"),
+        "owner": info.get("owner"),
+        "template": info.get("template"),
+        "state": session_state(info),
+        # Not sampled yet means it was started since the last pass
+        "running": sample.get("alive", True) and not is_parked(info),
+        "rss_mb": sample.get("rss_mb"),
+        "kernels": sample.get("kernels"),
+        "oom_kills": (sample.get("cgroup") or {}).get("oom_kill"),
+        "idle_seconds": idle_culler.idle_seconds(port),
+        "url": instance_url(port, info),
+        "password": info.get("password"),
+    }
+    return {f: entry[f] for f in fields}
+
+
+def parse_fields(fields):
+    if fields is None:
+        return DEFAULT_INSTANCE_FIELDS
+    wanted = tuple(f.strip() for f in fields.split(",") if f.strip())
+    unknown = [f for f in wanted if f not in INSTANCE_FIELDS]
+    if unknown or not wanted:
+        raise HTTPException(status_code=400, detail=f"fields: choose from {', '.join(INSTANCE_FIELDS)}")
+    return wanted
+
+
 @app.get("/api/jupyter")
-def list_jupyter():
-    cleanup_dead_and_expired()
-    data = load_state()
-
-    instances = []
-    for port, info in data.items():
-        expires_at_str = info.get("expires_at")
-        # Check if expiration is set to far future (timer disabled)
-        expires_at = None
-        if expires_at_str:
-            expires_at_dt = datetime.fromisoformat(expires_at_str)
-            years_until_expiry = (expires_at_dt - datetime.now(timezone.utc)).total_seconds() / (365.25 * 24 * 3600)
-            if years_until_expiry <= 50:
-                expires_at = expires_at_str
-        
-        instances.append({
-            "port": int(port),
-            "pid": info["pid"],
-            "started_at": info["started_at"],
-            "expires_at": expires_at,  # None if timer is disabled
-            "password": info.get("password"),
-            "running": is_running(info["pid"]),
-            "url": f"http://13.232.82.145:{port}",
-        })
+def list_jupyter(
+    request: Request,
+    since: Optional[int] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[int] = None,
+    running: Optional[bool] = None,
+    state: Optional[str] = None,
+    expiring_within: Optional[int] = None,
+    tag: Optional[str] = None,
+    owner: Optional[str] = None,
+    node: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """
+    Sessions, in port order, served from the in-memory index.
+
+    Filters: running, state (running, parked, waking), expiring_within
+    (minutes), tag, owner, node. fields= picks
+    the keys of each entry (password only when named). With limit, pages
+    continue from the X-Next-Cursor header (pass it as cursor=); the
+    header is absent on the last page.
+
+    The ETag changes with the state version and with each sampling /
+    culling pass, so If-None-Match gets a 304 while nothing moved.
+
+    With since=<version> (the X-State-Version of an earlier response) only
+    sessions written since then are returned, plus the ports that went away:
+    {"version", "full": false, "changed": [...], "deleted": [...]}. "full":
+    true with "instances" means the delta wasn't available.
+    """
+    wanted = parse_fields(fields)
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be 1-{MAX_PAGE_SIZE}")
+    filtered = any(v is not None for v in (limit, cursor, running, state, expiring_within, tag, owner, node))
+    if since is not None and filtered:
+        raise HTTPException(status_code=400, detail="since can't be combined with filters or pagination")
+
+    version = instance_index.refresh()
+    if since is None:
+        query = zlib.crc32(str(request.query_params).encode())
+        etag = f'W/"{version}-{(resource_sampler.snapshot or {}).get("sampled_at")}-{idle_culler.last_pass}-{query:x}"'
+    else:
+        # Deltas only carry state; sampled fields are as of the time of the change.
+        # since itself is left out, so "nothing after the version I hold" is a 304.
+        query = zlib.crc32(",".join(wanted).encode())
+        etag = f'W/"{version}-{query:x}"'
+    headers = {"ETag": etag, "X-State-Version": str(version)}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    if since is None:
+        now = time.time()
+
+        def matches(entry):
+            info = entry["info"]
+            if is_warm(info):
+                return False
+            if tag is not None and info.get("tag") != tag:
+                return False
+            if owner is not None and info.get("owner") != owner:
+                return False
+            if node is not None and (info.get("node") or node_registry.local.name) != node:
+                return False
+            if state is not None and session_state(info) != state:
+                return False
+            if expiring_within is not None and (entry["deadline"] is None or entry["deadline"] - now > expiring_within * 60):
+                return False
+            alive = (instance_sample(entry["port"], info) or {}).get("alive", True) and not is_parked(info)
+            if running is not None and alive != running:
+                return False
+            return True
+
+        entries, next_cursor = instance_index.page(matches, cursor, limit)
+        if next_cursor is not None:
+            headers["X-Next-Cursor"] = str(next_cursor)
+            headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+        return FastJSONResponse(
+            [instance_entry(e["port"], e["info"], e["deadline"], wanted) for e in entries],
+            headers=headers,
+        )
+
+    changes = get_store().changes_since(since)
+    if changes is None:
+        entries, _ = instance_index.page(lambda e: not is_warm(e["info"]))
+        return FastJSONResponse({
+            "version": version,
+            "full": True,
+            "instances": [instance_entry(e["port"], e["info"], e["deadline"], wanted) for e in entries],
+        }, headers=headers)
+    version, changed, deleted = changes
+    headers.update({"ETag": f'W/"{version}-{query:x}"', "X-State-Version": str(version)})
+    return FastJSONResponse({
+        "version": version,
+        "full": False,
+        # A claimed warm server shows up as changed; one still warm is not a session
+        "changed": [
+            instance_entry(port, info, parse_expires_at(info.get("expires_at")), wanted)
+            for port, info in changed.items() if not is_warm(info)
+        ],
+        "deleted": [int(port) for port in deleted]
+            + [int(port) for port, info in changed.items() if is_warm(info)],
+    }, headers=headers)
+
+
+# Declared last: /api/jupyter/<word> routes above must match first
+@app.get("/api/jupyter/{port}")
+def get_jupyter(port: int, fields: Optional[str] = None):
+    entry = instance_index.get(port)
+    if entry is None or is_warm(entry["info"]):
+        raise HTTPException(status_code=404, detail="Instance not found")
+    return FastJSONResponse(instance_entry(port, entry["info"], entry["deadline"], parse_fields(fields)))
+
+
+# ------------------------
+# INSTANCE LOGS
+# ------------------------
+LOG_FOLLOW_POLL_SECONDS = 0.5
+
+
+def read_instance_log(port, info, offset, length, backup=0, whole_lines=False):
+    """read_log() of a session's jupyter.log, here or through its node's agent (api/logs.py)."""
+    if not is_local(info):
+        node = node_registry.get(info["node"])
+        if node is None:
+            raise NodeUnavailable(f"Node {info['node']} is not configured")
+        return node.logs(port, offset, length, backup, whole_lines)
+    return read_log(log_path(info["path"], backup), offset, length, whole_lines)
+
+
+@app.get("/api/jupyter/{port}/logs")
+async def get_jupyter_logs(
+    port: int,
+    offset: Optional[int] = None,
+    length: int = LOG_READ_BYTES,
+    backup: int = 0,
+    follow: bool = False,
+):
+    """
+    A byte range of the session's jupyter.log: length bytes from offset, or
+    the last length bytes (a negative offset counts from the end); read on
+    from next_offset. backup=N reads the N-th rotated copy. With follow=true
+    the response is NDJSON, one read per batch of new lines, until the
+    session ends.
+    """
+    info = get_store().get(port)
+    if info is None or is_warm(info):
+        raise HTTPException(status_code=404, detail="Instance not found")
+    if length < 1 or not 0 <= backup <= LOG_BACKUPS or (follow and backup):
+        raise HTTPException(status_code=400, detail=f"length >= 1, 0 <= backup <= {LOG_BACKUPS}, no backup with follow")
+    loop = asyncio.get_running_loop()
+
+    async def read(offset):
+        try:
+            chunk = await loop.run_in_executor(None, read_instance_log, port, info, offset, length, backup, follow)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="No log for this instance")
+        except NodeUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except AgentError as e:
+            raise HTTPException(status_code=e.status, detail=str(e))
+        return {"port": port, **chunk}
+
+    chunk = await read(offset)
+    if not follow:
+        return chunk
+
+    async def lines():
+        current = chunk
+        while True:
+            if current["data"] or current["rotated"]:
+                yield json.dumps(current) + "\n"
+            if current["next_offset"] >= current["size"]:
+                await asyncio.sleep(LOG_FOLLOW_POLL_SECONDS)
+            if (get_store().get(port) or {}).get("pid") != info.get("pid"):
+                return   # stopped, or the port went to another session
+            try:
+                current = await read(current["next_offset"])
+            except HTTPException:
+                return
 
-    return JSONResponse(instances)
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
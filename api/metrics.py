@@ -0,0 +1,272 @@
+"""
+Prometheus metrics.
+
+A small registry that renders the Prometheus text exposition format
+(version 0.0.4) without extra dependencies. Counters and histograms are
+updated on the request path; gauges are callbacks evaluated at scrape
+time, so they always reflect the sampler / allocator / state store.
+
+With several backend workers (api/workers.py) a scrape reaches only one
+of them, so each worker writes its counters and histograms to the
+metric_values table (flush(), on every scrape and periodically) and a
+scrape renders the sum over all workers. Rows of workers that have exited
+are folded into one "retired" row, so totals never go backwards.
+"""
+import bisect, json, os, sqlite3, threading, time
+
+from api.procs import is_running
+from api.state import STATE_DB
+from api.workers import SHARED
+
+# Launch steps range from milliseconds (state write) to tens of seconds (cold spawn)
+LAUNCH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+# Waiting for the state store's write lock: microseconds when idle, seconds under heavy contention
+LOCK_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _fmt(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def render(self, values=None):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        items = sorted((values if values is not None else self.values()).items())
+        for key, value in items:
+            yield f"{self.name}{_labels(self.label_names, key)} {_fmt(value)}"
+
+
+class Gauge:
+    def __init__(self, name, help, callback, labels=()):
+        """callback() returns a number, or {label_values_tuple: number} when labels are set"""
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.callback = callback
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        value = self.callback()
+        if self.label_names:
+            for key, v in sorted(value.items()):
+                yield f"{self.name}{_labels(self.label_names, key)} {_fmt(v)}"
+        else:
+            yield f"{self.name} {_fmt(value)}"
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LAUNCH_BUCKETS):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}   # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def values(self):
+        with self._lock:
+            return {k: list(v) for k, v in self._series.items()}
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def render(self, values=None):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        items = sorted((values if values is not None else self.values()).items())
+        for key, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                yield f"{self.name}_bucket{_labels(self.label_names + ('le',), key + (_fmt(bound),))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(self.label_names + ('le',), key + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {_fmt(series[-2])}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {series[-1]}"
+
+
+class Registry:
+    def __init__(self, db_path=None):
+        """db_path: SQLite database to sum counters and histograms of all workers through"""
+        self.metrics = []
+        self.db_path = db_path
+        # A pid alone could be reused by a later worker and overwrite its predecessor's totals
+        self.worker = f"{os.getpid()}-{int(time.time())}"
+        self._local = threading.local()
+        if db_path is not None:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._conn().executescript("""
+                CREATE TABLE IF NOT EXISTS metric_values (
+                    worker  TEXT NOT NULL,    -- "<pid>-<start time>", or "retired"
+                    name    TEXT NOT NULL,
+                    labels  TEXT NOT NULL,    -- JSON list of label values
+                    value   TEXT NOT NULL,    -- JSON number (counter) or list (histogram)
+                    PRIMARY KEY (worker, name, labels)
+                );
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def _accumulated(self):
+        return [m for m in self.metrics if isinstance(m, (Counter, Histogram))]
+
+    def flush(self):
+        """Write this worker's counters and histograms; fold in those of exited workers."""
+        if self.db_path is None:
+            return
+        rows = [
+            (self.worker, metric.name, json.dumps(key), json.dumps(value))
+            for metric in self._accumulated() for key, value in metric.values().items()
+        ]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO metric_values VALUES (?, ?, ?, ?)", rows)
+            workers = [w for (w,) in conn.execute("SELECT DISTINCT worker FROM metric_values WHERE worker != 'retired'")]
+            exited = [w for w in workers if w != self.worker and not is_running(int(w.split("-")[0]))]
+            if exited:
+                self._retire(conn, exited)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _retire(self, conn, workers):
+        merge = {m.name: m.merge for m in self._accumulated()}
+        marks = ",".join("?" * len(workers))
+        retired = {}
+        for name, labels, value in conn.execute(
+            f"SELECT name, labels, value FROM metric_values WHERE worker IN ('retired', {marks})", workers
+        ):
+            if name not in merge:
+                continue
+            key = (name, labels)
+            value = json.loads(value)
+            retired[key] = merge[name](retired[key], value) if key in retired else value
+        conn.execute(f"DELETE FROM metric_values WHERE worker IN ('retired', {marks})", workers)
+        conn.executemany(
+            "INSERT INTO metric_values VALUES ('retired', ?, ?, ?)",
+            [(name, labels, json.dumps(value)) for (name, labels), value in retired.items()],
+        )
+
+    def _merged(self):
+        """name -> {label values: value summed over every worker}"""
+        merge = {m.name: m.merge for m in self._accumulated()}
+        merged = {}
+        for name, labels, value in self._conn().execute("SELECT name, labels, value FROM metric_values"):
+            if name not in merge:
+                continue
+            series = merged.setdefault(name, {})
+            key, value = tuple(json.loads(labels)), json.loads(value)
+            series[key] = merge[name](series[key], value) if key in series else value
+        return merged
+
+    def render(self):
+        lines = []
+        merged = None
+        if self.db_path is not None:
+            self.flush()
+            merged = self._merged()
+        for metric in self.metrics:
+            try:
+                if merged is not None and isinstance(metric, (Counter, Histogram)):
+                    lines.extend(metric.render(merged.get(metric.name, {})))
+                else:
+                    lines.extend(metric.render())
+            except Exception as e:
+                # One broken gauge callback must not take the whole scrape down
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(db_path=STATE_DB if SHARED else None)
+
+launch_phase_seconds = registry.register(Histogram(
+    "jupyter_launch_phase_seconds",
+    "Duration of each launch step (queue, password_hash, provision, seed, spawn, readiness, state_write, total)",
+    labels=("phase",),
+))
+launches_total = registry.register(Counter(
+    "jupyter_launches_total", "Launch attempts by outcome (started, warm, failed)", labels=("result",),
+))
+expiries_total = registry.register(Counter(
+    "jupyter_expiries_total", "Sessions terminated by the expiry scheduler",
+))
+stops_total = registry.register(Counter(
+    "jupyter_stops_total", "Sessions stopped through the API",
+))
+stop_escalations_total = registry.register(Counter(
+    "jupyter_stop_escalations_total", "Server stops that had to SIGKILL processes still running after the grace period",
+))
+stop_freed_mb_total = registry.register(Counter(
+    "jupyter_stop_freed_mb_total", "RSS of the processes of stopped servers, measured right before each stop",
+))
+orphans_stopped_total = registry.register(Counter(
+    "jupyter_orphans_stopped_total", "Processes of jupyter-<port> users no session accounted for, stopped by the sweep",
+))
+idle_kernels_culled_total = registry.register(Counter(
+    "jupyter_idle_kernels_culled_total", "Idle kernels shut down by the culler",
+))
+idle_servers_stopped_total = registry.register(Counter(
+    "jupyter_idle_servers_stopped_total", "Idle sessions stopped by the culler",
+))
+idle_servers_parked_total = registry.register(Counter(
+    "jupyter_idle_servers_parked_total", "Idle sessions parked by the culler",
+))
+idle_reclaimed_mb_total = registry.register(Counter(
+    "jupyter_idle_reclaimed_mb_total", "RSS freed by idle culling, measured right before each shutdown",
+))
+wakes_total = registry.register(Counter(
+    "jupyter_wakes_total", "Parked sessions restarted, by outcome (woken, failed)", labels=("result",),
+))
+log_rotations_total = registry.register(Counter(
+    "jupyter_log_rotations_total", "Instance logs rotated for going over JUPYTER_LOG_MAX_BYTES",
+))
+state_lock_wait_seconds = registry.register(Histogram(
+    "jupyter_state_lock_wait_seconds", "Time state store write transactions waited for the lock",
+    buckets=LOCK_WAIT_BUCKETS,
+))
@@ -0,0 +1,321 @@
+"""
+Nodes sessions can run on, and where a new one goes.
+
+The backend's own host is the local node. Every other host runs a node
+agent (api/agent.py) and is listed in JUPYTER_NODES:
+
+    JUPYTER_NODES="node-2=http://10.0.0.12:8100,node-3=http://10.0.0.13:8100"
+
+Every NODE_POLL_SECONDS each agent is asked for /health (its port range,
+free ports, RAM headroom and the last sample of its servers). After
+NODE_UNHEALTHY_AFTER failed polls in a row a node is unhealthy and gets no
+new sessions until a poll succeeds again. A draining node gets no new
+sessions either but keeps the ones it has until they end. Port ranges must
+not overlap, since sessions are keyed by port; a node whose range overlaps
+another's is kept unhealthy.
+
+A new session goes to the healthy, non-draining node with the most RAM
+headroom (capacity minus committed reservations, from its admission
+controller) that has a free port, or that owns the requested port. Each
+placement is deducted from the node's figures until its next poll, so a
+burst spreads over the nodes instead of piling onto the emptiest one.
+
+With JUPYTER_NODES unset there is only the local node and everything runs
+on this host as before.
+"""
+import asyncio, json, os, threading, time, urllib.error, urllib.request
+from urllib.parse import urlencode, urlparse
+
+NODES = os.environ.get("JUPYTER_NODES", "")
+LOCAL_NODE = os.environ.get("JUPYTER_NODE_NAME", "local")
+AGENT_TOKEN = os.environ.get("JUPYTER_AGENT_TOKEN", "")
+DRAIN_LOCAL = os.environ.get("JUPYTER_DRAIN_LOCAL", "0") == "1"   # agents only, no sessions here
+NODE_POLL_SECONDS = 5
+NODE_UNHEALTHY_AFTER = 3
+REQUEST_TIMEOUT_SECONDS = 5
+LAUNCH_TIMEOUT_SECONDS = 90   # the agent's launcher timeout plus slack
+STOP_TIMEOUT_SECONDS = 60     # a graceful stop's grace period, SIGKILL and port wait, plus slack
+
+
+class NodeUnavailable(Exception):
+    pass
+
+
+class AgentError(Exception):
+    """The agent answered with an error status."""
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+
+
+def parse_nodes(spec):
+    """[(name, url)] from "name=http://host:port,..."."""
+    nodes = []
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, sep, url = item.partition("=")
+        if not sep or not name.strip() or not url.strip().startswith(("http://", "https://")):
+            raise ValueError(f"JUPYTER_NODES entry {item!r} is not name=http://host:port")
+        nodes.append((name.strip(), url.strip().rstrip("/")))
+    return nodes
+
+
+class Node:
+    local = False
+
+    def __init__(self, name, draining=False):
+        self.name = name
+        self.draining = draining
+        self.healthy = False
+        self.error = None
+        self.failures = 0
+        self.last_seen = None
+        self.health = {}
+        self._placed_mb = 0      # placed here since the last poll
+        self._placed_ports = 0
+
+    @property
+    def host(self):
+        raise NotImplementedError
+
+    @property
+    def port_range(self):
+        bounds = self.health.get("ports", {}).get("range")
+        return range(bounds[0], bounds[1] + 1) if bounds else range(0)
+
+    def owns_port(self, port):
+        return int(port) in self.port_range
+
+    def headroom_mb(self):
+        return self.health.get("ram", {}).get("headroom_mb", 0) - self._placed_mb
+
+    def ports_free(self):
+        return self.health.get("ports", {}).get("free", 0) - self._placed_ports
+
+    def can_host(self, memory_mb, port=None):
+        if not self.healthy or self.draining:
+            return False
+        has_port = self.owns_port(port) if port is not None else self.ports_free() > 0
+        return has_port and self.headroom_mb() >= memory_mb
+
+    def placed(self, memory_mb):
+        self._placed_mb += memory_mb
+        self._placed_ports += 1
+
+    def _polled(self, health):
+        self.health = health
+        self.last_seen = time.time()
+        self._placed_mb = self._placed_ports = 0
+
+    def to_dict(self):
+        ports = self.health.get("ports", {})
+        return {
+            "name": self.name,
+            "local": self.local,
+            "host": self.host,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "error": self.error,
+            "last_seen": self.last_seen,
+            "port_range": ports.get("range"),
+            "ports_free": ports.get("free"),
+            "ram": self.health.get("ram"),
+        }
+
+
+class LocalNode(Node):
+    """This host; status() reports it in the shape of an agent's /health."""
+    local = True
+
+    def __init__(self, name, status, public_host, draining=False):
+        super().__init__(name, draining)
+        self.status = status
+        self.public_host = public_host
+
+    @property
+    def host(self):
+        return self.public_host
+
+    def poll(self):
+        health = self.status()
+        self.healthy = health.get("healthy", True)
+        self.error = None if self.healthy else health.get("error")
+        self._polled(health)
+        return health
+
+
+class RemoteNode(Node):
+    def __init__(self, name, url, token=AGENT_TOKEN, draining=False):
+        super().__init__(name, draining)
+        self.url = url
+        self.token = token
+
+    @property
+    def host(self):
+        return self.health.get("public_host") or urlparse(self.url).hostname
+
+    def _call(self, method, path, body=None, timeout=REQUEST_TIMEOUT_SECONDS):
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["X-Agent-Token"] = self.token
+        req = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(body).encode() if body is not None else None,
+            method=method,
+            headers=headers,
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                return json.loads(resp.read() or b"null")
+        except urllib.error.HTTPError as e:
+            try:
+                detail = json.loads(e.read()).get("detail")
+            except (ValueError, AttributeError):
+                detail = None
+            raise AgentError(e.code, detail or f"HTTP {e.code}")
+        except (OSError, ValueError) as e:
+            raise NodeUnavailable(f"Node {self.name} unreachable: {e}")
+
+    def poll(self):
+        """Fetch /health; returns it, or None if the agent didn't answer."""
+        try:
+            health = self._call("GET", "/health")
+        except (AgentError, NodeUnavailable) as e:
+            self.failures += 1
+            self.error = str(e)
+            if self.healthy and self.failures >= NODE_UNHEALTHY_AFTER:
+                print(f"Node {self.name} is unhealthy: {e}")
+                self.healthy = False
+            return None
+        if not self.healthy:
+            print(f"Node {self.name} is up ({self.url})")
+        self.healthy, self.failures, self.error = True, 0, None
+        self._polled(health)
+        return health
+
+    def launch(self, spec):
+        """POST /launch (blocking); {"port", "pid", "cgroup", "timings"}."""
+        return self._call("POST", "/launch", spec, timeout=LAUNCH_TIMEOUT_SECONDS)
+
+    def stop(self, port):
+        """POST /stop (blocking); the stop report (api/procs.py), None if it was already gone."""
+        try:
+            return self._call("POST", f"/stop/{int(port)}", timeout=STOP_TIMEOUT_SECONDS)
+        except AgentError as e:
+            if e.status != 404:   # already gone
+                raise
+            return None
+
+    def logs(self, port, offset, length, backup=0, whole_lines=False):
+        """read_log() of a server's jupyter.log on this node (api/logs.py)."""
+        query = {"length": length, "backup": backup, "whole_lines": str(whole_lines).lower()}
+        if offset is not None:
+            query["offset"] = offset
+        return self._call("GET", f"/logs/{int(port)}?{urlencode(query)}")
+
+    def sample(self, port):
+        """The agent's last sample of port, or None."""
+        return self.health.get("instances", {}).get(str(port))
+
+    def to_dict(self):
+        return {**super().to_dict(), "url": self.url, "failures": self.failures}
+
+
+class NodeRegistry:
+    def __init__(self, local, remotes=(), on_health=None, interval=NODE_POLL_SECONDS):
+        """
+        on_health(node, health, polled_at): after each successful poll of a
+        remote node (in a worker thread); polled_at is when the request went out
+        """
+        self.local = local
+        self.nodes = {local.name: local}
+        for node in remotes:
+            if node.name in self.nodes:
+                raise ValueError(f"Duplicate node name {node.name!r}")
+            self.nodes[node.name] = node
+        self.on_health = on_health
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._task = None
+
+    @property
+    def remotes(self):
+        return [node for node in self.nodes.values() if not node.local]
+
+    def get(self, name):
+        return self.nodes.get(name)
+
+    def place(self, memory_mb, port=None, prefer=None):
+        """
+        The node a new session of memory_mb goes to (on port, if given), or
+        NodeUnavailable. prefer wins whenever it is schedulable and owns the
+        port, regardless of headroom (e.g. this host, to hand out a warm server).
+        """
+        with self._lock:
+            if not self.remotes:
+                # Single host: admission on this host has the final word
+                if self.local.draining:
+                    raise NodeUnavailable(f"Node {self.local.name} is draining")
+                return self.local
+            if (
+                prefer is not None and prefer.healthy and not prefer.draining
+                and (port is None or prefer.owns_port(port))
+            ):
+                node = prefer
+            else:
+                candidates = [n for n in self.nodes.values() if n.can_host(memory_mb, port)]
+                if not candidates:
+                    if port is not None:
+                        owner = next((n for n in self.nodes.values() if n.owns_port(port)), None)
+                        if owner is None:
+                            raise NodeUnavailable(f"No node owns port {port}")
+                        state = "draining" if owner.draining else "unhealthy" if not owner.healthy else "full"
+                        raise NodeUnavailable(f"Port {port} is on node {owner.name}, which is {state}")
+                    raise NodeUnavailable(f"No node has a free port and {memory_mb} MB of headroom")
+                node = max(candidates, key=lambda n: (n.headroom_mb(), n.ports_free(), n.local))
+            node.placed(memory_mb)
+            return node
+
+    def _overlap(self, node):
+        for other in self.nodes.values():
+            if other is node or not other.port_range or not node.port_range:
+                continue
+            if max(node.port_range.start, other.port_range.start) < min(node.port_range.stop, other.port_range.stop):
+                return other
+        return None
+
+    def poll_node(self, node):
+        polled_at = time.time()
+        health = node.poll()
+        if health is None or node.local:
+            return
+        other = self._overlap(node)
+        if other is not None:
+            if node.healthy:
+                print(f"Node {node.name}: port range overlaps node {other.name}, not scheduling on it")
+            node.healthy = False
+            node.error = f"Port range overlaps node {other.name}"
+        if self.on_health is not None:
+            self.on_health(node, health, polled_at)
+
+    async def poll_once(self):
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(loop.run_in_executor(None, self.poll_node, node) for node in self.nodes.values()),
+            return_exceptions=True,
+        )
+        for node, result in zip(self.nodes.values(), results):
+            if isinstance(result, Exception):
+                print(f"Polling node {node.name} failed: {result}")
+
+    async def run(self):
+        while True:
+            await self.poll_once()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.local.poll()
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def status(self):
+        return [node.to_dict() for node in self.nodes.values()]
@@ -0,0 +1,118 @@
+"""
+Warm pool of pre-spawned Jupyter servers.
+
+WARM_POOL_SIZE servers are kept running on the reserved WARM_POOL_PORTS
+range with a throwaway password nobody knows. Claiming one re-keys it
+(writes the new hash to <instance>/.jupyter_password_hash, which
+api.jupyter_auth picks up on the next login), sets its TTL and hands it
+over, which takes milliseconds instead of a full launch.
+
+Warm servers are ordinary state entries tagged pool="warm"; claiming drops
+the tag. The refiller only spawns while RAM headroom allows another
+reserved instance under admission control (api/admission.py).
+"""
+import asyncio, os
+
+from api.ports import PortUnavailable, parse_port_range
+from api.state import get_store
+
+WARM_POOL_SIZE = int(os.environ.get("JUPYTER_WARM_POOL_SIZE", "0"))
+WARM_POOL_PORTS = os.environ.get("JUPYTER_WARM_POOL_PORTS", "9090-9100")
+WARM_POOL_REFILL_SECONDS = 10
+PASSWORD_FILE_NAME = ".jupyter_password_hash"
+
+
+def is_warm(info):
+    return info.get("pool") == "warm"
+
+
+def write_password_hash(instance_dir, password_hash):
+    """Atomically replace the re-key file read by RekeyablePasswordIdentityProvider."""
+    path = os.path.join(instance_dir, PASSWORD_FILE_NAME)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(password_hash)
+    # Readable by the instance user through the shared jupyter-admins group
+    os.chmod(tmp, 0o640)
+    os.replace(tmp, path)
+
+
+class WarmPool:
+    def __init__(self, spawn, allocator, admit, is_alive,
+                 size=WARM_POOL_SIZE, ports=parse_port_range(WARM_POOL_PORTS)):
+        """
+        spawn(port): coroutine that launches a warm server on port and tags it
+        allocator: PortAllocator the pool reserves its ports from
+        admit(port): reserve RAM for a server on port; False if it doesn't fit
+        is_alive(pid): liveness check used before handing a server over
+        """
+        self.spawn = spawn
+        self.allocator = allocator
+        self.admit = admit
+        self.is_alive = is_alive
+        self.size = size
+        self.ports = ports
+        self.pending = set()
+        self._task = None
+
+    def warm_ports(self):
+        return sorted(int(port) for port, info in get_store().all().items() if is_warm(info))
+
+    def status(self):
+        return {
+            "target_size": self.size,
+            "port_range": [self.ports.start, self.ports.stop - 1],
+            "warm_ports": self.warm_ports(),
+            "pending_ports": sorted(self.pending),
+        }
+
+    def claim(self, user_port=None, **fields):
+        """Take a live warm server (on user_port, if given). Returns (port, info) or None."""
+        def available(port, info):
+            return (
+                is_warm(info)
+                and (user_port is None or int(port) == int(user_port))
+                # Seeded with the notebook template asked for (api/seeding.py)
+                and info.get("template") == fields.get("template")
+                and self.is_alive(info.get("pid"))
+            )
+        return get_store().claim(available, pool=None, **fields)
+
+    # ------------------------
+    # Refiller
+    # ------------------------
+    async def refill_once(self):
+        warm = len(self.warm_ports())
+        missing = self.size - warm - len(self.pending)
+
+        for _ in range(max(missing, 0)):
+            try:
+                port = self.allocator.reserve(owner="warm-pool", within=self.ports)
+            except PortUnavailable:
+                break
+            if not self.admit(port):
+                self.allocator.release(port)
+                print("Warm pool refill paused: not enough free RAM")
+                break
+            self.pending.add(port)
+            asyncio.get_running_loop().create_task(self._spawn(port))
+
+    async def _spawn(self, port):
+        try:
+            await self.spawn(port)
+        except Exception as e:
+            print(f"Warm pool spawn on port {port} failed: {e}")
+        finally:
+            self.pending.discard(port)
+
+    async def run(self):
+        while True:
+            try:
+                await self.refill_once()
+            except Exception as e:
+                print(f"Warm pool refill error: {e}")
+            await asyncio.sleep(WARM_POOL_REFILL_SECONDS)
+
+    def start(self):
+        if self.size > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
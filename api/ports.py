@@ -0,0 +1,189 @@
+"""
+In-process port allocator.
+
+Replaces the `seq | sort | ss | awk | sed | comm | head` pipeline that used
+to run in start_jupyter.sh on every launch. Free ports are tracked in a
+bitmap (bit i set = PORT_RANGE.start + i is free), so picking the lowest
+free port is a couple of integer operations, and a reservation is taken
+under a lock before the launcher ever runs, so simultaneous starts can no
+longer pick the same port.
+
+The bitmap is reconciled against the state store and the host's listening
+sockets at startup; after that, ports go back to the pool only through
+release() (stop, expiry, dead process or failed launch).
+
+With several backend workers (api/workers.py) each has its own bitmap, so
+a shared reservation table is passed in: reserve() then runs under the
+cross-worker launch lock and rebuilds the bitmap from the state store and
+every worker's reservations before picking.
+"""
+import os, socket, threading
+from contextlib import nullcontext
+
+import psutil
+
+PORT_RANGE = os.environ.get("JUPYTER_PORT_RANGE", "9000-9100")
+
+
+class PortUnavailable(Exception):
+    pass
+
+
+def parse_port_range(spec):
+    start, _, end = spec.partition("-")
+    return range(int(start), int(end or start) + 1)
+
+
+def listening_ports():
+    """Ports with a TCP listener on this host (reads /proc/net, no subprocess)."""
+    try:
+        conns = psutil.net_connections(kind="tcp")
+    except psutil.AccessDenied:
+        return set()
+    return {c.laddr.port for c in conns if c.status == psutil.CONN_LISTEN and c.laddr}
+
+
+def is_bindable(port):
+    """True if nothing is listening on port right now."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("0.0.0.0", port))
+        except OSError:
+            return False
+    return True
+
+
+class PortAllocator:
+    def __init__(self, ports=parse_port_range(PORT_RANGE), shared=None):
+        """shared: SharedReservations of all backend workers, or None for a single process"""
+        self.ports = ports
+        self.shared = shared
+        self._free = (1 << len(ports)) - 1
+        self._reserved = {}   # port -> owner, taken but not yet running
+        self._external = set()  # bound by something we don't manage
+        self._lock = threading.Lock()
+
+    def _bit(self, port):
+        return 1 << (port - self.ports.start)
+
+    def _mask(self, ports):
+        """Bitmask covering the part of `ports` that overlaps our range."""
+        lo = max(ports.start, self.ports.start)
+        hi = min(ports.stop, self.ports.stop)
+        if lo >= hi:
+            return 0
+        return ((1 << (hi - lo)) - 1) << (lo - self.ports.start)
+
+    def _launch_lock(self):
+        return self.shared.lock if self.shared is not None else nullcontext()
+
+    def _mark_used(self, ports):
+        # Caller holds self._lock
+        self._free = (1 << len(self.ports)) - 1
+        for port in ports:
+            if port in self.ports:
+                self._free &= ~self._bit(port)
+
+    def _sync(self):
+        """Pick up the ports other workers took or gave back (caller holds self._lock)."""
+        if self.shared is None:
+            return
+        # Something outside the service may have let go of its port by now
+        self._external = {port for port in self._external if not is_bindable(port)}
+        self._mark_used(self.shared.used_ports() | set(self._reserved) | self._external)
+
+    def reconcile(self, used_ports):
+        """Rebuild the bitmap from tracked ports plus live listeners."""
+        live = listening_ports()
+        used = set(map(int, used_ports))
+        if self.shared is not None:
+            used |= self.shared.used_ports()
+        with self._lock:
+            self._external = set()
+            self._mark_used(used | set(self._reserved))
+            for port in live:
+                if port in self.ports and self._free & self._bit(port):
+                    self._free &= ~self._bit(port)
+                    self._external.add(port)
+
+    def reserve(self, port=None, owner=None, within=None, exclude=None):
+        """
+        Reserve `port`, or the lowest free port (inside `within`, outside
+        `exclude`) when port is None. Raises PortUnavailable.
+        """
+        with self._launch_lock(), self._lock:
+            self._sync()
+            port = self._pick(port, owner, within, exclude)
+            if self.shared is not None:
+                self.shared.add(port)
+            return port
+
+    def _pick(self, port, owner, within, exclude):
+        # Caller holds self._lock
+        if port is not None:
+            port = int(port)
+            if port not in self.ports:
+                raise PortUnavailable(f"Port {port} is outside {self.ports.start}-{self.ports.stop - 1}")
+            if not self._free & self._bit(port):
+                raise PortUnavailable(f"Port {port} is already in use")
+            if not is_bindable(port):
+                self._free &= ~self._bit(port)
+                self._external.add(port)
+                raise PortUnavailable(f"Port {port} is already in use")
+            self._free &= ~self._bit(port)
+            self._reserved[port] = owner
+            return port
+
+        candidates = self._free
+        if within is not None:
+            candidates &= self._mask(within)
+        if exclude is not None:
+            candidates &= ~self._mask(exclude)
+        while candidates:
+            low = candidates & -candidates
+            candidates ^= low
+            self._free &= ~low
+            port = self.ports.start + low.bit_length() - 1
+            if is_bindable(port):
+                self._reserved[port] = owner
+                return port
+            # Someone outside the service grabbed it; keep it marked used
+            self._external.add(port)
+        raise PortUnavailable("No free ports")
+
+    def commit(self, port):
+        """The reserved port now belongs to a running instance."""
+        with self._lock:
+            self._reserved.pop(int(port), None)
+        if self.shared is not None:
+            self.shared.remove(port)
+
+    def release(self, port):
+        port = int(port)
+        if port not in self.ports:
+            return
+        with self._lock:
+            self._reserved.pop(port, None)
+            self._external.discard(port)
+            self._free |= self._bit(port)
+        if self.shared is not None:
+            self.shared.remove(port)
+
+    def is_free(self, port):
+        with self._lock:
+            self._sync()
+            return int(port) in self.ports and bool(self._free & self._bit(int(port)))
+
+    def stats(self):
+        with self._lock:
+            self._sync()
+            free = bin(self._free).count("1")
+            return {
+                "range": [self.ports.start, self.ports.stop - 1],
+                "total": len(self.ports),
+                "free": free,
+                "used": len(self.ports) - free,
+                "reserved": sorted(self._reserved),
+                "external": sorted(self._external),
+            }
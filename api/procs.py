@@ -0,0 +1,271 @@
+"""
+Process helpers shared by the backend and the node agent (api/agent.py).
+
+Jupyter servers run as their own jupyter-<port> user, so signalling one
+may need sudo.
+
+Stopping an instance (stop_process_tree) covers everything it runs: the
+server's process tree, plus whatever else is in its cgroup or runs as its
+user, e.g. kernels an earlier server on the same port left behind. The
+server gets SIGTERM first (on which Jupyter shuts its kernels down), then
+what is left of the rest; whatever still runs STOP_GRACE_SECONDS later is
+SIGKILLed. The report says how many processes there were, how many needed
+SIGKILL, the RSS they held, and whether the port was free afterwards.
+
+An OrphanSweeper on each host stops, every ORPHAN_SWEEP_SECONDS, the
+processes of jupyter-* users that no running session accounts for.
+
+    python3 -m api.procs stop PID [PORT]   # prints the report (stop_jupyter.sh)
+"""
+import asyncio, json, os, signal, subprocess, sys, time
+
+import psutil
+
+from api.cgroups import cgroup_path
+from api.ports import is_bindable
+
+USER_PREFIX = "jupyter-"   # keep in sync with provision_instance.sh
+STOP_GRACE_SECONDS = float(os.environ.get("JUPYTER_STOP_GRACE_SECONDS", "10"))
+STOP_KILL_SECONDS = 5        # wait after SIGKILL before reporting survivors
+PORT_RELEASE_SECONDS = 5
+STOP_POLL_SECONDS = 0.1
+ORPHAN_SWEEP_SECONDS = int(os.environ.get("JUPYTER_ORPHAN_SWEEP_SECONDS", "300"))
+ORPHAN_MIN_AGE_SECONDS = 120   # longer than any launch: a server being started isn't tracked yet
+_MB = 1024 * 1024
+
+
+def is_running(pid: int) -> bool:
+    """Check if process is running, works across users"""
+    try:
+        # Try using psutil first (works across users)
+        psutil.Process(pid)
+        return True
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        # Fallback to os.kill (may fail for different users)
+        try:
+            os.kill(pid, 0)
+            return True
+        except (OSError, ProcessLookupError):
+            return False
+
+
+def signal_processes(pids, sig=signal.SIGTERM):
+    """Signal pids; those of other users (jupyter-<port>) in one sudo kill."""
+    denied = []
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass  # Process already dead
+        except PermissionError:
+            denied.append(pid)
+    if denied:
+        subprocess.run(["sudo", "kill", f"-{int(sig)}", *map(str, denied)], capture_output=True)
+
+
+def kill_instance(pid, sig=signal.SIGTERM):
+    """Signal a Jupyter server; it runs as jupyter-<port>, so fall back to sudo"""
+    signal_processes([pid], sig)
+
+
+def instance_user(port):
+    return f"{USER_PREFIX}{int(port)}"
+
+
+def _user_port(username):
+    """port of a jupyter-<port> user name, else None."""
+    suffix = (username or "")[len(USER_PREFIX):]
+    return int(suffix) if (username or "").startswith(USER_PREFIX) and suffix.isdigit() else None
+
+
+def process_tree(pid):
+    """The process and all its descendants ([] if it is gone)."""
+    try:
+        root = psutil.Process(pid)
+        return [root] + root.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+def _cgroup_pids(port):
+    try:
+        with open(os.path.join(cgroup_path(port), "cgroup.procs")) as f:
+            return [int(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def instance_processes(pid, port=None):
+    """
+    The server's process tree and, with port, everything else in its cgroup
+    or running as jupyter-<port>.
+    """
+    procs = {}
+    tree = process_tree(pid) if pid else []
+    try:
+        # A recycled pid of another instance's user is not ours to stop
+        if tree and port is not None and _user_port(tree[0].username()) not in (None, int(port)):
+            tree = []
+    except psutil.Error:
+        tree = []
+    for proc in tree:
+        procs[proc.pid] = proc
+    if port is not None:
+        user = instance_user(port)
+        for proc in psutil.process_iter(["username"]):
+            if proc.info["username"] == user:
+                procs.setdefault(proc.pid, proc)
+        for cpid in _cgroup_pids(port):
+            try:
+                procs.setdefault(cpid, psutil.Process(cpid))
+            except psutil.NoSuchProcess:
+                pass
+    return list(procs.values())
+
+
+def _alive(proc):
+    try:
+        return proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def _wait_gone(procs, timeout):
+    """Those of procs still alive after waiting up to timeout for them to exit."""
+    deadline = time.monotonic() + timeout
+    while True:
+        procs = [p for p in procs if _alive(p)]
+        if not procs or time.monotonic() >= deadline:
+            return procs
+        time.sleep(STOP_POLL_SECONDS)
+
+
+def _rss(procs):
+    total = 0
+    for proc in procs:
+        try:
+            total += proc.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def wait_port_released(port, timeout=PORT_RELEASE_SECONDS):
+    deadline = time.monotonic() + timeout
+    while not is_bindable(int(port)):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(STOP_POLL_SECONDS)
+    return True
+
+
+def stop_processes(procs, first=(), grace=STOP_GRACE_SECONDS):
+    """
+    SIGTERM first, then the rest of procs, SIGKILL whatever is left after
+    grace seconds (blocking). Returns {"processes", "escalated", "survivors",
+    "freed_mb", "seconds"}.
+    """
+    started = time.monotonic()
+    deadline = started + grace
+    freed = _rss(procs)
+    first = [p for p in procs if p.pid in first] or procs
+    signal_processes([p.pid for p in first], signal.SIGTERM)
+    _wait_gone(first, grace)
+    rest = [p for p in procs if _alive(p)]
+    signal_processes([p.pid for p in rest], signal.SIGTERM)
+    alive = _wait_gone(rest, max(deadline - time.monotonic(), STOP_POLL_SECONDS))
+    escalated = len(alive)
+    if alive:
+        signal_processes([p.pid for p in alive], signal.SIGKILL)
+        alive = _wait_gone(alive, STOP_KILL_SECONDS)
+    return {
+        "processes": len(procs),
+        "escalated": escalated,
+        "survivors": [p.pid for p in alive],
+        "freed_mb": round((freed - _rss(alive)) / _MB, 1),
+        "seconds": round(time.monotonic() - started, 2),
+    }
+
+
+def stop_process_tree(pid, port=None, grace=STOP_GRACE_SECONDS):
+    """
+    Stop a server and everything of its instance (instance_processes())
+    (blocking). With port, also waits for it to be free: the report's
+    "port_released" is False if something still listens on it.
+    """
+    report = stop_processes(instance_processes(pid, port), first=(pid,), grace=grace)
+    report["port_released"] = wait_port_released(port) if port is not None else None
+    return report
+
+
+def orphan_processes(tracked, min_age=ORPHAN_MIN_AGE_SECONDS):
+    """
+    port -> processes of jupyter-<port> users that no session accounts for:
+    there is no server on the port (tracked: port -> server pid) or they
+    are outside its process tree. Processes younger than min_age are left
+    alone, so a server being launched is never taken for an orphan.
+    """
+    trees, orphans, now = {}, {}, time.time()
+    for proc in psutil.process_iter(["username", "create_time"]):
+        port = _user_port(proc.info["username"])
+        if port is None or now - (proc.info["create_time"] or now) < min_age:
+            continue
+        pid = tracked.get(port)
+        if pid is not None:
+            if port not in trees:
+                trees[port] = {p.pid for p in process_tree(pid)}
+            if proc.pid in trees[port]:
+                continue
+        orphans.setdefault(port, []).append(proc)
+    return orphans
+
+
+class OrphanSweeper:
+    def __init__(self, get_tracked, on_stopped=None, interval=ORPHAN_SWEEP_SECONDS):
+        """
+        get_tracked(): port -> server pid of the sessions with a server on this host
+        on_stopped(port, report): after the orphans of a port were stopped
+        """
+        self.get_tracked = get_tracked
+        self.on_stopped = on_stopped
+        self.interval = interval
+        self.last_sweep = None
+        self._task = None
+
+    def sweep_once(self):
+        tracked = {int(port): pid for port, pid in self.get_tracked().items() if pid}
+        for port, procs in orphan_processes(tracked).items():
+            report = stop_processes(procs)
+            print(
+                f"Stopped {report['processes']} orphaned process(es) of {instance_user(port)}, "
+                f"{report['freed_mb']} MB freed"
+            )
+            if self.on_stopped is not None:
+                self.on_stopped(port, report)
+        self.last_sweep = time.time()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.sweep_once)
+            except Exception as e:
+                print(f"Orphan sweep error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+
+def main(argv):
+    if len(argv) not in (2, 3) or argv[0] != "stop" or not all(a.isdigit() for a in argv[1:]):
+        print("usage: python3 -m api.procs stop PID [PORT]", file=sys.stderr)
+        return 2
+    report = stop_process_tree(int(argv[1]), int(argv[2]) if len(argv) == 3 else None)
+    print(json.dumps(report))
+    return 1 if report["survivors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,172 @@
+"""
+Background resource sampler.
+
+Every SAMPLE_INTERVAL_SECONDS one pass over the process table builds the
+parent->children map, then each instance's whole tree (the Jupyter server
+plus its ipykernel children, which hold most of the memory) is measured:
+RSS, PSS where /proc allows it, CPU% and the number of live kernels, plus
+the instance cgroup's usage and OOM counters when it has one.
+
+The result is kept as an immutable snapshot plus a short per-instance
+ring buffer. Request handlers read those instead of walking /proc
+themselves.
+"""
+import asyncio, time
+from collections import deque
+
+import psutil
+
+from api.cgroups import read_stats as read_cgroup_stats
+
+SAMPLE_INTERVAL_SECONDS = 5
+HISTORY_SAMPLES = 120   # 10 minutes at the default interval
+
+_MB = 1024 * 1024
+
+
+def _is_kernel(cmdline):
+    return any("ipykernel" in part for part in cmdline)
+
+
+class ResourceSampler:
+    def __init__(self, get_instances, on_sample=None, interval=SAMPLE_INTERVAL_SECONDS):
+        """
+        get_instances(): port -> state info, read at the start of each pass
+        on_sample(snapshot): called after each pass (e.g. to reap dead servers)
+        """
+        self.get_instances = get_instances
+        self.on_sample = on_sample
+        self.interval = interval
+        self.snapshot = None
+        self.history = {}
+        self._procs = {}   # pid -> psutil.Process, kept so cpu_percent() has a baseline
+        self._task = None
+
+    def _proc(self, pid):
+        proc = self._procs.get(pid)
+        if proc is None:
+            proc = self._procs[pid] = psutil.Process(pid)
+        return proc
+
+    def _measure(self, pids):
+        rss = pss = cpu = 0.0
+        kernels = 0
+        pss_available = True
+        for pid in pids:
+            try:
+                proc = self._proc(pid)
+                with proc.oneshot():
+                    rss += proc.memory_info().rss
+                    cpu += proc.cpu_percent(None)
+                    if pss_available:
+                        try:
+                            pss += proc.memory_full_info().pss
+                        except (psutil.AccessDenied, AttributeError):
+                            pss_available = False
+                    try:
+                        kernels += _is_kernel(proc.cmdline())
+                    except psutil.AccessDenied:
+                        pass
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                self._procs.pop(pid, None)
+        return {
+            "rss_mb": round(rss / _MB, 1),
+            "pss_mb": round(pss / _MB, 1) if pss_available else None,
+            "cpu_percent": round(cpu, 1),
+            "kernels": kernels,
+            "processes": len(pids),
+        }
+
+    def sample_once(self):
+        instances = self.get_instances()
+        children = {}
+        alive = set()
+        for proc in psutil.process_iter(["pid", "ppid", "status"]):
+            if proc.info["status"] == psutil.STATUS_ZOMBIE:
+                continue
+            alive.add(proc.info["pid"])
+            children.setdefault(proc.info["ppid"], []).append(proc.info["pid"])
+
+        now = time.time()
+        samples = {}
+        for port, info in instances.items():
+            root = info.get("pid")
+            if not root or root not in alive:
+                samples[port] = {"pid": root, "alive": False}
+                continue
+            tree, stack = [], [root]
+            while stack:
+                pid = stack.pop()
+                tree.append(pid)
+                stack.extend(children.get(pid, ()))
+            samples[port] = {"pid": root, "alive": True, **self._measure(tree)}
+            if info.get("cgroup"):
+                samples[port]["cgroup"] = read_cgroup_stats(info["cgroup"])
+
+        # Forget processes we no longer track
+        self._procs = {pid: p for pid, p in self._procs.items() if pid in alive}
+
+        vm = psutil.virtual_memory()
+        running = [s for s in samples.values() if s["alive"]]
+        self.snapshot = {
+            "sampled_at": now,
+            "host": {
+                "total_mb": vm.total // _MB,
+                "available_mb": vm.available // _MB,
+            },
+            "totals": {
+                "instances": len(running),
+                "rss_mb": round(sum(s["rss_mb"] for s in running), 1),
+                "cpu_percent": round(sum(s["cpu_percent"] for s in running), 1),
+                "kernels": sum(s["kernels"] for s in running),
+            },
+            "instances": samples,
+        }
+        self._record(self.snapshot)
+        return self.snapshot
+
+    def _record(self, snapshot):
+        for port, sample in snapshot["instances"].items():
+            if not sample["alive"]:
+                continue
+            ring = self.history.setdefault(port, deque(maxlen=HISTORY_SAMPLES))
+            ring.append({
+                "t": snapshot["sampled_at"],
+                "rss_mb": sample["rss_mb"],
+                "cpu_percent": sample["cpu_percent"],
+                "kernels": sample["kernels"],
+            })
+        # Forget histories of instances no longer tracked
+        for port in list(self.history):
+            if port not in snapshot["instances"]:
+                del self.history[port]
+
+    def load(self, snapshot):
+        """Take over a pass made by another process (a backend worker that is not the leader)."""
+        if self.snapshot is None or snapshot["sampled_at"] > self.snapshot["sampled_at"]:
+            self.snapshot = snapshot
+            self._record(snapshot)
+
+    def instance(self, port):
+        """Latest sample for port, or None if it has not been sampled yet."""
+        if self.snapshot is None:
+            return None
+        return self.snapshot["instances"].get(str(port))
+
+    def instance_history(self, port):
+        return list(self.history.get(str(port), ()))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                snapshot = await loop.run_in_executor(None, self.sample_once)
+                if self.on_sample:
+                    await loop.run_in_executor(None, self.on_sample, snapshot)
+            except Exception as e:
+                print(f"Resource sampler error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
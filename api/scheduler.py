@@ -0,0 +1,152 @@
+"""
+Expiry scheduler.
+
+One min-heap of (deadline, port) inside the API process replaces both the
+per-instance `sleep $((TTL*60))` subshells of start_jupyter.sh (lost on
+restart) and the full state scan that used to run on every listing. The
+heap is rebuilt from the state store at startup, and a single asyncio task
+sleeps until the earliest deadline.
+
+Rescheduling a port just pushes a new heap entry; stale entries are
+skipped when they surface (lazy deletion), so schedule/unschedule are
+O(log n) / O(1).
+
+Each due port is expired in its own task, at most EXPIRY_CONCURRENCY at a
+time: a stop can take a grace period (api/procs.py), and a batch of
+sessions that expire together shouldn't be stopped one after the other.
+"""
+import asyncio, heapq, threading, time
+from datetime import datetime
+
+# expires_at this far out means "timer disabled" (see start_jupyter)
+TIMER_DISABLED_AFTER_SECONDS = 50 * 365.25 * 24 * 3600
+EXPIRY_CONCURRENCY = 16
+
+
+def parse_expires_at(expires_at):
+    """Deadline as a unix timestamp, or None if unset/disabled."""
+    if not expires_at:
+        return None
+    ts = datetime.fromisoformat(expires_at).timestamp()
+    if ts - time.time() > TIMER_DISABLED_AFTER_SECONDS:
+        return None
+    return ts
+
+
+class ExpiryScheduler:
+    def __init__(self, on_expire, concurrency=EXPIRY_CONCURRENCY):
+        """on_expire(port): coroutine run once port's deadline passes."""
+        self.on_expire = on_expire
+        self.concurrency = concurrency
+        self._expiring = {}    # port -> task of an expiry in flight
+        self._semaphore = None
+        self._heap = []
+        self._deadlines = {}   # port -> currently scheduled deadline
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def _wake(self):
+        # schedule() may be called from threadpool workers (sync endpoints)
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def schedule(self, port, expires_at):
+        port = int(port)
+        deadline = parse_expires_at(expires_at)
+        with self._lock:
+            if deadline is None:
+                self._deadlines.pop(port, None)
+                return
+            self._deadlines[port] = deadline
+            heapq.heappush(self._heap, (deadline, port))
+            earliest = self._heap[0][0] == deadline
+        if earliest:
+            self._wake()
+
+    def unschedule(self, port):
+        with self._lock:
+            self._deadlines.pop(int(port), None)
+
+    def rebuild(self, data):
+        """Reload every deadline from a state snapshot (port -> info)."""
+        with self._lock:
+            self._heap = []
+            self._deadlines = {}
+        for port, info in data.items():
+            self.schedule(port, info.get("expires_at"))
+
+    def deadline(self, port):
+        with self._lock:
+            return self._deadlines.get(int(port))
+
+    def due_within(self, seconds):
+        """[(port, deadline)] for every deadline in the next `seconds`."""
+        horizon = time.time() + seconds
+        with self._lock:
+            return [(port, ts) for port, ts in self._deadlines.items() if ts <= horizon]
+
+    def stats(self):
+        with self._lock:
+            upcoming = sorted(self._deadlines.items(), key=lambda item: item[1])
+        return {
+            "scheduled": len(upcoming),
+            "heap_size": len(self._heap),
+            "expiring": sorted(self._expiring),
+            "next": [{"port": port, "expires_in_seconds": round(ts - time.time(), 1)} for port, ts in upcoming[:5]],
+        }
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, port = heapq.heappop(self._heap)
+                if self._deadlines.get(port) == deadline:
+                    del self._deadlines[port]
+                    due.append(port)
+            # Drop stale entries at the top so the sleep targets a live deadline
+            while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            next_deadline = self._heap[0][0] if self._heap else None
+        return due, next_deadline
+
+    def _retry_later(self, port, seconds=1):
+        with self._lock:
+            if port not in self._deadlines:
+                self._deadlines[port] = time.time() + seconds
+                heapq.heappush(self._heap, (self._deadlines[port], port))
+
+    async def _expire(self, port):
+        try:
+            async with self._semaphore:
+                await self.on_expire(port)
+        except Exception as e:
+            print(f"Expiry of port {port} failed: {e}")
+        finally:
+            self._expiring.pop(port, None)
+
+    async def run(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            self._wakeup = asyncio.Event()
+            due, next_deadline = self._pop_due(time.time())
+            for port in due:
+                if port in self._expiring:
+                    # Due again before its last expiry finished: look at it once that's done
+                    self._retry_later(port)
+                    continue
+                self._expiring[port] = asyncio.get_running_loop().create_task(self._expire(port))
+            if due:
+                continue
+            timeout = None if next_deadline is None else max(next_deadline - time.time(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._task = self._loop.create_task(self.run())
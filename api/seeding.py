@@ -0,0 +1,260 @@
+"""
+Notebook templates and seeding a new instance's notebooks/ from one.
+
+A template is a directory under instances/common (instances/common/<name>).
+The launcher seeds notebooks/ from the template chosen for the launch
+(`template=` on POST /api/jupyter, JUPYTER_NOTEBOOK_TEMPLATE by default)
+instead of anyone copying material in by hand.
+
+Every template has a content-hash manifest (sha256 per file, and one hash
+over all of them), cached in SEED_DIR/manifests/<name>.json by size and
+mtime so only files that changed are re-read. Seeding never reads the
+template itself but an immutable snapshot of it,
+SEED_DIR/snapshots/<name>/<hash>, made once per version of the template.
+SEED_DIR is private to the service user, so instance users only ever see
+the snapshot through their own notebooks/.
+
+Two ways to seed, picked by JUPYTER_SEED_MODE:
+
+  reflink  (default) each file is cloned from the snapshot with FICLONE:
+           a copy-on-write reflink on btrfs/XFS, an ordinary copy where
+           the filesystem can't share extents. The instance records what it
+           got in .seed.json; a re-launch with the same template version
+           does nothing, and a newer version only replaces files the user
+           hasn't modified or deleted.
+  overlay  notebooks/ is an overlay mount of the snapshot under the
+           instance's own upper layer (provision_instance.sh does the
+           mount as root); nothing is copied at all and a file is only
+           copied up when the user writes it.
+
+Hardlinks are not offered: Jupyter saves notebooks in place, so a linked
+file would be edited for every instance at once.
+
+The launcher uses the CLI at the bottom of this file:
+
+    python3 -m api.seeding list
+    python3 -m api.seeding snapshot NAME           # prints the snapshot dir
+    python3 -m api.seeding seed NAME INSTANCE_DIR  # reflink mode
+"""
+import fcntl, grp, hashlib, json, os, re, shutil, sys, tempfile
+
+COMMON_DIR = os.environ.get("JUPYTER_COMMON_DIR", "/home/ubuntu/jupyter_service/instances/common")
+SEED_DIR = os.environ.get("JUPYTER_SEED_DIR", "/home/ubuntu/jupyter_service/instances/.seed")
+DEFAULT_TEMPLATE = os.environ.get("JUPYTER_NOTEBOOK_TEMPLATE") or None
+SEED_MODE = os.environ.get("JUPYTER_SEED_MODE", "reflink")
+SEED_MARKER = ".seed.json"   # in the instance dir, next to notebooks/
+ADMIN_GROUP = "jupyter-admins"   # keep in sync with provision_instance.sh
+
+FICLONE = 0x40049409
+_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+class UnknownTemplate(Exception):
+    pass
+
+
+def template_dir(name):
+    path = os.path.join(COMMON_DIR, name)
+    if not _NAME.match(name or "") or not os.path.isdir(path):
+        raise UnknownTemplate(f"Unknown template: {name}")
+    return path
+
+
+def list_templates():
+    try:
+        names = os.listdir(COMMON_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(n for n in names if _NAME.match(n) and os.path.isdir(os.path.join(COMMON_DIR, n)))
+
+
+def _files(root):
+    """Relative paths of the regular files under root; dotfiles and symlinks are left out."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith(".") and not os.path.islink(os.path.join(dirpath, d)))
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if not name.startswith(".") and os.path.isfile(path) and not os.path.islink(path):
+                yield os.path.relpath(path, root)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _combined(files):
+    """One hash over {relpath: sha256}, in the format of sha256sum's output."""
+    lines = "".join(f"{files[rel]}  {rel}\n" for rel in sorted(files))
+    return hashlib.sha256(lines.encode()).hexdigest()
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _private_dir(*parts):
+    # SEED_DIR itself is 0700: instance users can't reach snapshots directly
+    os.makedirs(SEED_DIR, mode=0o700, exist_ok=True)
+    path = os.path.join(SEED_DIR, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def manifest(name):
+    """{"template", "hash", "files": {relpath: sha256}} of the template as it is now."""
+    root = template_dir(name)
+    cache_path = os.path.join(SEED_DIR, "manifests", f"{name}.json")
+    cached = (_read_json(cache_path) or {}).get("files", {})
+    entries, changed = {}, False
+    for rel in _files(root):
+        st = os.stat(os.path.join(root, rel))
+        entry = cached.get(rel)
+        if entry is None or entry[:2] != [st.st_size, st.st_mtime_ns]:
+            entry = [st.st_size, st.st_mtime_ns, _sha256(os.path.join(root, rel))]
+            changed = True
+        entries[rel] = entry
+    if changed or len(entries) != len(cached):
+        _private_dir("manifests")
+        _write_json(cache_path, {"files": entries})
+    files = {rel: entry[2] for rel, entry in entries.items()}
+    return {"template": name, "hash": _combined(files), "files": files}
+
+
+def clone_file(src, dst):
+    """Copy src to dst as a reflink where the filesystem supports it."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            # EOPNOTSUPP, EXDEV, EINVAL...: no shared extents here
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+
+def _admin_gid():
+    try:
+        return grp.getgrnam(ADMIN_GROUP).gr_gid
+    except KeyError:
+        return None
+
+
+def snapshot(name):
+    """(manifest, dir) of the read-only snapshot of the template's current version."""
+    current = manifest(name)
+    parent = _private_dir("snapshots", name)
+    path = os.path.join(parent, current["hash"][:16])
+    if os.path.isdir(path):
+        return current, path
+
+    root = template_dir(name)
+    gid = _admin_gid()
+    tmp = tempfile.mkdtemp(prefix=".building-", dir=parent)
+    try:
+        for rel in _files(root):
+            dst = os.path.join(tmp, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            clone_file(os.path.join(root, rel), dst)
+        # Hash what was copied: the template may have changed since manifest()
+        files = {rel: _sha256(os.path.join(tmp, rel)) for rel in _files(tmp)}
+        current = {"template": name, "hash": _combined(files), "files": files}
+        path = os.path.join(parent, current["hash"][:16])
+        # Group-writable for the admin group: under an overlay mount, writing a
+        # file is what copies it up to the instance's own layer
+        for dirpath, _, filenames in os.walk(tmp):
+            for entry in [dirpath] + [os.path.join(dirpath, f) for f in filenames]:
+                os.chmod(entry, 0o2775 if os.path.isdir(entry) else 0o664)
+                if gid is not None:
+                    os.chown(entry, -1, gid)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            # Another launch made the same snapshot first
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"Snapshot of template {name} at {path}", file=sys.stderr)
+    return current, path
+
+
+def _inside(path, root):
+    real = os.path.realpath(path)
+    return real == root or real.startswith(root + os.sep)
+
+
+def seed(name, instance_dir):
+    """
+    Clone the template's snapshot into instance_dir/notebooks. Returns the
+    number of files written, or None if the instance already has this version.
+    """
+    current, source = snapshot(name)
+    marker_path = os.path.join(instance_dir, SEED_MARKER)
+    previous = _read_json(marker_path) or {}
+    if previous.get("template") == name and previous.get("hash") == current["hash"]:
+        return None
+
+    notebooks = os.path.realpath(os.path.join(instance_dir, "notebooks"))
+    seeded = previous.get("files", {}) if previous.get("template") == name else {}
+    files, written = {}, 0
+    for rel, digest in current["files"].items():
+        dst = os.path.join(notebooks, rel)
+        before = seeded.get(rel)
+        # The user owns notebooks/: never follow a link out of it
+        if not _inside(os.path.dirname(dst), notebooks) or os.path.islink(dst):
+            continue
+        if os.path.exists(dst):
+            if before is None:
+                continue   # the user's own file
+            if before == digest or _sha256(dst) != before:
+                files[rel] = before   # up to date, or modified since it was seeded: keep it
+                continue
+        elif before is not None:
+            files[rel] = before   # seeded once and deleted since
+            continue
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.seeding")
+        clone_file(os.path.join(source, rel), tmp)
+        os.replace(tmp, dst)
+        files[rel] = digest
+        written += 1
+
+    _write_json(marker_path, {"template": name, "hash": current["hash"], "files": files})
+    return written
+
+
+def main(argv):
+    if not argv or argv[0] not in ("list", "snapshot", "seed") or len(argv) != {"list": 1, "snapshot": 2, "seed": 3}[argv[0]]:
+        print("usage: python3 -m api.seeding list | snapshot NAME | seed NAME INSTANCE_DIR", file=sys.stderr)
+        return 2
+    try:
+        if argv[0] == "list":
+            for name in list_templates():
+                print(name, manifest(name)["hash"][:16])
+        elif argv[0] == "snapshot":
+            print(snapshot(argv[1])[1])
+        else:
+            written = seed(argv[1], argv[2])
+            print("SEED cached" if written is None else f"SEED copied {written}")
+    except (UnknownTemplate, OSError) as e:
+        print(f"ERROR {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
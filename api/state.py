@@ -0,0 +1,447 @@
+"""
+Instance state storage.
+
+The API, the launcher scripts and the reaper all go through a StateStore
+instead of rewriting jupyter_instances.json wholesale. The default backend
+is SQLite in WAL mode (one row per port, indexed by pid and expires_at);
+the JSON backend is kept for hosts that cannot use SQLite and serialises
+its read-modify-write cycles behind an flock.
+
+Every write bumps a store-wide version. Readers use it for ETags and, on
+SQLite, to ask for only the rows changed (and ports deleted) since a
+version they already have: each row remembers the version that last wrote
+it and deletions leave a tombstone.
+
+The SQLite store is also where backend workers share what is not instance
+state (api/workers.py): reservations of launches in flight, and small
+JSON values under meta keys.
+
+Shell scripts use the same API through the CLI at the bottom of this file:
+
+    python3 -m api.state upsert 9001 pid=1234 expires_at=... password=...
+    python3 -m api.state get 9001
+    python3 -m api.state delete 9001
+"""
+import fcntl, json, os, sqlite3, sys, threading, time
+from contextlib import contextmanager
+
+STATE_DIR = os.environ.get("JUPYTER_STATE_DIR", "/home/ubuntu/jupyter_service/instances")
+STATE_FILE = os.path.join(STATE_DIR, "jupyter_instances.json")
+STATE_DB = os.environ.get("JUPYTER_STATE_DB", os.path.join(STATE_DIR, "jupyter_instances.db"))
+STATE_BACKEND = os.environ.get("JUPYTER_STATE_BACKEND", "sqlite")
+
+# Fields stored in their own (indexed) columns; everything else goes to `extra`.
+_COLUMNS = ("pid", "started_at", "expires_at", "path", "common", "password")
+
+
+def _merge(info, fields):
+    """Apply a partial update; a value of None removes the field."""
+    for key, value in fields.items():
+        if value is None:
+            info.pop(key, None)
+        else:
+            info[key] = value
+    return info
+
+
+# ------------------------
+# SQLite backend
+# ------------------------
+class SqliteStateStore:
+    on_lock_wait = None   # on_lock_wait(seconds): how long each write transaction waited for the lock
+
+    def __init__(self, db_path=STATE_DB, legacy_json=STATE_FILE):
+        self.db_path = db_path
+        self.legacy_json = legacy_json
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # executescript() manages its own transaction
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS instances (
+                port        INTEGER PRIMARY KEY,
+                pid         INTEGER,
+                started_at  TEXT,
+                expires_at  TEXT,
+                path        TEXT,
+                common      TEXT,
+                password    TEXT,
+                extra       TEXT NOT NULL DEFAULT '{}',
+                version     INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_instances_pid ON instances(pid);
+            CREATE INDEX IF NOT EXISTS idx_instances_expires_at ON instances(expires_at);
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS deletions (
+                port     INTEGER PRIMARY KEY,
+                version  INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS reservations (
+                port        INTEGER PRIMARY KEY,
+                owner       INTEGER NOT NULL,   -- pid of the worker launching on it
+                memory_mb   INTEGER,            -- NULL until admitted
+                created_at  REAL NOT NULL
+            );
+        """)
+        columns = {row["name"] for row in self._conn().execute("PRAGMA table_info(instances)")}
+        if "version" not in columns:
+            # Databases created before versioning
+            self._conn().execute("ALTER TABLE instances ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_instances_version ON instances(version)")
+        self._migrate_json()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: we issue BEGIN/COMMIT ourselves
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT, so concurrent writers queue instead of losing rows."""
+        conn = self._conn()
+        if conn.in_transaction:
+            # Nested use joins the outer transaction
+            yield conn
+            return
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        if self.on_lock_wait is not None:
+            self.on_lock_wait(time.perf_counter() - started)
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def _migrate_json(self):
+        """One-time import of the legacy jupyter_instances.json."""
+        if not self.legacy_json or not os.path.exists(self.legacy_json):
+            return
+        with self.transaction() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return
+            try:
+                with open(self.legacy_json) as f:
+                    legacy = json.load(f)
+            except (OSError, ValueError):
+                legacy = {}
+            for port, info in legacy.items():
+                self._upsert(db, port, info)
+            db.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (self.legacy_json,))
+        print(f"Migrated {len(legacy)} instance(s) from {self.legacy_json} to {self.db_path}")
+
+    @staticmethod
+    def _row_to_info(row):
+        info = json.loads(row["extra"] or "{}")
+        for col in _COLUMNS:
+            if row[col] is not None:
+                info[col] = row[col]
+        return info
+
+    @staticmethod
+    def _bump(db):
+        """Next store version (caller is inside a write transaction)."""
+        db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+        db.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+        return int(db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+    @classmethod
+    def _upsert(cls, db, port, info):
+        extra = {k: v for k, v in info.items() if k not in _COLUMNS}
+        db.execute(
+            """
+            INSERT INTO instances (port, pid, started_at, expires_at, path, common, password, extra, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(port) DO UPDATE SET
+                pid = excluded.pid,
+                started_at = excluded.started_at,
+                expires_at = excluded.expires_at,
+                path = excluded.path,
+                common = excluded.common,
+                password = excluded.password,
+                extra = excluded.extra,
+                version = excluded.version
+            """,
+            (int(port), *(info.get(col) for col in _COLUMNS), json.dumps(extra), cls._bump(db)),
+        )
+        db.execute("DELETE FROM deletions WHERE port = ?", (int(port),))
+
+    def all(self):
+        rows = self._conn().execute("SELECT * FROM instances ORDER BY port").fetchall()
+        return {str(row["port"]): self._row_to_info(row) for row in rows}
+
+    def ports(self):
+        return [row[0] for row in self._conn().execute("SELECT port FROM instances")]
+
+    def get(self, port):
+        row = self._conn().execute("SELECT * FROM instances WHERE port = ?", (int(port),)).fetchone()
+        return self._row_to_info(row) if row else None
+
+    def version(self):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def changes_since(self, version):
+        """
+        (current version, {port: info} written after version, [ports deleted after version]),
+        read from one snapshot.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            current = self.version()
+            rows = conn.execute(
+                "SELECT * FROM instances WHERE version > ? ORDER BY port", (int(version),)
+            ).fetchall()
+            deleted = [row[0] for row in conn.execute(
+                "SELECT port FROM deletions WHERE version > ? ORDER BY port", (int(version),)
+            )]
+        finally:
+            conn.execute("COMMIT")
+        return current, {str(row["port"]): self._row_to_info(row) for row in rows}, [str(p) for p in deleted]
+
+    def find_by_pid(self, pid):
+        row = self._conn().execute("SELECT * FROM instances WHERE pid = ?", (int(pid),)).fetchone()
+        return (str(row["port"]), self._row_to_info(row)) if row else None
+
+    def expiring_before(self, iso_ts):
+        """Entries whose expires_at sorts before iso_ts (all timestamps are UTC ISO-8601)."""
+        rows = self._conn().execute(
+            "SELECT * FROM instances WHERE expires_at IS NOT NULL AND expires_at < ? ORDER BY expires_at",
+            (iso_ts,),
+        ).fetchall()
+        return {str(row["port"]): self._row_to_info(row) for row in rows}
+
+    def upsert(self, port, info):
+        with self.transaction() as db:
+            self._upsert(db, port, info)
+
+    def update(self, port, **fields):
+        """Merge fields into an existing entry. Returns the new entry, or None if missing."""
+        with self.transaction() as db:
+            row = db.execute("SELECT * FROM instances WHERE port = ?", (int(port),)).fetchone()
+            if row is None:
+                return None
+            info = _merge(self._row_to_info(row), fields)
+            self._upsert(db, port, info)
+            return info
+
+    def claim(self, predicate, **fields):
+        """
+        Atomically take the first entry for which predicate(port, info) holds
+        and merge fields into it. Returns (port, info) or None.
+        """
+        with self.transaction() as db:
+            for row in db.execute("SELECT * FROM instances ORDER BY port").fetchall():
+                info = self._row_to_info(row)
+                if predicate(str(row["port"]), info):
+                    _merge(info, fields)
+                    self._upsert(db, row["port"], info)
+                    return str(row["port"]), info
+        return None
+
+    def delete(self, port):
+        with self.transaction() as db:
+            cur = db.execute("DELETE FROM instances WHERE port = ?", (int(port),))
+            if cur.rowcount == 0:
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO deletions (port, version) VALUES (?, ?)",
+                (int(port), self._bump(db)),
+            )
+            return True
+
+    # Launches in flight, shared between workers (they don't bump the version)
+    def reservations(self):
+        """port -> {"owner", "memory_mb", "created_at"}"""
+        rows = self._conn().execute("SELECT * FROM reservations").fetchall()
+        return {row["port"]: {"owner": row["owner"], "memory_mb": row["memory_mb"], "created_at": row["created_at"]}
+                for row in rows}
+
+    def reserve(self, port, owner, memory_mb=None):
+        """Record (or update) a reservation; memory_mb=None keeps the current one."""
+        with self.transaction() as db:
+            db.execute(
+                """
+                INSERT INTO reservations (port, owner, memory_mb, created_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(port) DO UPDATE SET
+                    owner = excluded.owner,
+                    memory_mb = COALESCE(excluded.memory_mb, memory_mb)
+                """,
+                (int(port), int(owner), memory_mb, time.time()),
+            )
+
+    def release_reservations(self, ports):
+        with self.transaction() as db:
+            db.executemany("DELETE FROM reservations WHERE port = ?", [(int(p),) for p in ports])
+
+    def get_meta(self, key):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (f"shared:{key}",)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"shared:{key}", json.dumps(value)))
+
+
+# ------------------------
+# JSON backend (legacy)
+# ------------------------
+class JsonStateStore:
+    on_lock_wait = None
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.lock_path = path + ".lock"
+
+    @contextmanager
+    def transaction(self):
+        """Exclusive flock around a load/modify/atomic-replace cycle."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            started = time.perf_counter()
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.on_lock_wait is not None:
+                self.on_lock_wait(time.perf_counter() - started)
+            try:
+                data = self._load()
+                yield data
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, "w") as f:
+                    json.dump(data, f, indent=2)
+                os.replace(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def all(self):
+        return self._load()
+
+    def ports(self):
+        return [int(port) for port in self._load()]
+
+    def get(self, port):
+        return self._load().get(str(port))
+
+    def version(self):
+        # Every write replaces the file; its mtime serves as the version
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return 0
+
+    def changes_since(self, version):
+        """Not tracked by this backend: None means "send everything"."""
+        return None
+
+    def find_by_pid(self, pid):
+        for port, info in self._load().items():
+            if info.get("pid") == int(pid):
+                return port, info
+        return None
+
+    def expiring_before(self, iso_ts):
+        items = [(p, i) for p, i in self._load().items() if i.get("expires_at") and i["expires_at"] < iso_ts]
+        return dict(sorted(items, key=lambda item: item[1]["expires_at"]))
+
+    def upsert(self, port, info):
+        with self.transaction() as data:
+            data[str(port)] = info
+
+    def update(self, port, **fields):
+        with self.transaction() as data:
+            if str(port) not in data:
+                return None
+            return _merge(data[str(port)], fields)
+
+    def claim(self, predicate, **fields):
+        with self.transaction() as data:
+            for port in sorted(data, key=int):
+                if predicate(port, data[port]):
+                    return port, _merge(data[port], fields)
+        return None
+
+    def delete(self, port):
+        with self.transaction() as data:
+            return data.pop(str(port), None) is not None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Process-wide store for the configured backend."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if STATE_BACKEND == "json":
+                _store = JsonStateStore()
+            else:
+                _store = SqliteStateStore()
+        return _store
+
+
+# ------------------------
+# CLI (used by scripts/*.sh)
+# ------------------------
+def _parse_value(key, value):
+    if key == "pid":
+        return int(value)
+    return value
+
+
+def main(argv):
+    if not argv or argv[0] not in ("get", "upsert", "delete", "list") or (argv[0] != "list" and len(argv) < 2):
+        print("usage: python3 -m api.state {get|upsert|delete} PORT [key=value ...] | list", file=sys.stderr)
+        return 2
+
+    store = get_store()
+    cmd = argv[0]
+
+    if cmd == "list":
+        print(json.dumps(store.all(), indent=2))
+        return 0
+
+    port = argv[1]
+    if cmd == "get":
+        info = store.get(port)
+        if info is None:
+            print("ERROR Not found", file=sys.stderr)
+            return 1
+        print(json.dumps(info))
+    elif cmd == "delete":
+        if not store.delete(port):
+            print("ERROR Not found", file=sys.stderr)
+            return 1
+    elif cmd == "upsert":
+        info = {}
+        for pair in argv[2:]:
+            key, sep, value = pair.partition("=")
+            if not sep:
+                print(f"ERROR Bad field: {pair}", file=sys.stderr)
+                return 2
+            info[key] = _parse_value(key, value)
+        store.upsert(port, info)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
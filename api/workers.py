@@ -0,0 +1,182 @@
+"""
+Running the backend as several processes (uvicorn --workers N).
+
+Workers share the SQLite state store, and what used to live in the memory
+of the one backend process is coordinated through it and STATE_DIR:
+
+  * One worker is the leader: it holds an exclusive flock on
+    STATE_DIR/backend.leader.lock for as long as it lives, and only it
+    runs the loops that act on sessions (expiry, reaping, sampling, idle
+    culling, warm pool refills). When it exits the kernel drops the lock
+    and another worker takes over within LEADER_RETRY_SECONDS.
+  * Ports and RAM of launches in flight are rows of the reservations
+    table, taken under STATE_DIR/backend.launch.lock (SharedReservations),
+    so two workers can't hand out the same port or both squeeze into the
+    last of the headroom. LAUNCH_CONCURRENCY is enforced across workers
+    with one lock file per slot (FileSemaphore).
+  * Launch jobs, events, metrics and the last sample / culling pass are
+    written to the database by the worker that has them and read back by
+    the others (api/jobs.py, api/events.py, api/metrics.py, api/main.py).
+
+The JSON backend has nothing to share through; run a single worker with it.
+"""
+import asyncio, fcntl, os, threading, time
+from contextlib import asynccontextmanager
+
+from api.procs import is_running
+from api.state import STATE_BACKEND, STATE_DIR
+
+SHARED = STATE_BACKEND == "sqlite"
+LEADER_LOCK = os.path.join(STATE_DIR, "backend.leader.lock")
+LAUNCH_LOCK = os.path.join(STATE_DIR, "backend.launch.lock")
+LAUNCH_SLOTS = os.path.join(STATE_DIR, "backend.launch.slot")   # .0, .1, ...
+LEADER_RETRY_SECONDS = 5
+SLOT_POLL_SECONDS = 0.05
+
+
+def _open(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+
+class FileLock:
+    """flock on path: exclusive across processes, re-entrant within one."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            if self._fd is None:
+                self._fd = _open(self.path)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class FileSemaphore:
+    """At most `slots` holders across processes: one flock'd file per slot."""
+
+    def __init__(self, path, slots):
+        self.paths = [f"{path}.{i}" for i in range(slots)]
+
+    def _try_acquire(self):
+        for path in self.paths:
+            fd = _open(path)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    @asynccontextmanager
+    async def slot(self):
+        fd = self._try_acquire()
+        while fd is None:
+            await asyncio.sleep(SLOT_POLL_SECONDS)
+            fd = self._try_acquire()
+        try:
+            yield
+        finally:
+            os.close(fd)   # closing drops the flock
+
+
+class LeaderElection:
+    def __init__(self, on_elected, path=LEADER_LOCK, interval=LEADER_RETRY_SECONDS):
+        """on_elected(): coroutine run once, when this worker becomes the leader"""
+        self.on_elected = on_elected
+        self.path = path
+        self.interval = interval
+        self.is_leader = False
+        self.elected_at = None
+        self._fd = None
+        self._task = None
+
+    def try_acquire(self):
+        if self.is_leader:
+            return True
+        fd = _open(self.path)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self._fd = fd
+        self.is_leader = True
+        self.elected_at = time.time()
+        return True
+
+    def leader_pid(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    async def _elected(self):
+        print(f"Worker {os.getpid()} is the leader")
+        await self.on_elected()
+
+    async def campaign(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.interval)
+        await self._elected()
+
+    async def start(self):
+        if self.try_acquire():
+            await self._elected()
+        elif self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.campaign())
+
+    def stats(self):
+        return {
+            "pid": os.getpid(),
+            "leader": self.is_leader,
+            "leader_pid": os.getpid() if self.is_leader else self.leader_pid(),
+            "elected_at": self.elected_at,
+        }
+
+
+class SharedReservations:
+    """Launches in flight of every worker (the reservations table), under the launch lock."""
+
+    def __init__(self, get_store, lock):
+        self.get_store = get_store
+        self.lock = lock
+        self.owner = os.getpid()
+
+    def _live(self):
+        store = self.get_store()
+        rows = store.reservations()
+        # A worker that died mid-launch leaves its rows behind
+        dead = [port for port, row in rows.items() if row["owner"] != self.owner and not is_running(row["owner"])]
+        if dead:
+            store.release_reservations(dead)
+        return {port: row for port, row in rows.items() if port not in dead}
+
+    def used_ports(self):
+        """Ports of running sessions plus those reserved by any worker."""
+        return set(self.get_store().ports()) | set(self._live())
+
+    def memory(self):
+        """port -> MB admitted for launches in flight."""
+        return {port: row["memory_mb"] for port, row in self._live().items() if row["memory_mb"] is not None}
+
+    def add(self, port, memory_mb=None):
+        self.get_store().reserve(port, self.owner, memory_mb)
+
+    def remove(self, port):
+        self.get_store().release_reservations([port])
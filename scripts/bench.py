@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+Load test of the backend against stub Jupyter servers.
+
+Starts the API (uvicorn, --workers N) in a scratch JUPYTER_STATE_DIR with
+JUPYTER_START_SCRIPT=scripts/stub_start_jupyter.sh, so launches need no
+useradd, sudo or JupyterLab: every session is a scripts/stub_jupyter.py
+bound to its port and answering /api/status. --concurrency clients then
+run a weighted mix of operations for --duration seconds:
+
+    start   POST /api/jupyter, then long-poll the job until it is ready
+    list    GET /api/jupyter
+    stop    DELETE /api/jupyter/<port> of a session the benchmark started
+    expire  POST /api/jupyter/<port>/ttl?session_minutes=0, and the lag
+            until its "expired" event shows up on /api/jupyter/events
+
+The report (JSON, --output) has operations per second, p50/p95/p99 latency
+and status codes per endpoint, how long state store writes waited for the
+lock (jupyter_state_lock_wait_seconds), RSS per stub instance (from the
+sampler) and of the backend's own processes, plus the commit measured.
+--compare prints the change against an earlier report and exits 1 when a
+p95 got worse by more than --threshold percent.
+
+Usage:
+    bench.py [--workers 1] [--concurrency 16] [--duration 30]
+             [--mix start=2,list=10,stop=1,expire=1] [--output bench.json]
+             [--compare OLD.json] [--url http://127.0.0.1:8000]
+
+With --url an already running backend is measured instead; it has to use
+the stub launcher as well, or the sessions started are real ones.
+"""
+import argparse, json, os, random, re, shutil, signal, subprocess, sys, tempfile, threading, time
+import urllib.error, urllib.parse, urllib.request
+from datetime import datetime, timezone
+
+import psutil
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_START_SCRIPT = os.path.join(SERVICE_DIR, "scripts", "stub_start_jupyter.sh")
+DEFAULT_MIX = "start=2,list=10,stop=1,expire=1"
+OPERATIONS = ("start", "list", "stop", "expire")
+TAG = "bench"
+REQUEST_TIMEOUT_SECONDS = 120
+READY_TIMEOUT_SECONDS = 90
+BACKEND_START_TIMEOUT_SECONDS = 30
+LOCK_WAIT_METRIC = "jupyter_state_lock_wait_seconds"
+
+
+def call(base, method, path, params=None, body=None):
+    """(status, JSON body or None, seconds); status 0 when the request didn't get an answer."""
+    url = base + path + ("?" + urllib.parse.urlencode(params) if params else "")
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT_SECONDS) as resp:
+            status, raw = resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        status, raw = e.code, e.read()
+    except OSError:
+        status, raw = 0, b""
+    elapsed = time.perf_counter() - started
+    try:
+        return status, json.loads(raw) if raw else None, elapsed
+    except ValueError:
+        return status, None, elapsed
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}   # endpoint -> [seconds]
+        self.statuses = {}    # endpoint -> {status: count}
+        self.operations = {op: 0 for op in OPERATIONS}
+        self.skipped = {op: 0 for op in OPERATIONS}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, status, seconds):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[str(status)] = counts.get(str(status), 0) + 1
+
+    def done(self, op, skipped=False):
+        with self._lock:
+            (self.skipped if skipped else self.operations)[op] += 1
+
+    def report(self, duration):
+        endpoints = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            statuses = self.statuses.get(endpoint, {})
+            endpoints[endpoint] = {
+                "count": len(values),
+                # Derived timings (launch_ready, expiry_lag) carry no status
+                "errors": sum(n for s, n in statuses.items() if s != "-" and not 200 <= int(s) < 400),
+                "statuses": statuses,
+                "per_second": round(len(values) / duration, 2),
+                "mean_ms": round(sum(values) / len(values) * 1000, 2),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+        requests = sum(len(v) for e, v in self.latencies.items() if e.split()[0] in ("GET", "POST", "DELETE"))
+        return {
+            "requests_per_second": round(requests / duration, 2),
+            "operations_per_second": {op: round(n / duration, 2) for op, n in self.operations.items()},
+            "operations": self.operations,
+            "skipped": self.skipped,
+            "endpoints": endpoints,
+        }
+
+
+class Bench:
+    def __init__(self, base, memory_mb, session_minutes, max_sessions):
+        self.base = base
+        self.memory_mb = memory_mb
+        self.session_minutes = session_minutes
+        self.max_sessions = max_sessions
+        self.recorder = Recorder()
+        self.sessions = []     # ports of ready sessions started here
+        self.starting = 0
+        self.expiring = {}     # port -> when its TTL was cut to zero
+        self._lock = threading.Lock()
+
+    def _call(self, endpoint, method, path, params=None, body=None):
+        status, data, seconds = call(self.base, method, path, params, body)
+        self.recorder.add(endpoint, status, seconds)
+        return status, data
+
+    def _take(self):
+        with self._lock:
+            if not self.sessions:
+                return None
+            return self.sessions.pop(random.randrange(len(self.sessions)))
+
+    def start(self):
+        with self._lock:
+            full = len(self.sessions) + self.starting >= self.max_sessions
+            if not full:
+                self.starting += 1
+        if full:
+            # Keep the fleet bounded: a start at the cap becomes a stop
+            return self.stop()
+        try:
+            started = time.perf_counter()
+            status, data = self._call("POST /api/jupyter", "POST", "/api/jupyter", {
+                "memory_mb": self.memory_mb, "session_minutes": self.session_minutes, "tag": TAG,
+            })
+            if status not in (200, 202):
+                return self.recorder.done("start")
+            job = data
+            deadline = time.time() + READY_TIMEOUT_SECONDS
+            while job.get("phase") not in ("ready", "failed") and time.time() < deadline:
+                status, polled = self._call("GET /api/jupyter/jobs/{id}", "GET", f"/api/jupyter/jobs/{data['job_id']}", {"wait": 30})
+                if status != 200:
+                    break
+                job = polled
+            if job.get("phase") == "ready":
+                self.recorder.add("launch_ready", "-", time.perf_counter() - started)
+                with self._lock:
+                    self.sessions.append(job["result"]["port"])
+            self.recorder.done("start")
+        finally:
+            with self._lock:
+                self.starting -= 1
+
+    def list(self):
+        self._call("GET /api/jupyter", "GET", "/api/jupyter", {"tag": TAG})
+        self.recorder.done("list")
+
+    def stop(self):
+        port = self._take()
+        if port is None:
+            return self.recorder.done("stop", skipped=True)
+        self._call("DELETE /api/jupyter/{port}", "DELETE", f"/api/jupyter/{port}")
+        self.recorder.done("stop")
+
+    def expire(self):
+        port = self._take()
+        if port is None:
+            return self.recorder.done("expire", skipped=True)
+        with self._lock:
+            self.expiring[port] = time.perf_counter()
+        status, _ = self._call("POST /api/jupyter/{port}/ttl", "POST", f"/api/jupyter/{port}/ttl", {"session_minutes": 0})
+        if status != 200:
+            with self._lock:
+                self.expiring.pop(port, None)
+        self.recorder.done("expire")
+
+    def follow_expiries(self):
+        """Match "expired" events to the TTL cuts made by expire() (runs in a daemon thread)."""
+        while True:
+            try:
+                with urllib.request.urlopen(self.base + "/api/jupyter/events?types=expired", timeout=60) as resp:
+                    for raw in resp:
+                        line = raw.decode(errors="replace").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        port = json.loads(line[5:])["data"].get("port")
+                        with self._lock:
+                            cut = self.expiring.pop(port, None)
+                        if cut is not None:
+                            self.recorder.add("expiry_lag", "-", time.perf_counter() - cut)
+            except (OSError, ValueError):
+                time.sleep(0.5)
+
+    def client(self, ops, weights, deadline):
+        while time.time() < deadline:
+            getattr(self, random.choices(ops, weights)[0])()
+
+
+def parse_mix(spec):
+    mix = {}
+    for item in spec.split(","):
+        op, _, weight = item.partition("=")
+        if op.strip() not in OPERATIONS or not weight.strip().isdigit():
+            raise SystemExit(f"--mix: expected op=weight with op in {', '.join(OPERATIONS)}, got {item!r}")
+        mix[op.strip()] = int(weight)
+    return mix
+
+
+def lock_wait_histogram(base):
+    """({le: cumulative count}, sum, count) of the lock wait histogram, from /api/metrics."""
+    req = urllib.request.Request(base + "/api/metrics")
+    with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT_SECONDS) as resp:
+        text = resp.read().decode()
+    buckets, total, count = {}, 0.0, 0
+    for line in text.splitlines():
+        match = re.match(rf'{LOCK_WAIT_METRIC}_bucket\{{le="([^"]+)"\}} (\S+)', line)
+        if match:
+            buckets[match.group(1)] = float(match.group(2))
+        elif line.startswith(f"{LOCK_WAIT_METRIC}_sum "):
+            total = float(line.split()[1])
+        elif line.startswith(f"{LOCK_WAIT_METRIC}_count "):
+            count = int(float(line.split()[1]))
+    return buckets, total, count
+
+
+def lock_wait_report(before, after):
+    buckets = {le: after[0].get(le, 0) - before[0].get(le, 0) for le in after[0]}
+    total, count = after[1] - before[1], after[2] - before[2]
+
+    def bound(q):
+        # Upper bound of the bucket holding the q-th percentile
+        for le, n in sorted(buckets.items(), key=lambda item: float(item[0])):
+            if count and n >= count * q / 100:
+                return None if le == "+Inf" else round(float(le) * 1000, 3)
+        return None
+
+    return {
+        "write_transactions": count,
+        "lock_wait_mean_ms": round(total / count * 1000, 3) if count else None,
+        "lock_wait_p50_ms_at_most": bound(50),
+        "lock_wait_p95_ms_at_most": bound(95),
+        "lock_wait_p99_ms_at_most": bound(99),
+    }
+
+
+def memory_report(base, backend_pid):
+    _, stats, _ = call(base, "GET", "/api/jupyter/stats")
+    alive = [s for s in (stats or {}).get("instances", {}).values() if s.get("alive")]
+    report = {
+        "instances_sampled": len(alive),
+        "instance_rss_mb_mean": round(sum(s["rss_mb"] for s in alive) / len(alive), 1) if alive else None,
+        "instance_rss_mb_max": max((s["rss_mb"] for s in alive), default=None),
+        "backend_rss_mb": None,
+    }
+    if backend_pid is not None:
+        try:
+            root = psutil.Process(backend_pid)
+            procs = [root] + root.children(recursive=True)
+            # Launcher shells and stubs still attached to them aren't the backend
+            rss = sum(
+                p.memory_info().rss for p in procs
+                if "python" in p.name() and not any("stub_jupyter" in part for part in p.cmdline())
+            )
+            report["backend_rss_mb"] = round(rss / 1024 / 1024, 1)
+        except psutil.Error:
+            pass
+    return report
+
+
+def start_backend(args, state_dir):
+    env = dict(
+        os.environ,
+        JUPYTER_STATE_DIR=state_dir,
+        JUPYTER_START_SCRIPT=STUB_START_SCRIPT,
+        JUPYTER_STUB_DIR=os.path.join(state_dir, "stub"),
+        JUPYTER_PORT_RANGE=args.ports,
+        JUPYTER_WARM_POOL_SIZE="0",
+        # Stubs use a few MB each; admit by their memory_mb without needing that much RAM
+        JUPYTER_RAM_OVERCOMMIT=str(args.overcommit),
+        PYTHONPATH=os.pathsep.join(filter(None, [SERVICE_DIR, os.environ.get("PYTHONPATH")])),
+    )
+    log = open(os.path.join(state_dir, "backend.log"), "w")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=SERVICE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    base = f"http://127.0.0.1:{args.port}"
+    deadline = time.time() + BACKEND_START_TIMEOUT_SECONDS
+    while time.time() < deadline and proc.poll() is None:
+        if call(base, "GET", "/api/workers")[0] == 200:
+            return proc, base
+        time.sleep(0.2)
+    proc.kill()
+    raise SystemExit(f"Backend didn't come up, see {log.name}")
+
+
+def stop_backend(proc):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(20)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "-C", SERVICE_DIR, "describe", "--always", "--dirty"], capture_output=True, text=True,
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old, new, threshold):
+    """Print p95 / throughput changes; returns the endpoints whose p95 regressed past threshold."""
+    regressed = []
+    print(f"{'endpoint':32} {'p95 old':>10} {'p95 new':>10} {'change':>8}")
+    for endpoint, stats in new["endpoints"].items():
+        before = old.get("endpoints", {}).get(endpoint)
+        if before is None:
+            continue
+        change = (stats["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100 if before["p95_ms"] else 0.0
+        flag = ""
+        if change > threshold:
+            regressed.append(endpoint)
+            flag = "  REGRESSION"
+        print(f"{endpoint:32} {before['p95_ms']:>10} {stats['p95_ms']:>10} {change:>+7.1f}%{flag}")
+    print(f"requests/s: {old.get('requests_per_second')} -> {new['requests_per_second']}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="measure this running backend instead of starting one")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the started backend")
+    parser.add_argument("--port", type=int, default=8099, help="port of the started backend")
+    parser.add_argument("--ports", default="9300-9399", help="JUPYTER_PORT_RANGE of the started backend")
+    parser.add_argument("--overcommit", type=float, default=10.0, help="JUPYTER_RAM_OVERCOMMIT of the started backend")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of measured load")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="relative weights of start, list, stop, expire")
+    parser.add_argument("--initial", type=int, default=10, help="sessions started before measuring")
+    parser.add_argument("--max-sessions", type=int, default=60, help="a start beyond this many becomes a stop")
+    parser.add_argument("--memory-mb", type=int, default=128)
+    parser.add_argument("--session-minutes", type=int, default=30)
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--compare", help="earlier report to compare with")
+    parser.add_argument("--threshold", type=float, default=20.0, help="p95 regression (percent) that fails --compare")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    state_dir = proc = None
+    if args.url:
+        base = args.url.rstrip("/")
+    else:
+        state_dir = tempfile.mkdtemp(prefix="jupyter-bench-")
+        proc, base = start_backend(args, state_dir)
+        print(f"Backend with {args.workers} worker(s) on {base}, state in {state_dir}")
+
+    bench = Bench(base, args.memory_mb, args.session_minutes, args.max_sessions)
+    try:
+        threading.Thread(target=bench.follow_expiries, daemon=True).start()
+        warmup = [threading.Thread(target=bench.start) for _ in range(args.initial)]
+        for t in warmup:
+            t.start()
+        for t in warmup:
+            t.join()
+        print(f"{len(bench.sessions)} initial sessions up, measuring for {args.duration}s")
+        bench.recorder = Recorder()
+
+        lock_before = lock_wait_histogram(base)
+        ops, weights = list(mix), list(mix.values())
+        started = time.time()
+        clients = [
+            threading.Thread(target=bench.client, args=(ops, weights, started + args.duration))
+            for _ in range(args.concurrency)
+        ]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        duration = time.time() - started
+        time.sleep(1)   # let the last expiries arrive
+        lock_after = lock_wait_histogram(base)
+
+        report = {
+            "commit": git_commit(),
+            "time": datetime.now(timezone.utc).isoformat(),
+            "config": {
+                "url": args.url, "workers": None if args.url else args.workers,
+                "concurrency": args.concurrency, "duration_seconds": args.duration, "mix": mix,
+                "initial": args.initial, "max_sessions": args.max_sessions, "memory_mb": args.memory_mb,
+            },
+            "duration_seconds": round(duration, 2),
+            **bench.recorder.report(duration),
+            "state_store": lock_wait_report(lock_before, lock_after),
+            "memory": memory_report(base, proc.pid if proc else None),
+        }
+    finally:
+        status, data, _ = call(base, "POST", "/api/jupyter/batch/stop", body={"tag": TAG})
+        print(f"Stopped {data.get('stopped') if status == 200 else 'no'} benchmark sessions")
+        if proc is not None:
+            stop_backend(proc)
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    for endpoint, stats in report["endpoints"].items():
+        print(f"  {endpoint:32} n={stats['count']:<6} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms "
+              f"p99={stats['p99_ms']}ms errors={stats['errors']}")
+    print(f"  {report['requests_per_second']} requests/s, state store: {report['state_store']}")
+    print(f"  memory: {report['memory']}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(json.load(f), report, args.threshold)
+        if regressed:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Render nginx.conf with JupyterLab's static assets served by nginx.
+
+Every Jupyter server ships the same JupyterLab bundle. Instead of proxying
+each request to one of the Tornado processes, the generated config serves
+
+    [/jupyter/<port>]/static/lab/...                  <app dir>/static/
+    [/jupyter/<port>]/lab/extensions/<ext>/static/... <ext dir>/static/
+    [/jupyter/<port>]/static/...                      jupyter_server/static/
+
+straight from the venv, port-independent, gzip-compressed, with
+`immutable` caching for content-hashed files. The paths and the extension
+list are read from the installed JupyterLab (via the venv's python), so
+re-run this after upgrading JupyterLab or installing an extension; --check
+exits 1 when the generated file is out of date.
+
+The generated blocks replace the "# @jupyter-static-http" and
+"# @jupyter-static-server" markers of the template (the repo's
+nginx.conf, which stays usable as-is without them).
+
+Usage:
+    gen_nginx_conf.py [--output PATH] [--brotli] [--precompress] [--check]
+"""
+import argparse, gzip, json, os, subprocess, sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE = os.path.join(SERVICE_DIR, "nginx.conf")
+OUTPUT = "/etc/nginx/sites-available/jupyter_service"
+JUPYTER_BIN = "/home/ubuntu/.venv/bin/jupyter"   # keep in sync with api/main.py
+HTTP_MARKER = "# @jupyter-static-http"
+SERVER_MARKER = "# @jupyter-static-server"
+COMPRESS_TYPES = "application/javascript text/css application/json image/svg+xml text/plain"
+PRECOMPRESS_SUFFIXES = (".js", ".css", ".json", ".svg", ".map", ".txt", ".html")
+
+# Runs under the venv's python: where the installed JupyterLab keeps its assets
+INSPECT = r"""
+import json, os
+import jupyter_server, jupyterlab
+from jupyter_core.paths import jupyter_path
+from jupyterlab.commands import get_app_dir
+
+extensions = {}
+for root in jupyter_path("labextensions"):
+    if not os.path.isdir(root):
+        continue
+    for dirpath, dirnames, filenames in os.walk(root):
+        if "package.json" in filenames and os.path.isdir(os.path.join(dirpath, "static")):
+            name = os.path.relpath(dirpath, root).replace(os.sep, "/")
+            # First match wins, as in JupyterLab's own lookup order
+            extensions.setdefault(name, os.path.join(dirpath, "static"))
+            dirnames[:] = []
+print(json.dumps({
+    "jupyterlab_version": jupyterlab.__version__,
+    "lab_static": os.path.join(get_app_dir(), "static"),
+    "server_static": os.path.join(os.path.dirname(jupyter_server.__file__), "static"),
+    "extensions": extensions,
+}))
+"""
+
+
+def inspect_jupyterlab(jupyter_bin):
+    python = os.path.join(os.path.dirname(jupyter_bin), "python")
+    out = subprocess.run([python, "-c", INSPECT], capture_output=True, text=True, check=True).stdout
+    return json.loads(out)
+
+
+def _regex_escape(name):
+    return "".join("\\" + c if c in ".+*?()[]{}|^$\\" else c for c in name)
+
+
+def render_http(info):
+    return [
+        f"# Generated by scripts/gen_nginx_conf.py for JupyterLab {info['jupyterlab_version']}",
+        "# Content-hashed files (and ?v= busted ones) never change under the same URL",
+        "map $request_uri $jupyter_static_cache_control {",
+        '    "~*\\.[0-9a-f]{16,}\\.[a-z0-9]+$"  "public, max-age=31536000, immutable";',
+        '    "~[?&]v="                          "public, max-age=31536000, immutable";',
+        '    default                            "public, max-age=3600";',
+        "}",
+    ]
+
+
+def _static_location(pattern, root, brotli):
+    lines = [
+        f"location ~ {pattern} {{",
+        f"    alias {root}/$1;",
+        # Per location: the distro's http block usually has its own "gzip on"
+        "    gzip on;",
+        "    gzip_static on;",
+        "    gzip_comp_level 5;",
+        "    gzip_vary on;",
+        f"    gzip_types {COMPRESS_TYPES};",
+    ]
+    if brotli:
+        lines += ["    brotli on;", "    brotli_static on;", f"    brotli_types {COMPRESS_TYPES};"]
+    lines += [
+        "    add_header Cache-Control $jupyter_static_cache_control;",
+        "    access_log off;",
+        "}",
+    ]
+    return lines
+
+
+def render_server(info, brotli):
+    # Regex locations match in order: these must come before the proxy block
+    prefix = r"^(?:/jupyter/\d+)?"
+    lines = [f"# JupyterLab {info['jupyterlab_version']} static assets, served by nginx (gen_nginx_conf.py)"]
+    lines += _static_location(prefix + r"/static/lab/(.+)$", info["lab_static"], brotli)
+    for name, root in sorted(info["extensions"].items()):
+        lines += _static_location(prefix + f"/lab/extensions/{_regex_escape(name)}/static/(.+)$", root, brotli)
+    lines += _static_location(prefix + r"/static/((?!lab/).+)$", info["server_static"], brotli)
+    return lines
+
+
+def render(template, info, brotli=False):
+    out = []
+    for line in template.splitlines():
+        stripped = line.strip()
+        indent = line[: len(line) - len(line.lstrip())]
+        if stripped == HTTP_MARKER:
+            out += [indent + l if l else l for l in render_http(info)]
+        elif stripped == SERVER_MARKER:
+            out += [indent + l if l else l for l in render_server(info, brotli)]
+        else:
+            out.append(line)
+    return "\n".join(out) + "\n"
+
+
+def precompress(roots):
+    """Write .gz next to compressible assets so gzip_static skips on-the-fly compression."""
+    written = 0
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if not name.endswith(PRECOMPRESS_SUFFIXES):
+                    continue
+                path = os.path.join(dirpath, name)
+                target = path + ".gz"
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                with open(path, "rb") as src, gzip.open(target, "wb", compresslevel=9) as dst:
+                    dst.write(src.read())
+                written += 1
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--template", default=TEMPLATE)
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--jupyter-bin", default=JUPYTER_BIN)
+    parser.add_argument("--brotli", action="store_true", help="nginx has the ngx_brotli module")
+    parser.add_argument("--precompress", action="store_true", help="write .gz files next to the assets")
+    parser.add_argument("--check", action="store_true", help="exit 1 if OUTPUT is out of date")
+    args = parser.parse_args()
+
+    info = inspect_jupyterlab(args.jupyter_bin)
+    with open(args.template) as f:
+        rendered = render(f.read(), info, brotli=args.brotli)
+
+    if args.check:
+        try:
+            with open(args.output) as f:
+                current = f.read()
+        except OSError:
+            current = None
+        if current != rendered:
+            print(f"{args.output} is out of date for JupyterLab {info['jupyterlab_version']}", file=sys.stderr)
+            return 1
+        return 0
+
+    if args.precompress:
+        roots = [info["lab_static"], info["server_static"], *info["extensions"].values()]
+        print(f"Precompressed {precompress(roots)} files")
+
+    tmp = f"{args.output}.tmp"
+    with open(tmp, "w") as f:
+        f.write(rendered)
+    os.replace(tmp, args.output)
+    print(f"Wrote {args.output} (JupyterLab {info['jupyterlab_version']}, {len(info['extensions'])} extensions)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
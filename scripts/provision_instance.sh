@@ -0,0 +1,151 @@
+#!/bin/bash
+# Privileged half of start_jupyter.sh: everything that needs root before a
+# server can start on PORT, in one `sudo` call.
+#
+# What has been done is recorded in versioned markers under $MARKER_DIR
+# (root-owned, so instances can't forge them):
+#   global   parent directory modes, admin group, ubuntu's membership
+#   <port>   jupyter-<port> user, its group membership, the instance dirs
+# A re-launch with up-to-date markers does no work at all. Permissions are
+# only set on the two directories we create; default ACLs make everything
+# created inside them group-writable, so nothing is ever applied
+# recursively over a user's notebooks.
+#
+# With JUPYTER_SEED_MODE=overlay the launcher also passes the snapshot of
+# the launch's notebook template (api/seeding.py), and notebooks/ becomes
+# an overlay mount of it: the snapshot is the read-only lower layer, and
+# $OVERLAY_DIR/upper (root-owned parent, out of the user's reach) holds
+# whatever the user writes.
+#
+# Usage: sudo provision_instance.sh PORT [SNAPSHOT]
+# Prints "PROVISION cached" or "PROVISION updated", then "SEED cached" or
+# "SEED mounted" when given a snapshot.
+
+PORT="$1"
+SNAPSHOT="$2"
+case "$PORT" in
+  ''|*[!0-9]*) echo "ERROR Invalid port: $PORT" >&2; exit 1 ;;
+esac
+
+SERVICE_DIR="/home/ubuntu/jupyter_service"
+BASE_DIR="$SERVICE_DIR/instances"
+MARKER_DIR="$BASE_DIR/.provisioned"
+SEED_DIR="$BASE_DIR/.seed"   # keep in sync with api/seeding.py
+PROVISION_VERSION=1   # bump when the steps below change
+
+INSTANCE_DIR="$BASE_DIR/$PORT"
+NOTEBOOK_DIR="$INSTANCE_DIR/notebooks"
+OVERLAY_DIR="$BASE_DIR/.overlays/$PORT"
+USER_NAME="jupyter-$PORT"
+ADMIN_GROUP="jupyter-admins"
+
+set -e
+
+marker_ok() {
+  # $1 marker file, $2 expected content
+  [ -f "$1" ] && [ "$(cat "$1")" = "$2" ]
+}
+
+user_dir_perms() {
+  chown "$USER_NAME:$ADMIN_GROUP" "$1"
+  # setgid: new files inherit the admin group
+  chmod 2777 "$1"
+  if command -v setfacl >/dev/null; then
+    # New files and directories below stay group-writable without a recursive chmod
+    setfacl -d -m "u::rwx,g::rwx,g:$ADMIN_GROUP:rwx,o::rx" "$1"
+  fi
+}
+
+# -------------------------
+# Overlay seeding
+# -------------------------
+mount_template() {
+  [ -z "$SNAPSHOT" ] && return 0
+  # Only ever a snapshot made by api/seeding.py
+  local lower
+  lower=$(realpath -e "$SNAPSHOT") || return 1
+  case "$lower" in
+    "$(realpath -m "$SEED_DIR")"/snapshots/*/*) ;;
+    *) echo "ERROR Not a template snapshot: $SNAPSHOT" >&2; return 1 ;;
+  esac
+  # The instance dir is the user's: don't mount through a link they planted
+  if [ -L "$NOTEBOOK_DIR" ] || [ "$(realpath "$NOTEBOOK_DIR")" != "$(realpath "$INSTANCE_DIR")/notebooks" ]; then
+    echo "ERROR $NOTEBOOK_DIR is not a plain directory" >&2
+    return 1
+  fi
+
+  if mountpoint -q "$NOTEBOOK_DIR"; then
+    if findmnt -no OPTIONS "$NOTEBOOK_DIR" | grep -qF "lowerdir=$lower,"; then
+      echo "SEED cached"
+      return 0
+    fi
+    # A newer version of the template (or another one): same upper layer
+    umount "$NOTEBOOK_DIR" || umount -l "$NOTEBOOK_DIR"
+  fi
+
+  mkdir -p "$OVERLAY_DIR/work"
+  chown root:root "$BASE_DIR/.overlays" "$OVERLAY_DIR"
+  chmod 711 "$BASE_DIR/.overlays" "$OVERLAY_DIR"
+  if [ ! -d "$OVERLAY_DIR/upper" ]; then
+    mkdir "$OVERLAY_DIR/upper"
+    user_dir_perms "$OVERLAY_DIR/upper"
+  fi
+  # Files written to notebooks/ before it was mounted would be hidden by it
+  find "$NOTEBOOK_DIR" -mindepth 1 -maxdepth 1 -exec mv --backup=numbered -t "$OVERLAY_DIR/upper" {} +
+
+  mount -t overlay overlay \
+    -o "lowerdir=$lower,upperdir=$OVERLAY_DIR/upper,workdir=$OVERLAY_DIR/work" "$NOTEBOOK_DIR"
+  echo "SEED mounted"
+}
+
+# -------------------------
+# Host-wide setup
+# -------------------------
+GLOBAL_MARKER="$MARKER_DIR/global"
+GLOBAL_STATE="version=$PROVISION_VERSION"
+if ! marker_ok "$GLOBAL_MARKER" "$GLOBAL_STATE" || ! getent group "$ADMIN_GROUP" >/dev/null; then
+  # Parent directory traversal (CRITICAL)
+  chmod 711 /home/ubuntu
+  chmod 755 "$SERVICE_DIR"
+  chmod 755 "$BASE_DIR"
+
+  getent group "$ADMIN_GROUP" >/dev/null || groupadd "$ADMIN_GROUP"
+  id -nG ubuntu | grep -qw "$ADMIN_GROUP" || usermod -aG "$ADMIN_GROUP" ubuntu
+
+  mkdir -p "$MARKER_DIR"
+  chown root:root "$MARKER_DIR"
+  chmod 755 "$MARKER_DIR"
+  echo "$GLOBAL_STATE" > "$GLOBAL_MARKER"
+fi
+
+# -------------------------
+# Per-port setup
+# -------------------------
+PORT_MARKER="$MARKER_DIR/$PORT"
+USER_UID=$(id -u "$USER_NAME" 2>/dev/null || true)
+PORT_STATE="version=$PROVISION_VERSION uid=$USER_UID"
+if [ -n "$USER_UID" ] && [ -d "$NOTEBOOK_DIR" ] && marker_ok "$PORT_MARKER" "$PORT_STATE"; then
+  echo "PROVISION cached"
+  mount_template
+  exit 0
+fi
+
+if [ -z "$USER_UID" ]; then
+  # If directory exists but user doesn't, remove it first to avoid warning
+  if [ -d "$INSTANCE_DIR" ]; then
+    echo "Directory $INSTANCE_DIR exists but user $USER_NAME doesn't. Cleaning up..." >&2
+    rm -rf "$INSTANCE_DIR"
+  fi
+  useradd --create-home --home-dir "$INSTANCE_DIR" --shell /bin/bash "$USER_NAME"
+  USER_UID=$(id -u "$USER_NAME")
+fi
+id -nG "$USER_NAME" | grep -qw "$ADMIN_GROUP" || usermod -aG "$ADMIN_GROUP" "$USER_NAME"
+
+mkdir -p "$NOTEBOOK_DIR"
+for dir in "$INSTANCE_DIR" "$NOTEBOOK_DIR"; do
+  user_dir_perms "$dir"
+done
+
+echo "version=$PROVISION_VERSION uid=$USER_UID" > "$PORT_MARKER"
+echo "PROVISION updated"
+mount_template
@@ -2,14 +2,26 @@
 
 PASSWORD="$1"
 PASSWORD_HASH="$2"
-EXPIRES_AT="$3"   # now correctly assigned
-TTL_MINUTES="$4"  # optional, for auto-stop
-USER_PORT="$5"
-
-STATE_FILE="/home/ubuntu/jupyter_service/instances/jupyter_instances.json"
-BASE_DIR="/home/ubuntu/jupyter_service/instances"
+EXPIRES_AT="$3"   # expiry itself is enforced by the backend's scheduler
+USER_PORT="$4"    # reserved by the backend
+MEMORY_MB="$5"    # cgroup limits; empty = no cgroup
+CPU_WEIGHT="$6"
+PIDS_MAX="$7"
+API_TOKEN="$8"    # lets the backend poll this server's REST API (idle culling)
+TEMPLATE="$9"     # notebook template in instances/common to seed with; empty = none
+
+SERVICE_DIR="/home/ubuntu/jupyter_service"
+BASE_DIR="$SERVICE_DIR/instances"
 COMMON_DIR="$BASE_DIR/common"
 JUPYTER_BIN="/home/ubuntu/.venv/bin/jupyter"
+READY_TIMEOUT_SECONDS=30
+SEED_MODE="${JUPYTER_SEED_MODE:-reflink}"   # reflink | overlay, see api/seeding.py
+CGROUP_ROOT="/sys/fs/cgroup/jupyter"   # keep in sync with api/cgroups.py
+
+# Step durations for the backend's metrics: "TIMING <step> <ms>" on stdout
+now_ms() { local t=${EPOCHREALTIME/[.,]/}; NOW_MS=$((t / 1000)); }
+step_start() { now_ms; STEP_START_MS=$NOW_MS; }
+step_done() { now_ms; echo "TIMING $1 $((NOW_MS - STEP_START_MS))"; }
 
 if [ -z "$PASSWORD_HASH" ] || [ -z "$EXPIRES_AT" ]; then
   echo "ERROR Missing password hash or expiry"
@@ -17,23 +29,13 @@ if [ -z "$PASSWORD_HASH" ] || [ -z "$EXPIRES_AT" ]; then
 fi
 
 # -------------------------
-# Find free port if not provided
+# Port
 # -------------------------
-if [ -n "$USER_PORT" ]; then
-    PORT="$USER_PORT"
-    # Check if the port is already in use
-    if ss -lnt | awk '{print $4}' | sed 's/.*://' | grep -q "^$PORT\$"; then
-        echo "ERROR: Port $PORT is already in use"
-        exit 1
-    fi
-else
-    PORT=$(/usr/bin/comm -23 \
-        <(/usr/bin/seq 9000 9100 | /usr/bin/sort) \
-        <(/usr/bin/ss -lnt | /usr/bin/awk '{print $4}' | /usr/bin/sed 's/.*://' | /usr/bin/sort -u) \
-        | /usr/bin/head -n 1)
-fi
+# Chosen and reserved by the backend's PortAllocator (api/ports.py), which
+# also checks that nothing is listening on it.
+PORT="$USER_PORT"
 
-[ -z "$PORT" ] && echo "ERROR No free ports" && exit 1
+[ -z "$PORT" ] && echo "ERROR No port given" && exit 1
 
 # -------------------------
 # Directories
@@ -42,114 +44,132 @@ INSTANCE_DIR="$BASE_DIR/$PORT"
 NOTEBOOK_DIR="$INSTANCE_DIR/notebooks"
 
 USER_NAME="jupyter-$PORT"
-ADMIN_GROUP="jupyter-admins"
-
-# Create notebook dir as root first
-sudo mkdir -p "$NOTEBOOK_DIR"
-
-# -------------------------
-# Fix parent directory traversal (CRITICAL)
-# -------------------------
-sudo chmod 711 /home/ubuntu
-sudo chmod 755 /home/ubuntu/jupyter_service
-sudo chmod 755 /home/ubuntu/jupyter_service/instances
 
 # =========================
-# Ensure admin group exists
+# Provision user and directories
 # =========================
-if ! getent group "$ADMIN_GROUP" >/dev/null; then
-  sudo groupadd "$ADMIN_GROUP"
+# One privileged call; it skips everything already recorded in its markers
+# (see provision_instance.sh), so a re-launch costs no recursive chown/chmod.
+step_start
+SNAPSHOT=""
+if [ -n "$TEMPLATE" ] && [ "$SEED_MODE" = "overlay" ]; then
+  # provision_instance.sh mounts it under notebooks/
+  if ! SNAPSHOT=$(PYTHONPATH="$SERVICE_DIR" python3 -m api.seeding snapshot "$TEMPLATE"); then
+    echo "ERROR: No snapshot of template $TEMPLATE" >&2
+    exit 1
+  fi
 fi
+if ! sudo "$SERVICE_DIR/scripts/provision_instance.sh" "$PORT" $SNAPSHOT; then
+  echo "ERROR: Failed to provision port $PORT" >&2
+  exit 1
+fi
+step_done provision
 
-# Ensure ubuntu is in admin group
-sudo usermod -aG "$ADMIN_GROUP" ubuntu
-
-# =========================
-# Create user if missing
-# =========================
-if ! cut -d: -f1 /etc/passwd | grep -q "^${USER_NAME}$"; then
-  # If directory exists but user doesn't, remove it first to avoid warning
-  if [ -d "$INSTANCE_DIR" ]; then
-    echo "Directory $INSTANCE_DIR exists but user $USER_NAME doesn't. Cleaning up..."
-    sudo rm -rf "$INSTANCE_DIR"
+# -------------------------
+# Seed notebooks
+# -------------------------
+# Reflinks from the template's snapshot; a no-op when this instance already
+# has the template's current version (see api/seeding.py)
+if [ -n "$TEMPLATE" ] && [ "$SEED_MODE" != "overlay" ]; then
+  step_start
+  if ! PYTHONPATH="$SERVICE_DIR" python3 -m api.seeding seed "$TEMPLATE" "$INSTANCE_DIR"; then
+    echo "ERROR: Failed to seed notebooks from template $TEMPLATE" >&2
+    exit 1
   fi
-  
-  sudo useradd \
-    --create-home \
-    --home-dir "$INSTANCE_DIR" \
-    --shell /bin/bash \
-    "$USER_NAME"
+  step_done seed
 fi
 
-# Add Jupyter user to admin group
-sudo usermod -aG "$ADMIN_GROUP" "$USER_NAME"
-
-# =========================
-# Directory setup
-# =========================
-sudo mkdir -p "$NOTEBOOK_DIR"
-sudo chown -R "$USER_NAME:$ADMIN_GROUP" "$INSTANCE_DIR"
-sudo chmod -R 777 "$INSTANCE_DIR"
-
-# Ensure new files inherit group
-sudo chmod g+s "$INSTANCE_DIR"
-
 # =========================
 # Start Jupyter
 # =========================
+echo "PHASE spawning"
 echo "Starting Jupyter on port $PORT as $USER_NAME..."
 
 # Escape password hash for safe passing through nested shells
 ESCAPED_PASSWORD_HASH=$(printf '%q' "$PASSWORD_HASH")
 
-sudo -u "$USER_NAME" -H bash -c "
+# A re-key file left from a previous run would override the new hash
+PASSWORD_FILE="$INSTANCE_DIR/.jupyter_password_hash"
+rm -f "$PASSWORD_FILE"
+
+step_start
+
+# The inner shell backgrounds Jupyter and prints its PID, so we never have to
+# look the process up by port afterwards. The log starts empty on each launch
+# and is opened O_APPEND so the backend can rotate it in place (api/logs.py).
+PID=$(sudo -u "$USER_NAME" -H bash -c "
 cd \"$NOTEBOOK_DIR\"
+: > \"$INSTANCE_DIR/jupyter.log\"
+export PYTHONPATH=\"$SERVICE_DIR\"
+export JUPYTER_PASSWORD_FILE=\"$PASSWORD_FILE\"
+export JUPYTER_TOKEN=\"$API_TOKEN\"
 nohup \"$JUPYTER_BIN\" lab \
   --ip=0.0.0.0 \
   --port=$PORT \
   --no-browser \
-  --ServerApp.token='' \
   --ServerApp.password=$ESCAPED_PASSWORD_HASH \
+  --ServerApp.identity_provider_class=api.jupyter_auth.RekeyablePasswordIdentityProvider \
   --notebook-dir=\"$NOTEBOOK_DIR\" \
-  > \"$INSTANCE_DIR/jupyter.log\" 2>&1 &
-" &
-
-# Wait for Jupyter to start and find PID (simplified)
-# Wait a moment for Jupyter to bind to port
-sleep 3
-
-# Find PID - try lsof first (fastest), then ss
-PID=$(sudo lsof -ti:$PORT 2>/dev/null | head -n 1)
-
-if [ -z "$PID" ]; then
-  # Fallback to ss
-  PID=$(sudo ss -lntp 2>/dev/null | grep ":$PORT " | sed -n 's/.*pid=\([0-9]*\).*/\1/p' | head -n 1)
-fi
-
-# Retry up to 8 times if PID not found (max 11 seconds total)
-RETRY=0
-while [ -z "$PID" ] && [ $RETRY -lt 8 ]; do
-  sleep 1
-  PID=$(sudo lsof -ti:$PORT 2>/dev/null | head -n 1)
-  [ -z "$PID" ] && PID=$(sudo ss -lntp 2>/dev/null | grep ":$PORT " | sed -n 's/.*pid=\([0-9]*\).*/\1/p' | head -n 1)
-  RETRY=$((RETRY + 1))
-done
+  >> \"$INSTANCE_DIR/jupyter.log\" 2>&1 &
+echo \$!
+")
 
-if [ -z "$PID" ]; then
-  echo "ERROR: Failed to find PID on port $PORT" >&2
+if ! [[ "$PID" =~ ^[0-9]+$ ]]; then
+  echo "ERROR: Failed to spawn Jupyter on port $PORT" >&2
   exit 1
 fi
 
 # -------------------------
-# Auto-expire (if TTL set)
+# cgroup v2 limits
 # -------------------------
-if [ ! -z "$TTL_MINUTES" ]; then
-(
-  sleep $((TTL_MINUTES * 60))
-  # Kill the Jupyter process (use sudo since it runs as jupyter user)
-  sudo kill "$PID" 2>/dev/null || kill "$PID" 2>/dev/null
-) &
+# Move the server into its own cgroup before any kernel exists, so every
+# kernel it starts inherits memory.max / cpu.weight / pids.max. The cgroup
+# is recreated on each launch to reset its OOM counters.
+if [ -n "$MEMORY_MB" ] && [ -f /sys/fs/cgroup/cgroup.controllers ]; then
+  CGROUP="$CGROUP_ROOT/$PORT"
+  sudo sh -c "
+    mkdir -p '$CGROUP_ROOT' &&
+    echo '+memory +cpu +pids' > '$CGROUP_ROOT/cgroup.subtree_control' &&
+    { rmdir '$CGROUP' 2>/dev/null; mkdir -p '$CGROUP'; } &&
+    echo $((MEMORY_MB * 1024 * 1024)) > '$CGROUP/memory.max' &&
+    echo ${CPU_WEIGHT:-100} > '$CGROUP/cpu.weight' &&
+    echo ${PIDS_MAX:-max} > '$CGROUP/pids.max' &&
+    echo $PID > '$CGROUP/cgroup.procs'
+  " || echo "WARNING: cgroup limits not applied for port $PORT" >&2
 fi
+step_done spawn
+
+# -------------------------
+# Wait for readiness
+# -------------------------
+# Probe /api/status with a tight exponential backoff (50ms -> 500ms). Any HTTP
+# response (200, or 403 before login) means the server is up and serving.
+now_ms; READY_START_MS=$NOW_MS
+READY_DEADLINE_MS=$((READY_START_MS + READY_TIMEOUT_SECONDS * 1000))
+DELAY=0.05
+while true; do
+  if [ ! -d "/proc/$PID" ]; then
+    echo "ERROR: Jupyter exited during startup: $(sudo tail -n 5 "$INSTANCE_DIR/jupyter.log" 2>/dev/null)" >&2
+    exit 1
+  fi
+  CODE=$(curl -s -o /dev/null -w '%{http_code}' --max-time 1 "http://127.0.0.1:$PORT/api/status")
+  [ "$CODE" != "000" ] && break
+
+  now_ms
+  if [ "$NOW_MS" -ge "$READY_DEADLINE_MS" ]; then
+    echo "ERROR: Jupyter on port $PORT not ready after ${READY_TIMEOUT_SECONDS}s" >&2
+    sudo kill "$PID" 2>/dev/null
+    exit 1
+  fi
+  sleep "$DELAY"
+  case "$DELAY" in
+    0.05) DELAY=0.1 ;;
+    0.1)  DELAY=0.2 ;;
+    *)    DELAY=0.5 ;;
+  esac
+done
+now_ms
+echo "TIMING readiness $((NOW_MS - READY_START_MS))"
 
 # -------------------------
 # Persist state
@@ -160,30 +180,19 @@ if [ -z "$PID" ] || ! [[ "$PID" =~ ^[0-9]+$ ]]; then
   exit 1
 fi
 
-# Write state file with error handling
-python3 - <<EOF
-import json, datetime, os, sys
-
-try:
-    f="$STATE_FILE"
-    os.makedirs(os.path.dirname(f), exist_ok=True)
-    data = json.load(open(f)) if os.path.exists(f) else {}
-    
-    data["$PORT"] = {
-        "pid": int("$PID"),
-        "started_at": datetime.datetime.utcnow().isoformat(),
-        "expires_at": "$EXPIRES_AT",
-        "path": "$INSTANCE_DIR",
-        "common": "$COMMON_DIR",
-        "password": "$PASSWORD"
-    }
-    
-    with open(f, "w") as outfile:
-        json.dump(data, outfile, indent=2)
-except Exception as e:
-    print(f"ERROR writing state file: {e}", file=sys.stderr)
-    sys.exit(1)
-EOF
+# Write through the shared state store (row-level upsert, no whole-file rewrite)
+step_start
+if ! PYTHONPATH="$SERVICE_DIR" python3 -m api.state upsert "$PORT" \
+    "pid=$PID" \
+    "started_at=$(date -u +%Y-%m-%dT%H:%M:%S.%6N)" \
+    "expires_at=$EXPIRES_AT" \
+    "path=$INSTANCE_DIR" \
+    "common=$COMMON_DIR" \
+    "password=$PASSWORD"; then
+  echo "ERROR writing instance state" >&2
+  exit 1
+fi
+step_done state_write
 
 # Output PORT and PID (required by API)
 echo "$PORT $PID"
@@ -1,28 +1,21 @@
 #!/bin/bash
-STATE_FILE="/home/ubuntu/jupyter_service/instances/jupyter_instances.json"
+SERVICE_DIR="/home/ubuntu/jupyter_service"
 PORT="$1"
 
-python3 - <<EOF
-import json, os, signal, shutil, sys
+INFO=$(PYTHONPATH="$SERVICE_DIR" python3 -m api.state get "$PORT" 2>/dev/null)
+if [ -z "$INFO" ]; then
+    echo "ERROR Not found"
+    exit 1
+fi
 
-f="$STATE_FILE"
-port="$PORT"
+# The server, its kernels and anything else running as jupyter-$PORT: SIGTERM,
+# SIGKILL after JUPYTER_STOP_GRACE_SECONDS; prints what it took (api/procs.py)
+PID=$(printf '%s' "$INFO" | python3 -c 'import json, sys; print(json.load(sys.stdin).get("pid") or 0)')
+if ! PYTHONPATH="$SERVICE_DIR" python3 -m api.procs stop "$PID" "$PORT"; then
+    echo "ERROR Processes of port $PORT survived SIGKILL; state entry kept" >&2
+    exit 1
+fi
 
-data=json.load(open(f))
-if port not in data:
-    print("ERROR Not found")
-    sys.exit(1)
+PYTHONPATH="$SERVICE_DIR" python3 -m api.state delete "$PORT"
 
-pid=data[port]["pid"]
-path=data[port].get("path")
-
-try:
-    os.kill(pid, signal.SIGTERM)
-except ProcessLookupError:
-    pass
-
-del data[port]
-json.dump(data, open(f,"w"), indent=2)
-
-print("STOPPED", port)
-EOF
+echo "STOPPED $PORT"
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Stand-in for a Jupyter server, for running the service on a box without
+JupyterLab (e.g. a local cluster of node agents, see api/agent.py).
+
+Answers the parts of the REST API the backend relies on, token-checked
+against JUPYTER_TOKEN like the real server:
+
+    GET /api/status, GET /api/kernels, DELETE /api/kernels/<id>
+
+Every other path gets a small page and counts as user activity, so idle
+culling can be exercised too (?no_track_activity=1 doesn't count).
+
+Usage: stub_jupyter.py PORT
+"""
+import json, os, sys
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TOKEN = os.environ.get("JUPYTER_TOKEN", "")
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class StubJupyter(BaseHTTPRequestHandler):
+    started = now_iso()
+    last_activity = started
+    kernels = {}
+
+    def _send(self, code, body=None, content_type="application/json"):
+        data = b"" if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method):
+        url = urlparse(self.path)
+        if "no_track_activity" not in parse_qs(url.query):
+            StubJupyter.last_activity = now_iso()
+        if not url.path.startswith("/api/"):
+            return self._send(200, f"<h1>Stub Jupyter on port {self.server.server_port}</h1>".encode(), "text/html")
+        # A 403 still means "up" to the launcher's readiness probe
+        if TOKEN and self.headers.get("Authorization") != f"token {TOKEN}":
+            return self._send(403, {"message": "Forbidden"})
+        if url.path == "/api/status" and method == "GET":
+            return self._send(200, {
+                "started": self.started,
+                "last_activity": self.last_activity,
+                "connections": 0,
+                "kernels": len(self.kernels),
+            })
+        if url.path == "/api/kernels" and method == "GET":
+            return self._send(200, list(self.kernels.values()))
+        if url.path.startswith("/api/kernels/") and method == "DELETE":
+            found = self.kernels.pop(url.path.rsplit("/", 1)[1], None)
+            return self._send(204 if found else 404)
+        return self._send(404, {"message": "Not found"})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    port = int(sys.argv[1])
+    server = ThreadingHTTPServer(("0.0.0.0", port), StubJupyter)
+    print(f"Stub Jupyter listening on {port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/bin/bash
+# Drop-in for start_jupyter.sh that runs scripts/stub_jupyter.py instead of
+# JupyterLab: no sudo, no per-port user, no cgroup. Same arguments and the
+# same stdout protocol (PHASE / TIMING lines, then "<port> <pid>"), so the
+# backend or a node agent can use it through JUPYTER_START_SCRIPT, e.g. to
+# try multi-node scheduling on one machine (see api/agent.py).
+
+PASSWORD="$1"
+PASSWORD_HASH="$2"
+EXPIRES_AT="$3"
+PORT="$4"
+API_TOKEN="$8"
+TEMPLATE="$9"
+
+SERVICE_DIR="$(cd "$(dirname "$0")/.." && pwd)"
+INSTANCE_DIR="${JUPYTER_STUB_DIR:-/tmp/jupyter_stub}/$PORT"
+PYTHON="${PYTHON:-python3}"
+READY_TIMEOUT_SECONDS=10
+
+now_ms() { local t=${EPOCHREALTIME/[.,]/}; NOW_MS=$((t / 1000)); }
+step_start() { now_ms; STEP_START_MS=$NOW_MS; }
+step_done() { now_ms; echo "TIMING $1 $((NOW_MS - STEP_START_MS))"; }
+
+if [ -z "$PASSWORD_HASH" ] || [ -z "$EXPIRES_AT" ] || [ -z "$PORT" ]; then
+  echo "ERROR Missing password hash, expiry or port"
+  exit 1
+fi
+mkdir -p "$INSTANCE_DIR/notebooks"
+
+# Templates are seeded as by start_jupyter.sh (reflink mode only, no mounts)
+if [ -n "$TEMPLATE" ]; then
+  step_start
+  PYTHONPATH="$SERVICE_DIR" "$PYTHON" -m api.seeding seed "$TEMPLATE" "$INSTANCE_DIR" || exit 1
+  step_done seed
+fi
+
+echo "PHASE spawning"
+step_start
+: > "$INSTANCE_DIR/jupyter.log"
+JUPYTER_TOKEN="$API_TOKEN" nohup "$PYTHON" "$SERVICE_DIR/scripts/stub_jupyter.py" "$PORT" \
+  >> "$INSTANCE_DIR/jupyter.log" 2>&1 &
+PID=$!
+step_done spawn
+
+now_ms; READY_DEADLINE_MS=$((NOW_MS + READY_TIMEOUT_SECONDS * 1000)); READY_START_MS=$NOW_MS
+until [ "$(curl -s -o /dev/null -w '%{http_code}' --max-time 1 "http://127.0.0.1:$PORT/api/status")" != "000" ]; do
+  if [ ! -d "/proc/$PID" ]; then
+    echo "ERROR: stub exited during startup: $(tail -n 5 "$INSTANCE_DIR/jupyter.log")" >&2
+    exit 1
+  fi
+  now_ms
+  if [ "$NOW_MS" -ge "$READY_DEADLINE_MS" ]; then
+    echo "ERROR: stub on port $PORT not ready after ${READY_TIMEOUT_SECONDS}s" >&2
+    kill "$PID" 2>/dev/null
+    exit 1
+  fi
+  sleep 0.05
+done
+now_ms
+echo "TIMING readiness $((NOW_MS - READY_START_MS))"
+
+step_start
+if ! PYTHONPATH="$SERVICE_DIR" "$PYTHON" -m api.state upsert "$PORT" \
+    "pid=$PID" \
+    "started_at=$(date -u +%Y-%m-%dT%H:%M:%S.%6N)" \
+    "expires_at=$EXPIRES_AT" \
+    "path=$INSTANCE_DIR" \
+    "password=$PASSWORD"; then
+  echo "ERROR writing instance state" >&2
+  kill "$PID" 2>/dev/null
+  exit 1
+fi
+step_done state_write
+
+echo "$PORT $PID"
@@ -18,13 +18,20 @@ sudo systemctl enable nginx
 sudo systemctl start nginx
 
 sudo rm /etc/nginx/sites-enabled/default
-sudo nano /etc/nginx/sites-available/jupyter_service
+# Renders nginx.conf with JupyterLab's static assets served by nginx;
+# re-run after upgrading JupyterLab or installing extensions (--check tells)
+sudo python3 /home/ubuntu/jupyter_service/scripts/gen_nginx_conf.py --precompress
 sudo ln -s /etc/nginx/sites-available/jupyter_service \
            /etc/nginx/sites-enabled/jupyter_service
 sudo nginx -t
 sudo systemctl reload nginx
 sudo ufw allow 'Nginx Full'
 
+# Backend packages on top of the venv's JupyterLab / FastAPI / uvicorn:
+# orjson renders the session listing (api/main.py, the stdlib encoder is the
+# slow fallback), argon2-cffi hashes session passwords (api/hashing.py)
+/home/ubuntu/.venv/bin/pip install orjson argon2-cffi
+
 sudo chmod +x /home/ubuntu/jupyter_service/scripts/*.sh
 sudo chown -R ubuntu:ubuntu /home/ubuntu/jupyter_service
 
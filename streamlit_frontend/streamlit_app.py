@@ -1,66 +1,130 @@
 import streamlit as st
 import requests
-import json
+import threading
+import time
 from datetime import datetime, timezone
-from pathlib import Path
 
 API_BASE = "http://localhost:8000/api/jupyter"
-PORT_HISTORY_FILE = Path(__file__).parent / "port_history.json"
+INSTANCES_TTL_SECONDS = 2
+# What the session list shows; the backend leaves password out unless asked
+INSTANCE_FIELDS = "port,pid,started_at,expires_at,tag,url,password"
 
 st.set_page_config(page_title="Jupyter Manager", layout="wide")
 st.title("🧪 JupyterLab Instance Manager")
 
 # ------------------------
-# PORT HISTORY MANAGEMENT
+# BACKEND CLIENT
 # ------------------------
-def load_port_history():
-    """Load port history from JSON file"""
-    if PORT_HISTORY_FILE.exists():
-        try:
-            with open(PORT_HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
-
-def save_port_history(history):
-    """Save port history to JSON file"""
-    with open(PORT_HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
-
-def update_port_history(port, tag):
-    """Update port history with new usage
-    Args:
-        port: Port number
-        tag: Tag string. If empty string, sets to "Untagged". If provided, updates tag.
+@st.cache_resource
+def get_http():
+    """One pooled HTTP session shared by every rerun (keep-alive to the backend)."""
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=16))
+    return session
+
+
+class InstancesClient:
     """
-    history = load_port_history()
-    port_str = str(port)
-    
-    if port_str not in history:
-        history[port_str] = {
-            "tag": tag if tag else "Untagged",
-            "last_used": datetime.now(timezone.utc).isoformat(),
-            "times_used": 1
-        }
-    else:
-        # Always update tag (empty string will set to "Untagged")
-        history[port_str]["tag"] = tag if tag else "Untagged"
-        history[port_str]["last_used"] = datetime.now(timezone.utc).isoformat()
-        history[port_str]["times_used"] = history[port_str].get("times_used", 0) + 1
-    
-    save_port_history(history)
+    Mirror of GET /api/jupyter shared by all reruns. Within INSTANCES_TTL_SECONDS
+    it answers from memory; after that it asks only for what changed since
+    the last state version (If-None-Match turns "nothing changed" into a 304).
+    """
+    def __init__(self, http):
+        self.http = http
+        self.instances = None   # port -> entry
+        self.version = None
+        self.etag = None
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.fetched_at = 0
+
+    def _refresh(self):
+        params = {"fields": INSTANCE_FIELDS}
+        if self.version is not None:
+            params["since"] = self.version
+        headers = {"If-None-Match": self.etag} if self.etag and self.version is not None else {}
+        resp = self.http.get(API_BASE, params=params, headers=headers, timeout=5)
+        if resp.status_code == 304:
+            return
+        resp.raise_for_status()
+        body = resp.json()
+        if self.version is None:
+            self.instances = {inst["port"]: inst for inst in body}
+        elif body["full"]:
+            self.instances = {inst["port"]: inst for inst in body["instances"]}
+        else:
+            for port in body["deleted"]:
+                self.instances.pop(port, None)
+            for inst in body["changed"]:
+                self.instances[inst["port"]] = inst
+        self.version = int(resp.headers["X-State-Version"])
+        self.etag = resp.headers.get("ETag")
+
+    def get(self):
+        """Active instances sorted by port, or None if the backend can't be reached."""
+        with self.lock:
+            if time.time() - self.fetched_at > INSTANCES_TTL_SECONDS:
+                try:
+                    self._refresh()
+                except (requests.RequestException, ValueError, KeyError):
+                    # Start over with a full fetch next time
+                    self.instances = self.version = self.etag = None
+                    return None
+                self.fetched_at = time.time()
+            return [self.instances[port] for port in sorted(self.instances)]
+
+
+@st.cache_resource
+def get_instances_client():
+    return InstancesClient(get_http())
+
 
 def get_instances():
-    """Get active Jupyter instances from API"""
+    """Get active Jupyter instances from API (None if unreachable)"""
+    return get_instances_client().get()
+
+
+def get_port_history():
+    """Port history kept by the backend, most recently used first (with an 'active' flag)"""
     try:
-        resp = requests.get(API_BASE)
-        if resp.status_code != 200:
-            return []
-        return resp.json()
-    except:
+        resp = get_http().get(f"{API_BASE}/history", params={"sort": "last_used", "order": "desc", "limit": 500}, timeout=5)
+        resp.raise_for_status()
+        return resp.json()["items"]
+    except (requests.RequestException, ValueError, KeyError):
         return []
 
+def set_port_tag(port, tag):
+    """Remember tag for port (empty string sets it to "Untagged")"""
+    resp = get_http().put(f"{API_BASE}/history/{int(port)}", params={"tag": tag}, timeout=5)
+    return resp.status_code == 200
+
+def launch_session(params):
+    """Submit a launch job and long-poll it until it is ready or failed.
+    Returns (ok, data): data is the launch result on success, an error message otherwise.
+    """
+    http = get_http()
+    resp = http.post(API_BASE, params=params)
+    if resp.status_code != 202:
+        return False, resp.json().get("detail", "Failed to start JupyterLab")
+    if resp.json()["phase"] == "ready":
+        # Claimed from the warm pool, no need to wait
+        get_instances_client().invalidate()
+        return True, resp.json()["result"]
+
+    job_url = f"{API_BASE}/jobs/{resp.json()['job_id']}"
+    with st.spinner("Launching JupyterLab..."):
+        while True:
+            job = http.get(job_url, params={"wait": 30}).json()
+            if job["phase"] in ("ready", "failed"):
+                get_instances_client().invalidate()
+            if job["phase"] == "ready":
+                return True, job["result"]
+            if job["phase"] == "failed":
+                return False, job.get("error") or "Failed to start JupyterLab"
+
 # ------------------------
 # START NEW SESSION
 # ------------------------
@@ -110,16 +174,14 @@ with st.expander("➕ Start New Jupyter Session", expanded=True):
             params["user_port"] = int(user_port)
         if password_input:
             params["password"] = password_input
-        
-        resp = requests.post(API_BASE, params=params)
-        if resp.status_code == 200:
-            data = resp.json()
+        if tag_input.strip():
+            # The backend records the port history (and tag) on launch
+            params["tag"] = tag_input.strip()
+
+        ok, data = launch_session(params)
+        if ok:
             actual_port = data.get('port', user_port)
-            
-            # Save port history with tag
-            if actual_port:
-                update_port_history(actual_port, tag_input.strip() if tag_input else "")
-            
+
             st.success("JupyterLab started successfully!")
             st.markdown("### 🔐 Access Details")
             st.markdown(f"- **URL:** [{data['url']}]({data['url']})")
@@ -134,25 +196,26 @@ with st.expander("➕ Start New Jupyter Session", expanded=True):
             
             st.rerun()
         else:
-            st.error(resp.json().get("detail", "Failed to start JupyterLab"))
+            st.error(data)
 
 # ------------------------
 # OPEN PREVIOUSLY OPENED SESSIONS
 # ------------------------
-port_history = load_port_history()
+port_history = get_port_history()
 if port_history:
     with st.expander("📂 Open Previously Opened Session", expanded=False):
         instances = get_instances()
         active_ports = {str(inst['port']) for inst in instances} if instances else set()
-        
+
         # Create dropdown options with status
         port_options = []
         port_data_map = {}
-        
-        # Sort by last used (most recent first)
-        for port, data in sorted(port_history.items(), key=lambda x: x[1].get("last_used", ""), reverse=True):
-            tag = data.get("tag", "Untagged")
-            is_active = str(port) in active_ports
+
+        # Already sorted by last used (most recent first)
+        for data in port_history:
+            port = data["port"]
+            tag = data.get("tag") or "Untagged"
+            is_active = data["active"]
             status = "🟢 Currently Active" if is_active else "⚪ Inactive"
             last_used = data.get("last_used", "")
             
@@ -208,9 +271,7 @@ if port_history:
                     )
                 
                 with col2:
-                    # Check if edited port is active
-                    instances = get_instances()
-                    active_ports = {str(inst['port']) for inst in instances} if instances else set()
+                    # Check if edited port is active (active_ports from above)
                     edited_port_is_active = str(edited_port) in active_ports
                     
                     if edited_port_is_active:
@@ -265,12 +326,12 @@ if port_history:
                         final_tag = edited_tag.strip() if edited_tag and edited_tag.strip() else ""
                         
                         # Update history for the edited port (which might be different from selected_port)
-                        update_port_history(edited_port, final_tag)
-                        
+                        set_port_tag(edited_port, final_tag)
+
                         # If port changed, also update the old port's history (remove or keep as is)
                         if edited_port != selected_port:
                             # Keep old port history but update tag if needed
-                            update_port_history(selected_port, final_tag)
+                            set_port_tag(selected_port, final_tag)
                         
                         display_tag = final_tag if final_tag else "Untagged"
                         if edited_port != selected_port:
@@ -296,16 +357,14 @@ if port_history:
                                 params["disable_timer"] = True
                             if session_password:
                                 params["password"] = session_password
-                            
-                            resp = requests.post(API_BASE, params=params)
-                            if resp.status_code == 200:
-                                data = resp.json()
+                            final_tag = edited_tag.strip() if edited_tag and edited_tag.strip() else ""
+                            if final_tag:
+                                params["tag"] = final_tag
+
+                            ok, data = launch_session(params)
+                            if ok:
                                 actual_port = data.get('port', edited_port)
-                                
-                                # Update history with edited tag and port
-                                final_tag = edited_tag.strip() if edited_tag and edited_tag.strip() else ""
-                                update_port_history(actual_port, final_tag)
-                                
+
                                 display_tag = final_tag if final_tag else "Untagged"
                                 st.success(f"Session opened on port {actual_port}!")
                                 st.markdown("### 🔐 Access Details")
@@ -320,8 +379,7 @@ if port_history:
                                 
                                 st.rerun()
                             else:
-                                error_msg = resp.json().get("detail", "Failed to start session")
-                                st.error(f"Failed to open session: {error_msg}")
+                                st.error(f"Failed to open session: {data}")
         else:
             st.info("No previous sessions found in history")
 else:
@@ -333,15 +391,12 @@ st.divider()
 # ------------------------
 # LIST RUNNING SESSIONS
 # ------------------------
-def get_instances():
-    resp = requests.get(API_BASE)
-    if resp.status_code != 200:
-        st.error("Cannot reach backend")
-        st.stop()
-    return resp.json()
 st.subheader("📋 Active Jupyter Sessions")
 
 instances = get_instances()
+if instances is None:
+    st.error("Cannot reach backend")
+    st.stop()
 now = datetime.now(timezone.utc)
 
 if not instances:
@@ -368,7 +423,8 @@ else:
             col4.write(time_remaining_display)
 
             if col5.button("🛑 Stop", key=f"stop-{inst['port']}"):
-                r = requests.delete(f"{API_BASE}/{inst['port']}")
+                r = get_http().delete(f"{API_BASE}/{inst['port']}")
+                get_instances_client().invalidate()
                 if r.status_code == 200:
                     st.success(f"Stopped {inst['port']}")
                 else: